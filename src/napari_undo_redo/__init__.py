@@ -3,4 +3,12 @@ try:
 except ImportError:
     __version__ = "unknown"
 
-# from ._widget import UndoRedoWidget
+
+def __getattr__(name: str):
+    # the widget imports napari and Qt, it is only loaded when napari
+    # activates the plugin (see napari.yaml) or when it is used
+    if name == "UndoRedoWidget":
+        from ._widget import UndoRedoWidget
+
+        return UndoRedoWidget
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
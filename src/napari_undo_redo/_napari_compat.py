@@ -0,0 +1,152 @@
+"""
+The private napari internals the history relies on.
+
+napari has no public API to insert shapes at an index, or to edit some
+shapes without triangulating all of them again: the commands of Shapes
+layers (see command.shapes) go through the ShapeList of the layer instead,
+as napari does when shapes are edited with the mouse.
+
+Labels layers record every write of data_setitem in their own undo
+history, the paint commands (see command.paint) write around it.
+
+Private attributes of napari layers are only accessed here, so that a
+napari release changing them only breaks this module,
+see _tests/test_napari_compat.py.
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from napari.layers import Labels, Shapes
+
+
+def labels_setitem(layer: Labels, indices: tuple, values) -> None:
+    """
+    Labels.data_setitem, without recording the write in the undo history of
+    the layer, nor emitting a paint event
+
+    Args:
+        layer: napari Labels layer
+        indices: indices of the voxels to write, one array per dimension
+        values: a single label or one label per voxel
+    """
+    # data_setitem clears the redo history and stages the write
+    redo = list(layer._redo_history)
+    staged = len(layer._staged_history)
+    with layer.block_history():
+        layer.data_setitem(indices, values, refresh=True)
+        del layer._staged_history[staged:]
+    layer._redo_history.extend(redo)
+
+
+def shape_vertices(layer: Shapes, index: int) -> np.ndarray:
+    """
+    returns the vertices of a shape, without copying them
+    """
+    return layer._data_view.shapes[index].data
+
+
+def edit_shapes(
+    layer: Shapes,
+    indices: Sequence[int],
+    data: List[np.ndarray],
+    shape_types: Optional[List[str]] = None,
+) -> None:
+    """
+    replace the vertices (and type) of some shapes, only these shapes are
+    triangulated again. No event is emitted.
+
+    Args:
+        layer: napari Shapes layer
+        indices: indices of the shapes
+        data: new vertices of each shape
+        shape_types: new type of each shape, None keeps their types
+    """
+    view = layer._data_view
+    with layer.events.set_data.blocker(), view.batched_updates():
+        for k, (index, vertices) in enumerate(zip(indices, data)):
+            new_type = None if shape_types is None else shape_types[k]
+            view.edit(index, np.array(vertices), new_type=new_type)
+
+
+def pop_shapes(layer: Shapes, first: int) -> Tuple[list, list, list]:
+    """
+    remove the shapes from `first` on, without triangulating the others.
+    No event is emitted and the features table is left as it is.
+
+    Returns:
+        the removed Shape objects, their face colors and edge colors,
+        to append them back with append_shapes
+    """
+    view = layer._data_view
+    n = len(view.shapes)
+    shapes = list(view.shapes[first:])
+    face_colors = list(view._face_color[first:])
+    edge_colors = list(view._edge_color[first:])
+    view.remove_multiple(list(range(n - 1, first - 1, -1)))
+    view._face_color = view._face_color[:first]
+    view._edge_color = view._edge_color[:first]
+    return shapes, face_colors, edge_colors
+
+
+def new_shape(
+    layer: Shapes,
+    vertices: np.ndarray,
+    shape_type: str,
+    edge_width: float,
+    z_index: int,
+):
+    """
+    returns a Shape object of the layer, not added to it yet
+    """
+    from napari.layers.shapes._shapes_constants import ShapeType, shape_classes
+
+    return shape_classes[ShapeType(shape_type)](
+        vertices,
+        edge_width=edge_width,
+        z_index=z_index,
+        dims_order=layer._slice_input.order,
+        ndisplay=layer._slice_input.ndisplay,
+    )
+
+
+def append_shapes(
+    layer: Shapes, shapes: list, face_colors: list, edge_colors: list
+) -> None:
+    """
+    append Shape objects to a layer, only the ones that were never added
+    are triangulated. No event is emitted and the features table is left
+    as it is, see insert_feature_rows.
+    """
+    view = layer._data_view
+    view.add(
+        shapes,
+        face_color=face_colors,
+        edge_color=edge_colors,
+        z_refresh=False,
+    )
+    view._update_z_order()
+
+
+def insert_feature_rows(layer: Shapes, indices: np.ndarray) -> None:
+    """
+    insert rows of default features at `indices`, once the shapes were
+    inserted. The rows of the other shapes are moved, not copied.
+
+    Args:
+        layer: napari Shapes layer
+        indices: sorted indices of the inserted shapes
+    """
+    total = layer.nshapes
+    n = total - len(indices)
+    table = layer._feature_table
+    # default rows are appended, then moved to `indices`
+    table.resize(total)
+    rows = np.insert(
+        np.arange(n), indices - np.arange(len(indices)), np.arange(n, total)
+    )
+    table.reorder(rows)
@@ -0,0 +1,45 @@
+import json
+
+import numpy as np
+
+from napari_undo_redo import benchmarks
+
+
+def test_benchmarks_leave_the_layers_unchanged(monkeypatch):
+    layers = {}
+
+    def points(n):
+        layers["points"] = layer = original(n)
+        layers["data"] = np.array(layer.data)
+        return layer
+
+    original = benchmarks._LAYERS["points"]
+    monkeypatch.setitem(benchmarks._LAYERS, "points", points)
+    records = list(
+        benchmarks.run(layers=["points"], sizes=[100], edits=[1, 10], repeat=1)
+    )
+
+    assert records[0]["benchmark"] == "environment"
+    measured = {(r["benchmark"], r["command"], r["edit"]) for r in records[1:]}
+    for command in ("MoveCommand", "AddCommand", "DeleteCommand"):
+        for benchmark in ("push", "undo", "redo", "capture"):
+            assert (benchmark, command, 10) in measured
+    assert all(r["median_s"] >= 0 for r in records[1:])
+    np.testing.assert_array_equal(layers["points"].data, layers["data"])
+
+
+def test_compare_reports_regressions(tmp_path):
+    output = tmp_path / "results.jsonl"
+    argv = ["--layers", "labels", "--sizes", "1e3", "--edits", "10"]
+    assert benchmarks.main(argv + ["--output", str(output)]) == 0
+
+    baseline = benchmarks.load_results(str(output))
+    assert benchmarks.compare(baseline, baseline) == []
+
+    slower = [dict(r) for r in baseline]
+    slower[1]["median_s"] = baseline[1]["median_s"] * 2 + 1
+    (regression,) = benchmarks.compare(baseline, slower)
+    assert "median_s" in regression
+
+    output.write_text("".join(json.dumps(r) + "\n" for r in slower[:1]))
+    assert benchmarks.main(argv + ["--compare", str(output)]) == 0
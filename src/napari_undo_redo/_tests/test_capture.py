@@ -0,0 +1,48 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from napari_undo_redo.capture import CaptureQueue
+
+
+def test_jobs_run_in_order_on_a_shared_pool():
+    done = {"a": [], "b": []}
+
+    def job(name, i):
+        # later jobs are faster, they would overtake the earlier ones
+        time.sleep(0.002 * (i % 3 == 0))
+        done[name].append(i)
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        queues = {"a": CaptureQueue(pool), "b": CaptureQueue(pool)}
+        for i in range(50):
+            for name, queue in queues.items():
+                queue.submit(job, name, i)
+        for queue in queues.values():
+            queue.wait()
+            assert len(queue) == 0
+
+    assert done["a"] == list(range(50))
+    assert done["b"] == list(range(50))
+
+
+def test_inline_queue_and_errors():
+    calls = []
+    queue = CaptureQueue()
+    assert not queue.is_async
+    assert queue.submit(calls.append, 1) is None
+    assert calls == [1]
+
+    def fail():
+        raise RuntimeError("boom")
+
+    queue = CaptureQueue(workers=1)
+    queue.submit(fail)
+    queue.submit(lambda: calls.append(threading.current_thread().name))
+    with pytest.raises(RuntimeError):
+        queue.wait()
+    queue.close()
+    # the job after the failed one still ran, on the pool
+    assert calls[1].startswith("napari-undo-redo")
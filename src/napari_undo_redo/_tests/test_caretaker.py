@@ -0,0 +1,276 @@
+import numpy as np
+import pytest
+from napari.layers import Labels, Points, Shapes
+
+from napari_undo_redo.caretaker import CareTaker
+from napari_undo_redo.chunkstore import ChunkStore
+from napari_undo_redo.delta import Delta, compute_delta
+from napari_undo_redo.eviction import (
+    DropOldest,
+    MergeIntoBase,
+    ThinIntermediate,
+)
+from napari_undo_redo.state import State
+
+
+@pytest.mark.parametrize(
+    "new",
+    [
+        # move
+        np.array([[0, 10], [5, 25], [0, 30], [0, 40]]),
+        # add at the end
+        np.array([[0, 10], [0, 20], [0, 30], [0, 40], [0, 50]]),
+        # delete unsorted, non contiguous rows
+        np.array([[0, 20], [0, 40]]),
+        # everything changes
+        np.array([[1, 1], [2, 2], [3, 3]]),
+    ],
+)
+def test_delta_round_trip(new):
+    prev = np.array([[0, 10], [0, 20], [0, 30], [0, 40]])
+    delta = compute_delta(prev, new)
+
+    np.testing.assert_array_equal(delta.apply(prev), new)
+    np.testing.assert_array_equal(delta.revert(new), prev)
+
+
+def test_delta_is_compact_for_small_edits():
+    prev = np.random.random((100_000, 3))
+    new = np.delete(prev, [3, 500, 99_000], 0)
+    delta = compute_delta(prev, new)
+
+    np.testing.assert_array_equal(delta.deleted_indices, [3, 500, 99_000])
+    assert delta.nbytes < 1_000
+
+
+def test_delta_on_shapes_data():
+    prev = [np.array([[0, 0], [0, 5], [5, 5]]), np.array([[1, 1], [2, 2]])]
+    new = [prev[0], np.array([[3, 3], [4, 4]]), np.array([[7, 7], [8, 8]])]
+    delta = compute_delta(prev, new)
+
+    assert all(np.array_equal(a, b) for a, b in zip(delta.apply(prev), new))
+    assert all(np.array_equal(a, b) for a, b in zip(delta.revert(new), prev))
+
+
+def test_caretaker_restores_every_state():
+    layer = Points(np.array([[0, 10], [0, 20], [0, 30]]))
+    caretaker = CareTaker()
+    history = []
+    for step in range(6):
+        if step % 3 == 0:
+            layer.data = np.append(layer.data, [[step, step]], axis=0)
+        elif step % 3 == 1:
+            layer.data = np.delete(layer.data, 0, 0)
+        else:
+            data = layer.data.copy()
+            data[-1] += 1
+            layer.data = data
+        caretaker.add_state(State(layer))
+        history.append(layer.data.copy())
+
+    assert len(caretaker) == len(history)
+    for index in [5, 0, 3, 4, 1, 2]:
+        np.testing.assert_array_equal(
+            caretaker.get_state(index).data, history[index]
+        )
+
+    caretaker.truncate(2)
+    assert len(caretaker) == 2
+    np.testing.assert_array_equal(caretaker.get_state(-1).data, history[1])
+
+
+def test_caretaker_shapes_layer():
+    layer = Shapes([np.array([[0, 0], [0, 5], [5, 5]])], shape_type="polygon")
+    caretaker = CareTaker()
+    caretaker.add_state(State(layer))
+    layer.add(np.array([[1, 1], [2, 2], [1, 3]]), shape_type="polygon")
+    caretaker.add_state(State(layer))
+
+    assert len(caretaker.get_state(0).data) == 1
+    assert len(caretaker.get_state(1).data) == 2
+
+
+def test_chunk_store_shares_unchanged_blocks():
+    store = ChunkStore(chunk_bytes=1024)
+    data = np.zeros((64, 64, 64), dtype=np.uint8)
+    first = store.put(data)
+    data[10, 10, 10] = 7
+    second = store.put(data)
+
+    # all the zero blocks are stored once, plus the block that was painted
+    assert len(store) == 2
+    np.testing.assert_array_equal(store.get(second), data)
+    assert store.get(first).sum() == 0
+
+    store.release(second)
+    assert len(store) == 1
+
+
+def test_caretaker_labels_layer():
+    layer = Labels(np.zeros((20, 256, 256), dtype=np.uint16))
+    caretaker = CareTaker(chunk_bytes=4096)
+    caretaker.add_state(State(layer))
+    for label in range(1, 4):
+        layer.data[label, :5, :5] = label
+        caretaker.add_state(State(layer))
+
+    assert len(caretaker) == 4
+    # one zero block plus one painted block per state
+    assert caretaker.chunk_store.nbytes == 4 * 4096
+    assert caretaker.get_state(2).data[2, 0, 0] == 2
+    assert caretaker.get_state(0).data.sum() == 0
+
+    caretaker.truncate(1)
+    assert len(caretaker) == 1
+    assert caretaker.chunk_store.nbytes == 4096
+
+
+@pytest.mark.parametrize(
+    "policy", [DropOldest(), ThinIntermediate(), MergeIntoBase()]
+)
+def test_caretaker_budget(policy):
+    layer = Points(np.random.random((1_000, 2)))
+    caretaker = CareTaker(max_steps=10, eviction_policy=policy)
+    history = []
+    for step in range(40):
+        layer.data = np.append(layer.data, [[step, step]], axis=0)
+        caretaker.add_state(State(layer))
+        history.append(layer.data.copy())
+
+    assert len(caretaker) <= 10
+    # the most recent states can always be restored
+    np.testing.assert_array_equal(caretaker.get_state(-1).data, history[-1])
+    for index in range(len(caretaker)):
+        data = caretaker.get_state(index).data
+        assert any(np.array_equal(data, state) for state in history)
+
+    caretaker.set_budget(max_bytes=caretaker.footprint()["nbytes"] // 2)
+    assert caretaker.nbytes <= caretaker.max_bytes or len(caretaker) == 1
+    np.testing.assert_array_equal(caretaker.get_state(-1).data, history[-1])
+
+
+def test_caretaker_spills_cold_steps(tmp_path):
+    layer = Points(np.random.random((10_000, 3)))
+    caretaker = CareTaker(hot_steps=3, spill_directory=str(tmp_path))
+    history = []
+    for step in range(10):
+        data = layer.data.copy()
+        data[step * 100 : step * 100 + 500] += 1
+        layer.data = data
+        caretaker.add_state(State(layer))
+        history.append(layer.data.copy())
+
+    footprint = caretaker.footprint()
+    assert footprint["spilled_nbytes"] > footprint["nbytes"]
+    assert len(list(tmp_path.iterdir())) == 1
+    for index in [0, 9, 4, 1, 8]:
+        np.testing.assert_array_equal(
+            caretaker.get_state(index).data, history[index]
+        )
+
+    caretaker.close()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_caretaker_spills_cold_labels_blocks(tmp_path):
+    layer = Labels(np.zeros((10, 64, 64), dtype=np.uint8))
+    caretaker = CareTaker(
+        chunk_bytes=1024, hot_steps=2, spill_directory=str(tmp_path)
+    )
+    caretaker.add_state(State(layer))
+    for label in range(1, 10):
+        layer.data[0] = label
+        caretaker.add_state(State(layer))
+
+    assert caretaker.footprint()["spilled_nbytes"] > 0
+    assert caretaker.get_state(0).data.sum() == 0
+    np.testing.assert_array_equal(caretaker.get_state(9).data, layer.data)
+    caretaker.close()
+
+
+def test_state_holds_only_a_copy_of_the_data():
+    triangle = np.array([[0, 0], [10, 0], [5, 8]], float)
+    layer = Shapes([triangle, np.eye(4, 2)], shape_type=["polygon", "path"])
+    state = State(layer)
+    assert not hasattr(state, "__dict__")
+    layer._data_view.shift(0, np.array([1.0, 1.0]))
+    np.testing.assert_array_equal(state.data[0], triangle)
+
+    # restored to another layer, with the type of each shape
+    other = Shapes([np.eye(2, 2)], shape_type="line")
+    state.restore(other)
+    assert other.shape_type == ["polygon", "path"]
+    np.testing.assert_array_equal(other.data[0], triangle)
+    with pytest.raises(TypeError):
+        state.restore(Points())
+
+
+@pytest.mark.parametrize(
+    "options",
+    [{}, {"max_steps": 45, "eviction_policy": ThinIntermediate()}],
+)
+def test_caretaker_keyframes_bound_the_deltas_applied(options, monkeypatch):
+    layer = Points(np.random.random((1_000, 2)))
+    caretaker = CareTaker(keyframe_interval=8, **options)
+    history = []
+    for step in range(60):
+        data = layer.data.copy()
+        data[step] += 1
+        layer.data = np.append(data, [[step, step]], axis=0)
+        caretaker.add_state(State(layer))
+        history.append(layer.data.copy())
+
+    applied = []
+    for name in ("apply", "revert"):
+        method = getattr(Delta, name)
+        monkeypatch.setattr(
+            Delta,
+            name,
+            lambda delta, data, method=method: applied.append(1)
+            or method(delta, data),
+        )
+    for index in [30, 3, len(caretaker) - 1, 21, 12]:
+        applied.clear()
+        data = caretaker.get_state(index).data
+        assert any(np.array_equal(data, state) for state in history)
+        assert len(applied) <= 8
+
+    caretaker.truncate(20)
+    assert max(caretaker.keyframes) < 20
+    np.testing.assert_array_equal(
+        caretaker.get_state(-1).data, caretaker.get_state(19).data
+    )
+
+
+@pytest.mark.parametrize("layer_type", ["Points", "Labels"])
+def test_caretaker_undo_tree(layer_type):
+    caretaker = CareTaker(chunk_bytes=64, undo_tree=True)
+
+    def add_state(value, length=None):
+        if length is not None:
+            # a new state after an undo
+            caretaker.branch(length)
+        data = np.full((4, 8), value, dtype=np.int32)
+        caretaker.add_state(State.from_data(layer_type, data))
+
+    for value in range(3):
+        add_state(value)
+    add_state(10, length=2)
+    add_state(11)
+    add_state(20, length=1)
+    values = [caretaker.get_state(i).data[0, 0] for i in range(len(caretaker))]
+    assert values == [0, 20]
+    assert len(caretaker.branches) == 2
+
+    # 0 -> 1 -> 10 -> 11 forks from 0, 1 -> 2 from it
+    (first,) = caretaker.tree.branches
+    (nested,) = first.branches
+    assert caretaker.switch_branch(nested) == 2
+    assert caretaker.get_state(2).data[0, 0] == 2
+    assert caretaker.get_state(1).data[0, 0] == 1
+    assert len(caretaker.branches) == 2
+
+    # the least recently visited branch is pruned first: 0 -> 20
+    caretaker.set_budget(max_bytes=caretaker.nbytes - 1)
+    assert [len(branch) for branch in caretaker.branches] == [2]
+    assert len(caretaker) == 3
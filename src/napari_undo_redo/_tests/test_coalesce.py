@@ -0,0 +1,27 @@
+import numpy as np
+from napari.components import ViewerModel
+
+from napari_undo_redo._widget import UndoRedoWidget
+
+
+def test_events_within_the_window_are_one_entry(qtbot):
+    # the widget only uses the layer list, no canvas is needed
+    viewer = ViewerModel()
+    layer = viewer.add_image(np.zeros((8, 8)))
+    widget = UndoRedoWidget(viewer, layer, coalesce_ms=50)
+
+    for value in (1.0, 2.0, 3.0):
+        layer.data = np.full((8, 8), value)
+    assert widget.savedStates == 1
+    qtbot.wait(200)
+    assert widget.savedStates == 2
+
+    # an event after the window is another entry
+    layer.data = np.full((8, 8), 4.0)
+    qtbot.wait(200)
+    assert widget.savedStates == 3
+
+    widget.undo()
+    assert layer.data[0, 0] == 3
+    widget.undo()
+    assert layer.data[0, 0] == 0
@@ -0,0 +1,690 @@
+import gc
+import weakref
+from collections import deque
+
+import numpy as np
+import pytest
+from napari.layers import Labels, Points, Shapes
+
+from napari_undo_redo.command import (
+    AddCommand,
+    ColumnsCommand,
+    CommandManager,
+    CompositeCommand,
+    DeleteCommand,
+    EditShapesCommand,
+    HistoryRegistry,
+    MoveCommand,
+    PaintCommand,
+    TransformShapesCommand,
+    infer_columns_command,
+    infer_command,
+    infer_shapes_command,
+    replay,
+    shapes_data,
+)
+from napari_undo_redo.command.columns import read_columns
+
+
+def test_manager_budget_drops_oldest_commands():
+    layer = Points(np.zeros((0, 2)))
+    manager = CommandManager(layer, max_steps=3, merge=False)
+    for i in range(5):
+        layer.data = np.append(layer.data, [[i, i]], axis=0)
+        manager.add_command_to_undo_stack(
+            AddCommand(layer, [i], np.array([[i, i]]))
+        )
+
+    assert len(manager.undo_stack) == 3
+    assert manager.nbytes == sum(cmd.nbytes for cmd in manager.undo_stack)
+
+    # the remaining commands still undo the most recent additions
+    for _ in range(5):
+        manager.undo()
+    np.testing.assert_array_equal(layer.data, [[0, 0], [1, 1]])
+
+
+def test_delete_command_restores_unsorted_indices_in_one_update():
+    original = np.arange(20).reshape(10, 2)
+    layer = Points(original)
+    indices = [7, 0, 3, 9]
+    layer.data = np.delete(original, indices, 0)
+    cmd = DeleteCommand(layer, indices, original[indices])
+
+    updates = []
+    layer.events.data.connect(
+        lambda event: (
+            updates.append(event) if event.action == "changed" else None
+        )
+    )
+    cmd.undo()
+    np.testing.assert_array_equal(layer.data, original)
+    assert len(updates) == 1
+
+    cmd.redo()
+    np.testing.assert_array_equal(layer.data, np.delete(original, indices, 0))
+
+
+def test_add_command_with_interleaved_indices():
+    original = np.arange(12).reshape(6, 2)
+    indices = [4, 1, 7]
+    rows = np.array([[100, 100], [101, 101], [102, 102]])
+    expected = original.tolist()
+    for index, row in sorted(zip(indices, rows.tolist())):
+        expected.insert(index, row)
+
+    layer = Points(original)
+    cmd = AddCommand(layer, indices, rows)
+    cmd.redo()
+    np.testing.assert_array_equal(layer.data, expected)
+    cmd.undo()
+    np.testing.assert_array_equal(layer.data, original)
+
+
+@pytest.mark.parametrize("uniform", [True, False])
+def test_move_command_single_update(uniform):
+    original = np.random.random((1_000, 3))
+    indices = np.arange(0, 1_000, 7)
+    prev = original[indices]
+    if uniform:
+        new = prev + 0.5
+    else:
+        new = prev + np.random.random(prev.shape)
+
+    layer = Points(original)
+    layer.data[indices] = new
+    moved = layer.data.copy()
+    cmd = MoveCommand(layer, indices, prev, new)
+    if uniform and cmd.offset is not None:
+        assert cmd.nbytes < prev.nbytes
+
+    events = []
+    layer.events.data.connect(events.append)
+    cmd.undo()
+    assert len(events) == 1
+    np.testing.assert_array_equal(layer.data, original)
+    cmd.redo()
+    assert len(events) == 2
+    np.testing.assert_array_equal(layer.data, moved)
+
+
+def test_move_command_stores_integer_translation_as_offset():
+    layer = Points(np.arange(40).reshape(20, 2))
+    indices = [2, 5, 11]
+    prev = layer.data[indices].copy()
+    cmd = MoveCommand(layer, indices, prev, prev + [3, -4])
+
+    assert cmd.offset is not None
+    assert cmd.prev_coordinates is None
+
+
+def test_paint_command_from_paint_events():
+    layer = Labels(np.zeros((4, 64, 64), dtype=np.uint8))
+    commands = []
+    layer.events.paint.connect(
+        lambda event: commands.append(
+            PaintCommand.from_history_item(layer, event.value)
+        )
+    )
+    with layer.block_history():
+        layer.paint((1, 10, 10), 3)
+        layer.paint((1, 12, 12), 3)
+    layer.data_setitem(
+        (np.array([1, 1]), np.array([0, 1]), np.array([0, 0])), 5
+    )
+    painted = layer.data.copy()
+
+    assert len(commands) == 2
+    stroke = commands[0]
+    assert stroke.indices.dtype == np.uint32
+    assert len(stroke.new_values) == 1
+    assert stroke.nbytes < 10 * len(stroke.indices)
+
+    commands[1].undo()
+    stroke.undo()
+    assert layer.data.sum() == 0
+    stroke.redo()
+    commands[1].redo()
+    np.testing.assert_array_equal(layer.data, painted)
+
+
+@pytest.mark.parametrize(
+    "edit, command_type",
+    [
+        (lambda data: np.delete(data, [1, 5], 0), DeleteCommand),
+        (
+            lambda data: np.insert(data, [0, 3], [[9, 9], [8, 8]], 0),
+            AddCommand,
+        ),
+        (
+            lambda data: np.where(np.arange(8)[:, None] == 2, 7, data),
+            MoveCommand,
+        ),
+        (lambda data: np.insert(data[2:], 3, [[9, 9]], 0), CompositeCommand),
+        (lambda data: data.astype(float) / 2, CompositeCommand),
+    ],
+)
+def test_infer_command(edit, command_type):
+    original = np.arange(16).reshape(8, 2)
+    layer = Points(original)
+    layer.data = edit(original)
+    edited = layer.data.copy()
+
+    cmd = infer_command(layer, original, edited)
+    assert isinstance(cmd, command_type)
+    cmd.undo()
+    np.testing.assert_array_equal(layer.data, original)
+    cmd.redo()
+    np.testing.assert_array_equal(layer.data, edited)
+
+
+def test_infer_command_no_change():
+    data = np.arange(16).reshape(8, 2)
+    assert infer_command(Points(data), data, data.copy()) is None
+
+
+def _add_point(registry, layer, value):
+    layer.data = np.append(layer.data, [[value, value]], axis=0)
+    cmd = AddCommand(layer, [len(layer.data) - 1], np.array([[value, value]]))
+    registry.push(layer, cmd)
+
+
+@pytest.mark.parametrize("global_timeline", [False, True])
+def test_registry_undo_order(global_timeline):
+    registry = HistoryRegistry(global_timeline=global_timeline)
+    first, second = Points(np.zeros((0, 2))), Points(np.zeros((0, 2)))
+    _add_point(registry, first, 1)
+    _add_point(registry, second, 2)
+    _add_point(registry, first, 3)
+
+    if global_timeline:
+        assert registry.undo() is first
+        assert registry.undo() is second
+        assert len(second.data) == 0
+        assert registry.redo() is second
+    else:
+        assert registry.undo(second) is second
+        assert registry.undo(second) is None
+        assert len(first.data) == 2
+        assert registry.redo(second) is second
+    assert len(second.data) == 1
+
+    # a new edit drops what can be redone
+    _add_point(registry, second, 4)
+    assert registry.redo(None if global_timeline else second) is None
+
+
+def test_registry_remove_frees_layer():
+    registry = HistoryRegistry(global_timeline=True)
+    layer = Points(np.zeros((0, 2)))
+    _add_point(registry, layer, 1)
+    ref = weakref.ref(layer)
+
+    registry.remove(layer)
+    del layer
+    gc.collect()
+    assert ref() is None
+    assert len(registry) == 0
+    assert registry.undo() is None
+
+
+def test_transaction_is_one_fused_update():
+    original = np.arange(20, dtype=float).reshape(10, 2)
+    layer = Points(original)
+    manager = CommandManager(layer)
+    with manager.transaction():
+        for i in range(5):
+            cmd = AddCommand(layer, [len(layer.data)], np.array([[i, -i]]))
+            cmd.redo()
+            manager.add_command_to_undo_stack(cmd)
+            cmd = MoveCommand(layer, [i], layer.data[[i]], layer.data[[i]] + 1)
+            cmd.redo()
+            manager.add_command_to_undo_stack(cmd)
+        cmd = DeleteCommand(layer, [0, 12], layer.data[[0, 12]])
+        cmd.redo()
+        manager.add_command_to_undo_stack(cmd)
+    edited = layer.data.copy()
+
+    assert len(manager.undo_stack) == 1
+    assert isinstance(manager.undo_stack[-1], CompositeCommand)
+
+    updates = []
+    layer.events.data.connect(
+        lambda event: (
+            updates.append(event) if event.action == "changed" else None
+        )
+    )
+    manager.undo()
+    np.testing.assert_array_equal(layer.data, original)
+    manager.redo()
+    np.testing.assert_array_equal(layer.data, edited)
+    assert len(updates) == 2
+
+
+def test_transaction_of_paint_commands():
+    layer = Labels(np.zeros((10, 10), dtype=np.uint8))
+    manager = CommandManager(layer)
+    with manager.transaction():
+        # two overlapping strokes of rows 0-5 and 4-9
+        for value, indices in ((1, np.arange(60)), (2, np.arange(40, 100))):
+            cmd = PaintCommand(
+                layer, indices, layer.data.flat[indices], [value]
+            )
+            cmd.redo()
+            manager.add_command_to_undo_stack(cmd)
+    edited = layer.data.copy()
+
+    writes = []
+    layer.events.labels_update.connect(writes.append)
+    manager.undo()
+    assert layer.data.sum() == 0
+    manager.redo()
+    np.testing.assert_array_equal(layer.data, edited)
+    assert len(writes) == 2
+
+
+def test_manager_merges_consecutive_commands():
+    layer = Points(np.zeros((4, 2)))
+    manager = CommandManager(layer)
+
+    for _ in range(3):
+        prev = layer.data[[1, 2]]
+        cmd = MoveCommand(layer, [1, 2], prev, prev + [1, 0.5])
+        cmd.redo()
+        manager.add_command_to_undo_stack(cmd)
+    assert len(manager.undo_stack) == 1
+    np.testing.assert_array_equal(
+        layer.data, [[0, 0], [3, 1.5], [3, 1.5], [0, 0]]
+    )
+
+    for rows in ([[7, 7], [8, 8]], [[9, 9]]):
+        cmd = AddCommand(layer, [0, 3][: len(rows)], np.array(rows))
+        cmd.redo()
+        manager.add_command_to_undo_stack(cmd)
+    assert len(manager.undo_stack) == 2
+    assert manager.nbytes == sum(cmd.nbytes for cmd in manager.undo_stack)
+    edited = layer.data.copy()
+
+    manager.undo()
+    np.testing.assert_array_equal(
+        layer.data, [[0, 0], [3, 1.5], [3, 1.5], [0, 0]]
+    )
+    manager.undo()
+    np.testing.assert_array_equal(layer.data, np.zeros((4, 2)))
+    manager.redo()
+    manager.redo()
+    np.testing.assert_array_equal(layer.data, edited)
+
+    # deleting the added rows cancels the add
+    cmd = DeleteCommand(layer, [4, 0, 1], edited[[4, 0, 1]])
+    cmd.redo()
+    manager.add_command_to_undo_stack(cmd)
+    assert len(manager.undo_stack) == 1
+    np.testing.assert_array_equal(
+        layer.data, [[0, 0], [3, 1.5], [3, 1.5], [0, 0]]
+    )
+
+
+def _square(x):
+    return np.array([[x, x], [x, x + 5], [x + 5, x + 5], [x + 5, x]], float)
+
+
+def _assert_same_shapes(layer, shapes):
+    assert layer.shape_type == shapes.shape_types
+    for vertices, expected in zip(layer.data, shapes.data):
+        np.testing.assert_array_equal(vertices, expected)
+
+
+def test_shapes_commands_only_hold_the_edited_shapes():
+    layer = Shapes([_square(10 * i) for i in range(6)], face_color="red")
+    manager = CommandManager(layer, merge=False)
+    states = [shapes_data(layer)]
+
+    def edit(change, changed=None):
+        prev = shapes_data(layer)
+        change()
+        cmd = infer_shapes_command(layer, prev, shapes_data(layer), changed)
+        manager.add_command_to_undo_stack(cmd)
+        states.append(shapes_data(layer))
+        return cmd
+
+    triangle = np.array([[100, 100], [110, 120], [90, 130]], float)
+    edit(lambda: layer.add(triangle, shape_type="polygon"))
+    # deleting shapes in the middle, their undo inserts them back in place
+    layer.selected_data = {1, 2}
+    edit(layer.remove_selected)
+    # napari moves the vertices of a shape in place
+    cmd = edit(lambda: layer._data_view.shift(0, np.array([3.0, 4.0])), [0])
+    assert isinstance(cmd, TransformShapesCommand)
+    np.testing.assert_array_equal(cmd.offset, [3, 4])
+    assert cmd.nbytes < _square(0).nbytes
+    # a rectangle with an extra vertex becomes a polygon
+    cmd = edit(
+        lambda: layer._data_view.edit(
+            1, np.append(_square(30), [[33, 40]], axis=0), new_type="polygon"
+        ),
+        [1],
+    )
+    assert isinstance(cmd, EditShapesCommand)
+
+    for state in reversed(states[:-1]):
+        manager.undo()
+        _assert_same_shapes(layer, state)
+    # the shapes inserted back kept their color
+    np.testing.assert_array_equal(layer.face_color[:, 0], 1)
+    for state in states[1:]:
+        manager.redo()
+        _assert_same_shapes(layer, state)
+
+
+def test_undone_delete_keeps_the_following_shapes():
+    colors = ["red", "green", "blue", "white", "yellow"]
+    layer = Shapes(
+        [_square(10 * i) for i in range(5)],
+        face_color=colors,
+        edge_width=[1, 2, 3, 4, 5],
+        features={"id": np.arange(5)},
+    )
+    layer.selected_data = {4}
+    prev, prev_columns = shapes_data(layer), read_columns(layer)
+    layer.remove([1, 3])
+    cmd = infer_shapes_command(layer, prev, shapes_data(layer))
+    cmd.capture_columns(prev_columns, read_columns(layer))
+    tail = layer._data_view.shapes[1:]
+
+    cmd.undo()
+    _assert_same_shapes(layer, prev)
+    # the shapes after the first insertion point are not built again
+    assert layer._data_view.shapes[2] is tail[0]
+    assert layer._data_view.shapes[4] is tail[1]
+    np.testing.assert_array_equal(layer.features["id"], np.arange(5))
+    np.testing.assert_array_equal(layer.edge_width, [1, 2, 3, 4, 5])
+    np.testing.assert_array_equal(
+        layer.face_color, Shapes(prev.data, face_color=colors).face_color
+    )
+    assert layer.selected_data == {4}
+
+
+def test_undone_delete_keeps_the_z_index():
+    layer = Shapes([_square(10 * i) for i in range(4)], z_index=[3, 2, 1, 0])
+    manager = CommandManager(layer)
+    for indices in ([1], [0, 1, 2]):
+        prev, prev_columns = shapes_data(layer), read_columns(layer)
+        layer.remove(indices)
+        cmd = infer_shapes_command(layer, prev, shapes_data(layer))
+        cmd.capture_columns(prev_columns, read_columns(layer))
+        manager.add_command_to_undo_stack(cmd)
+
+    manager.undo()
+    assert layer.z_index == [3, 1, 0]
+    manager.undo()
+    assert layer.z_index == [3, 2, 1, 0]
+    manager.redo()
+    manager.redo()
+    manager.undo()
+    assert layer.z_index == [3, 1, 0]
+
+
+def test_shapes_transforms_merge():
+    layer = Shapes([_square(0), _square(10)])
+    manager = CommandManager(layer)
+    start = shapes_data(layer)
+    for scale in (2.0, 3.0):
+        prev = shapes_data(layer)
+        layer._data_view.scale(1, scale, center=np.array([10.0, 10.0]))
+        manager.add_command_to_undo_stack(
+            infer_shapes_command(layer, prev, shapes_data(layer), [1])
+        )
+    assert len(manager.undo_stack) == 1
+    manager.undo()
+    _assert_same_shapes(layer, start)
+
+
+def test_columns_are_restored_with_the_rows():
+    layer = Points(
+        np.arange(10.0).reshape(5, 2),
+        size=np.arange(1.0, 6.0),
+        features={"id": np.arange(5), "name": list("abcde")},
+    )
+    manager = CommandManager(layer, merge=False)
+    start = read_columns(layer)
+
+    prev = read_columns(layer)
+    layer.size = np.where(np.arange(5) == 3, 10.0, layer.size)
+    cmd = infer_columns_command(layer, prev, read_columns(layer))
+    assert isinstance(cmd, ColumnsCommand)
+    assert list(cmd.indices) == ["size"]
+    np.testing.assert_array_equal(cmd.indices["size"], [3])
+    manager.add_command_to_undo_stack(cmd)
+    edited = read_columns(layer)
+
+    # napari trims the columns at the end when rows are deleted
+    # with layer.data, the command puts the right rows back
+    prev_data = np.array(layer.data)
+    layer.selected_data = {1, 2}
+    layer.remove_selected()
+    cmd = infer_command(layer, prev_data, layer.data)
+    cmd.capture_columns(edited, read_columns(layer, copy=False))
+    manager.add_command_to_undo_stack(cmd)
+    deleted = read_columns(layer)
+
+    for expected in (edited, start):
+        manager.undo()
+        for name, values in read_columns(layer).items():
+            np.testing.assert_array_equal(values, expected[name])
+    manager.redo()
+    manager.redo()
+    for name, values in read_columns(layer).items():
+        np.testing.assert_array_equal(values, deleted[name])
+
+
+def test_undo_only_writes_the_rows_that_changed(monkeypatch):
+    from napari_undo_redo.command import columns
+
+    layer = Points(
+        np.arange(20.0).reshape(10, 2),
+        size=np.arange(1.0, 11.0),
+        features={"id": np.arange(10)},
+    )
+    start = read_columns(layer)
+    written = {}
+
+    def write_rows(layer, indices, values):
+        written.update(indices)
+        write_rows_(layer, indices, values)
+
+    write_rows_ = columns.write_rows
+    monkeypatch.setattr(columns, "write_rows", write_rows)
+
+    cmd = DeleteCommand(layer, [7], layer.data[[7]])
+    cmd.capture_columns(read_columns(layer, copy=False), {})
+    cmd.redo()
+    cmd.undo()
+    # the rows before the deleted one are left as they are
+    assert written["features.id"].min() == 7
+    for name, values in read_columns(layer).items():
+        np.testing.assert_array_equal(values, start[name])
+
+    # the columns of the layer are copied before being written,
+    # and the data isn't reassigned
+    sizes = layer.size
+    edits = CompositeCommand(
+        [
+            ColumnsCommand(layer, {"size": [i]}, {"size": [0.5]}, {})
+            for i in (2, 5)
+        ]
+    )
+    updates = []
+    layer.events.data.connect(updates.append)
+    written.clear()
+    edits.undo()
+    np.testing.assert_array_equal(written["size"], [2, 5])
+    np.testing.assert_array_equal(layer.size[[2, 5]], 0.5)
+    np.testing.assert_array_equal(sizes, start["size"])
+    assert not updates
+
+
+def _random_commands(n, steps, rng):
+    commands = []
+    for _ in range(steps):
+        kind, k = rng.integers(3), int(rng.integers(1, 4))
+        if kind == 0 or n <= k:
+            indices = rng.choice(n + k, k, replace=False).tolist()
+            commands.append(AddCommand(None, indices, rng.random((k, 2))))
+            n += k
+        elif kind == 1:
+            indices = rng.choice(n, k, replace=False).tolist()
+            commands.append(DeleteCommand(None, indices, np.zeros((k, 2))))
+            n -= k
+        else:
+            indices = rng.choice(n, k + 1, replace=False)
+            prev = rng.random((k + 1, 2))
+            # translations are stored as an offset
+            new = prev + 1.0 if rng.integers(2) else rng.random((k + 1, 2))
+            commands.append(MoveCommand(None, indices, prev, new))
+    return commands
+
+
+def test_replay_matches_redoing_the_commands():
+    rng = np.random.default_rng(0)
+    base = rng.random((50, 2))
+    commands = _random_commands(len(base), 300, rng)
+    commands = commands[:100] + [CompositeCommand(commands[100:110])]
+    expected = CompositeCommand(commands).redo_data(base.copy())
+
+    # tiny blocks, so that they are split and emptied
+    data = replay(commands, base, block_size=4)
+
+    np.testing.assert_array_equal(data, expected)
+    assert len(base) == 50
+
+
+def test_replay_to_a_layer_rebuilds_its_history():
+    data = np.arange(12.0).reshape(6, 2)
+    names = np.array(list("abcdef"), dtype=object)
+    session = Points(data, features={"name": names})
+    commands = [
+        DeleteCommand(session, [1], data[[1]]),
+        AddCommand(
+            session,
+            [0],
+            np.array([[9.0, 9.0]]),
+            {"features.name": np.array(["z"], dtype=object)},
+        ),
+        MoveCommand(session, [2, 3], data[[2, 3]], data[[2, 3]] + 5),
+    ]
+    commands[0].capture_columns(read_columns(session), {})
+    for cmd in commands:
+        cmd.redo()
+
+    layer = Points(data, features={"name": names})
+    manager = CommandManager(layer, merge=False)
+    replay(commands, layer, manager)
+
+    np.testing.assert_array_equal(layer.data, session.data)
+    assert list(layer.features["name"]) == list("zacdef")
+    assert len(manager.undo_stack) == 3
+    for _ in commands:
+        manager.undo()
+    np.testing.assert_array_equal(layer.data, data)
+    assert list(layer.features["name"]) == list("abcdef")
+
+
+def test_go_to_is_one_fused_update():
+    original = np.arange(20, dtype=float).reshape(10, 2)
+    layer = Points(original)
+    manager = CommandManager(layer, merge=False)
+    history = [original]
+    for i in range(6):
+        cmd = AddCommand(layer, [i], np.array([[i, -i]]))
+        if i % 2:
+            cmd = MoveCommand(layer, [i], layer.data[[i]], layer.data[[i]] + 1)
+        cmd.redo()
+        manager.add_command_to_undo_stack(cmd)
+        history.append(layer.data.copy())
+
+    updates = []
+    layer.events.data.connect(
+        lambda event: (
+            updates.append(event) if event.action == "changed" else None
+        )
+    )
+    assert manager.go_to(1) == -5
+    np.testing.assert_array_equal(layer.data, history[1])
+    assert manager.go_to(4) == 3
+    np.testing.assert_array_equal(layer.data, history[4])
+    assert len(updates) == 2
+
+    # the stacks are the same as after stepping one command at a time
+    manager.redo()
+    np.testing.assert_array_equal(layer.data, history[5])
+    assert manager.go_to(-1) == -5
+    np.testing.assert_array_equal(layer.data, original)
+    assert manager.position == 0 and manager.last_position == 6
+
+
+def test_registry_go_to_on_the_global_timeline():
+    registry = HistoryRegistry(global_timeline=True)
+    first, second = Points(np.zeros((0, 2))), Points(np.zeros((0, 2)))
+    for value, layer in enumerate([first, second, first, second]):
+        _add_point(registry, layer, value)
+    assert registry.position() == (4, 4)
+
+    updates = []
+    for layer in (first, second):
+        layer.events.data.connect(
+            lambda event: (
+                updates.append(event.source)
+                if event.action in ("added", "removed", "changed")
+                else None
+            )
+        )
+    # a single update of each layer
+    assert registry.go_to(1) == [second, first]
+    assert updates == [second, first]
+    assert (len(first.data), len(second.data)) == (1, 0)
+    assert registry.position() == (1, 4)
+
+    assert registry.go_to(3) == [second, first]
+    assert (len(first.data), len(second.data)) == (2, 1)
+    assert registry.redo() is second
+    assert len(second.data) == 2
+
+
+def test_undo_tree_keeps_the_alternative_edits():
+    layer = Points(np.zeros((1, 2)))
+    manager = CommandManager(layer, merge=False, undo_tree=True)
+
+    def add(value):
+        cmd = AddCommand(layer, [len(layer.data)], np.array([[value] * 2]))
+        cmd.redo()
+        manager.add_command_to_undo_stack(cmd)
+
+    add(1)
+    add(2)
+    manager.undo()
+    add(3)
+    add(4)
+    # 0 -> 1 -> 3 -> 4, and the branch 1 -> 2
+    (branch,) = manager.branches
+    assert (branch.fork, len(branch)) == (1, 1)
+    assert manager.redo_stack == deque()
+
+    manager.switch_branch(branch)
+    np.testing.assert_array_equal(layer.data[:, 0], [0, 1, 2])
+    # the edits it replaced are a branch now, sharing 0 -> 1
+    (other,) = manager.branches
+    assert (other.fork, len(other)) == (1, 2)
+
+    manager.switch_branch(other, steps=1)
+    np.testing.assert_array_equal(layer.data[:, 0], [0, 1, 3])
+    manager.redo()
+    np.testing.assert_array_equal(layer.data[:, 0], [0, 1, 3, 4])
+    assert manager.nbytes == (
+        sum(cmd.nbytes for cmd in manager.undo_stack) + manager.tree.nbytes
+    )
+
+    # over budget, the branches are pruned before the line
+    manager.set_budget(max_bytes=manager.nbytes - 1)
+    assert manager.branches == []
+    assert len(manager.undo_stack) == 3
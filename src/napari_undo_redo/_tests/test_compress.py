@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+from napari.layers import Labels, Points, Shapes
+
+from napari_undo_redo.caretaker import CareTaker
+from napari_undo_redo.command import CommandManager, MoveCommand
+from napari_undo_redo.compress import Codec, CompressedArray
+from napari_undo_redo.state import State
+
+
+@pytest.mark.parametrize("name", ["zlib", "lzma"])
+@pytest.mark.parametrize("shuffle", [True, False])
+def test_codec_round_trip(name, shuffle):
+    codec = Codec(name, shuffle=shuffle)
+    data = np.cumsum(np.ones((1000, 3)), axis=0)
+    compressed = codec.compress(data)
+    assert isinstance(compressed, CompressedArray)
+    assert compressed.nbytes < data.nbytes / 4
+    np.testing.assert_array_equal(compressed.load(), data)
+    # cached, and read-only since it is shared
+    assert compressed.load() is compressed.load()
+    assert not compressed.load().flags.writeable
+    # too small, or random bytes, are kept as they are
+    small = np.arange(3)
+    assert codec.compress(small) is small
+    noise = np.random.bytes(10_000)
+    noise = np.frombuffer(noise, np.uint8)
+    assert codec.compress(noise) is noise
+
+
+def test_codec_cache_is_bounded():
+    codec = Codec(cache_bytes=3 * 8000)
+    arrays = [codec.compress(np.full(1000, i, np.float64)) for i in range(5)]
+    for compressed in arrays:
+        compressed.load()
+    assert codec._cached_nbytes <= codec.cache_bytes
+    assert len(codec._cache) == 3
+
+
+@pytest.mark.parametrize(
+    "layer_type, make",
+    [
+        (Points, lambda i: np.arange(3000.0).reshape(-1, 2) + i),
+        (Shapes, lambda i: [np.eye(4, 2) * j + i for j in range(200)]),
+        (Labels, lambda i: np.full((256, 256), i, np.uint8)),
+    ],
+)
+def test_caretaker_compressed_history(layer_type, make):
+    caretaker = CareTaker(compression=Codec())
+    raw = CareTaker()
+    for i in range(5):
+        layer = layer_type(make(i))
+        caretaker.add_state(State(layer))
+        raw.add_state(State(layer))
+    assert caretaker.nbytes < raw.nbytes
+    for i in reversed(range(5)):
+        data = caretaker.get_state(i).data
+        expected = make(i)
+        if layer_type is Shapes:
+            for item, other in zip(data, expected):
+                np.testing.assert_array_equal(item, other)
+        else:
+            np.testing.assert_array_equal(data, expected)
+
+
+def test_compressed_commands():
+    layer = Points(np.zeros((2000, 2)))
+    manager = CommandManager(layer, compression=Codec(), merge=False)
+    moves = []
+    for i in range(3):
+        prev = np.array(layer.data)
+        layer.data = prev + np.linspace(0, 1, len(prev))[:, None]
+        new = np.array(layer.data)
+        cmd = MoveCommand(layer, np.arange(len(prev)), prev, new)
+        manager.add_command_to_undo_stack(cmd)
+        moves.append(np.array(layer.data))
+    # only the top command is kept raw
+    first, second, top = manager.undo_stack
+    assert isinstance(first.__dict__["prev_coordinates"], CompressedArray)
+    assert not isinstance(top.__dict__["prev_coordinates"], CompressedArray)
+    assert manager.nbytes == sum(cmd.nbytes for cmd in manager.undo_stack)
+    assert first.nbytes < top.nbytes
+
+    for expected in reversed([np.zeros((2000, 2))] + moves[:-1]):
+        manager.undo()
+        np.testing.assert_array_equal(layer.data, expected)
+    for expected in moves:
+        manager.redo()
+        np.testing.assert_array_equal(layer.data, expected)
@@ -0,0 +1,53 @@
+import numpy as np
+
+from napari_undo_redo.fingerprint import ChangeDetector
+
+
+def test_change_detector_arrays():
+    data = np.arange(3000, dtype=float).reshape(1000, 3)
+    detector = ChangeDetector(block_bytes=240)
+    detector.reset(data)
+
+    assert not detector.has_changed(data.copy())
+    assert detector.has_changed(data[:-1])
+    assert detector.has_changed(data.astype(np.float32))
+    changed = data.copy()
+    changed[500, 1] += 1
+    assert detector.has_changed(changed)
+
+
+def test_change_detector_rows_in_place():
+    data = np.zeros((1000, 2))
+    detector = ChangeDetector(block_bytes=160)
+    detector.reset(data)
+
+    data[900] = 1
+    # only the blocks of the given rows are checked
+    assert not detector.has_changed(data, rows=[0, 1])
+    assert detector.has_changed(data, rows=[900])
+    assert detector.has_changed(data, rows=[-100])
+    # a copy is not the fingerprinted object, all the rows are checked
+    assert detector.has_changed(data.copy(), rows=[0])
+    assert detector.has_changed(data.copy(), full=False)
+    # the same object without rows is hashed again
+    assert detector.has_changed(data)
+    assert detector.has_changed(data, full=False)
+
+    # only the blocks of the edited rows are fingerprinted again
+    detector.reset(data, rows=[900])
+    assert not detector.has_changed(data, rows=[900])
+    assert not detector.has_changed(data)
+    assert not detector.has_changed(data.copy())
+    data[0] = 2
+    detector.reset(data.copy(), rows=[0])
+    assert not detector.has_changed(data.copy())
+
+
+def test_change_detector_shapes():
+    data = [np.zeros((4, 2)), np.ones((3, 2))]
+    detector = ChangeDetector()
+    detector.reset(data)
+
+    assert not detector.has_changed([item.copy() for item in data])
+    assert detector.has_changed(data[:1])
+    assert detector.has_changed([np.zeros((4, 2)), np.ones((4, 2))])
@@ -0,0 +1,50 @@
+import json
+import subprocess
+import sys
+
+# the history engine, usable in headless batch jobs
+CORE_MODULES = [
+    "napari_undo_redo",
+    "napari_undo_redo.command",
+    "napari_undo_redo.caretaker",
+    "napari_undo_redo.originator",
+    "napari_undo_redo.journal",
+    "napari_undo_redo.capture",
+    "napari_undo_redo.fingerprint",
+    "napari_undo_redo.metrics",
+]
+HEAVY_MODULES = ["napari", "qtpy", "pandas", "vispy"]
+
+# numpy is imported first, only the plugin's own import time is measured
+_SCRIPT = f"""
+import importlib, json, sys, time
+import numpy
+start = time.perf_counter()
+for name in {CORE_MODULES!r}:
+    importlib.import_module(name)
+seconds = time.perf_counter() - start
+heavy = [name for name in {HEAVY_MODULES!r} if name in sys.modules]
+print(json.dumps({{"seconds": seconds, "heavy": heavy}}))
+"""
+
+
+def test_core_imports_fast_without_napari_and_qt():
+    # a fresh interpreter, the test session already imported napari
+    output = subprocess.run(
+        [sys.executable, "-c", _SCRIPT],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    result = json.loads(output.splitlines()[-1])
+
+    assert result["heavy"] == []
+    # about 0.1 s here, napari alone takes several seconds
+    assert result["seconds"] < 1.0
+
+
+def test_widget_is_loaded_lazily():
+    import napari_undo_redo
+    from napari_undo_redo._widget import UndoRedoWidget
+
+    assert napari_undo_redo.UndoRedoWidget is UndoRedoWidget
@@ -0,0 +1,163 @@
+import os
+
+import numpy as np
+from napari.layers import Labels, Points, Shapes
+
+from napari_undo_redo.command import (
+    AddCommand,
+    CommandManager,
+    DeleteCommand,
+    MoveCommand,
+    PaintCommand,
+    infer_columns_command,
+    infer_shapes_command,
+    shapes_data,
+)
+from napari_undo_redo.command.columns import read_columns
+from napari_undo_redo.journal import read_journal
+
+
+def _edit(manager, cmd):
+    cmd.redo()
+    manager.add_command_to_undo_stack(cmd)
+
+
+def test_journal_rebuilds_stacks(tmp_path):
+    path = str(tmp_path / "points.journal")
+    layer = Points(np.zeros((4, 2)))
+    manager = CommandManager(layer, max_steps=5)
+    manager.load_journal(path, checkpoint_every=7)
+
+    for i in range(10):
+        _edit(manager, AddCommand(layer, [0], np.array([[i, i]])))
+        _edit(
+            manager,
+            MoveCommand(layer, [1, 2], layer.data[[1, 2]], [[i, 0], [0, i]]),
+        )
+    _edit(manager, DeleteCommand(layer, [3], layer.data[[3]]))
+    manager.undo()
+    manager.undo()
+    manager.journal.close()
+    data = layer.data.copy()
+
+    undo_stack, redo_stack = read_journal(path, layer)
+    assert len(undo_stack) == len(manager.undo_stack)
+    assert len(redo_stack) == len(manager.redo_stack)
+    for loaded, cmd in zip(
+        undo_stack + redo_stack, manager.undo_stack + manager.redo_stack
+    ):
+        assert type(loaded) is type(cmd)
+        assert loaded == cmd
+
+    # a new session continues with the reloaded history
+    reloaded = CommandManager(layer, max_steps=5)
+    reloaded.load_journal(path)
+    steps = len(reloaded.undo_stack)
+    for _ in range(steps):
+        reloaded.undo()
+    for _ in range(steps):
+        reloaded.redo()
+    np.testing.assert_array_equal(layer.data, data)
+    reloaded.journal.close()
+
+
+def test_journal_rebuilds_shapes_stacks(tmp_path):
+    path = str(tmp_path / "shapes.journal")
+    layer = Shapes([np.eye(4, 2) * (i + 1) for i in range(3)])
+    manager = CommandManager(layer, merge=False)
+    manager.load_journal(path)
+    for change in (
+        lambda: layer.add(np.eye(3, 2), shape_type="path"),
+        lambda: layer.remove([0]),
+        lambda: layer._data_view.shift(1, np.array([1.0, 2.0])),
+    ):
+        prev = shapes_data(layer)
+        change()
+        manager.add_command_to_undo_stack(
+            infer_shapes_command(layer, prev, shapes_data(layer))
+        )
+    manager.undo()
+    manager.journal.close()
+
+    undo_stack, redo_stack = read_journal(path, layer)
+    for loaded, cmd in zip(
+        undo_stack + redo_stack, manager.undo_stack + manager.redo_stack
+    ):
+        assert type(loaded) is type(cmd)
+        assert loaded == cmd
+    assert undo_stack[0].shape_types == ["path"]
+
+
+def test_journal_rebuilds_columns(tmp_path):
+    path = str(tmp_path / "columns.journal")
+    layer = Points(np.zeros((3, 2)), features={"name": ["a", "b", "c"]})
+    manager = CommandManager(layer)
+    manager.load_journal(path)
+    prev = read_columns(layer)
+    features = layer.features.copy()
+    features.loc[1, "name"] = "z"
+    layer.features = features
+    layer.size = [1, 2, 3]
+    cmd = infer_columns_command(layer, prev, read_columns(layer))
+    manager.add_command_to_undo_stack(cmd)
+    manager.journal.close()
+
+    (loaded,), _ = read_journal(path, layer)
+    assert loaded == cmd
+    loaded.undo()
+    assert layer.features["name"].tolist() == ["a", "b", "c"]
+
+
+def test_journal_ignores_truncated_record(tmp_path):
+    path = str(tmp_path / "labels.journal")
+    layer = Labels(np.zeros((8, 8), dtype=np.uint8))
+    manager = CommandManager(layer)
+    manager.load_journal(path)
+    for value in (1, 2):
+        indices = np.arange(value * 10)
+        _edit(
+            manager,
+            PaintCommand(layer, indices, layer.data.flat[indices], [value]),
+        )
+    manager.journal.close()
+
+    # crash in the middle of writing the last record
+    with open(path, "r+b") as file:
+        file.truncate(file.seek(0, 2) - 3)
+    undo_stack, _ = read_journal(path, layer)
+    assert len(undo_stack) == 1
+    assert undo_stack[0] == manager.undo_stack[0]
+
+
+def test_journal_of_other_data_is_not_loaded(tmp_path):
+    path = str(tmp_path / "Points.journal")
+    layer = Points(np.zeros((3, 2)))
+    manager = CommandManager(layer)
+    manager.load_journal(path)
+    _edit(manager, DeleteCommand(layer, [0], layer.data[[0]]))
+    manager.close_journal()
+    size = os.path.getsize(path)
+
+    # another layer with the same name, or the same rows with other values
+    for data in (np.ones((100, 2)), np.ones((2, 2))):
+        other = CommandManager(Points(data))
+        other.load_journal(path)
+        assert not other.undo_stack
+        assert other.journal is None
+    assert os.path.getsize(path) == size
+
+    # the data the journal ends with
+    reloaded = CommandManager(Points(layer.data.copy()))
+    reloaded.load_journal(path)
+    assert len(reloaded.undo_stack) == 1
+
+    # after a crash, only the rows are known since the last signature
+    _edit(reloaded, AddCommand(reloaded.layer, [0, 1], np.ones((2, 2))))
+    reloaded.journal.close()
+    crashed = CommandManager(Points(np.ones((100, 2))))
+    crashed.load_journal(path)
+    assert crashed.journal is None
+    crashed = CommandManager(Points(np.ones((4, 2))))
+    crashed.load_journal(path)
+    assert len(crashed.undo_stack) == 2
+    crashed.close_journal()
@@ -0,0 +1,46 @@
+import pytest
+
+from napari_undo_redo.metrics import Histogram, Metrics
+
+
+def test_disabled_metrics_record_nothing():
+    metrics = Metrics()
+    with metrics.timer("undo"):
+        pass
+    metrics.timed("redo")(lambda: None)()
+    metrics.count("data")
+
+    assert metrics.snapshot() == {"latency": {}, "events": {}}
+
+
+def test_enabled_metrics_record_latencies_and_events():
+    metrics = Metrics()
+    metrics.enable()
+    for _ in range(3):
+        with metrics.timer("undo"):
+            pass
+    assert metrics.timed("redo")(lambda x: x + 1)(1) == 2
+    metrics.count("data", 2)
+
+    snapshot = metrics.snapshot()
+    assert snapshot["latency"]["undo"]["count"] == 3
+    assert snapshot["latency"]["redo"]["count"] == 1
+    assert snapshot["events"] == {"data": 2}
+
+    metrics.reset()
+    assert metrics.snapshot() == {"latency": {}, "events": {}}
+
+
+def test_histogram_percentiles_are_bucket_bounds():
+    histogram = Histogram()
+    for seconds in [1e-4] * 90 + [0.5] * 10:
+        histogram.add(seconds)
+
+    summary = histogram.summary()
+    assert summary["count"] == 100
+    assert summary["max_s"] == 0.5
+    # 1e-4 is in the bucket (64 µs, 128 µs]
+    assert summary["p50_s"] == pytest.approx(128e-6)
+    assert summary["p90_s"] == pytest.approx(128e-6)
+    assert summary["p99_s"] == 0.5
+    assert sum(n for _, n in summary["buckets"]) == 100
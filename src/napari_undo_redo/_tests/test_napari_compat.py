@@ -0,0 +1,71 @@
+import numpy as np
+from napari.layers import Labels, Shapes
+
+from napari_undo_redo._napari_compat import (
+    append_shapes,
+    edit_shapes,
+    insert_feature_rows,
+    labels_setitem,
+    new_shape,
+    pop_shapes,
+    shape_vertices,
+)
+
+
+def _square(x):
+    return np.array([[x, x], [x, x + 5], [x + 5, x + 5], [x + 5, x]], float)
+
+
+def test_shapes_are_edited_one_by_one():
+    layer = Shapes([_square(0), _square(10)], z_index=[1, 0])
+    edit_shapes(layer, [1], [_square(20)], ["polygon"])
+
+    np.testing.assert_array_equal(shape_vertices(layer, 0), _square(0))
+    np.testing.assert_array_equal(shape_vertices(layer, 1), _square(20))
+    assert layer.shape_type == ["rectangle", "polygon"]
+
+
+def test_shapes_are_inserted_without_building_the_others():
+    layer = Shapes(
+        [_square(10 * i) for i in range(3)],
+        face_color=["red", "green", "blue"],
+        z_index=[2, 1, 0],
+        features={"id": [0, 1, 2]},
+    )
+    shapes, face_colors, edge_colors = pop_shapes(layer, 1)
+    assert layer.nshapes == 1
+    assert len(shapes) == len(face_colors) == len(edge_colors) == 2
+
+    shape = new_shape(layer, _square(50), "rectangle", 3, z_index=5)
+    append_shapes(
+        layer,
+        [shape, *shapes],
+        [np.array([1, 1, 1, 1]), *face_colors],
+        [np.array([0, 0, 0, 1]), *edge_colors],
+    )
+    insert_feature_rows(layer, np.array([1]))
+
+    assert layer.nshapes == 4
+    assert layer._data_view.shapes[2] is shapes[0]
+    assert layer.z_index == [2, 5, 1, 0]
+    assert layer.edge_width[1] == 3
+    np.testing.assert_array_equal(layer.face_color[1], [1, 1, 1, 1])
+    np.testing.assert_array_equal(layer.face_color[3], [0, 0, 1, 1])
+    np.testing.assert_array_equal(layer.features["id"][[0, 2, 3]], [0, 1, 2])
+    assert len(layer.features) == 4
+
+
+def test_labels_writes_are_not_in_the_labels_history():
+    layer = Labels(np.zeros((10, 10), dtype=np.int32))
+    layer.paint((2, 2), 1)
+    layer.paint((7, 7), 2)
+    layer.undo()
+    painted = []
+    layer.events.paint.connect(painted.append)
+
+    labels_setitem(layer, (np.array([0, 1]), np.array([0, 1])), 5)
+    assert layer.data[0, 0] == layer.data[1, 1] == 5
+    assert not painted
+    assert len(layer._undo_history) == 1
+    layer.redo()
+    assert layer.data[7, 7] == 2
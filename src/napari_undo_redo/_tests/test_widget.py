@@ -1,34 +1,362 @@
 import numpy as np
-from napari_undo_redo import ExampleQWidget, example_magic_widget
+import pytest
+from napari.components import ViewerModel
+
+from napari_undo_redo._widget import UndoRedoWidget
+from napari_undo_redo.command import AddCommand, DeleteCommand
+from napari_undo_redo.metrics import metrics
 
 
 # make_napari_viewer is a pytest fixture that returns a napari viewer object
-# capsys is a pytest fixture that captures stdout and stderr output streams
-def test_example_q_widget(make_napari_viewer, capsys):
-    # make viewer and add an image layer using our fixture
+def test_points_edits_are_undone_and_redone(make_napari_viewer):
+    viewer = make_napari_viewer()
+    layer = viewer.add_points(np.array([[1.0, 1.0], [2.0, 2.0]]))
+    widget = UndoRedoWidget(viewer, layer)
+
+    layer.add([3.0, 3.0])
+    layer.selected_data = {0}
+    layer.remove_selected()
+    np.testing.assert_array_equal(layer.data, [[2, 2], [3, 3]])
+
+    widget.undo()
+    np.testing.assert_array_equal(layer.data, [[1, 1], [2, 2], [3, 3]])
+    widget.undo()
+    np.testing.assert_array_equal(layer.data, [[1, 1], [2, 2]])
+    widget.redo()
+    widget.redo()
+    np.testing.assert_array_equal(layer.data, [[2, 2], [3, 3]])
+
+
+def test_points_edits_update_the_tracked_data(qtbot):
+    viewer = ViewerModel()
+    widget, layer = _points_widget(viewer)
+
+    layer.add([3.0, 3.0])
+    data = layer.data.copy()
+    data[1] += 1
+    layer.data = data
+    layer.selected_data = {0}
+    layer.remove_selected()
+    np.testing.assert_array_equal(widget._last_data, layer.data)
+    assert widget._last_data is not layer.data
+
+    # a no op saves nothing
+    layer.data = layer.data
+    widget.undo()
+    np.testing.assert_array_equal(layer.data, [[0, 0], [2, 2], [3, 3]])
+    np.testing.assert_array_equal(widget._last_data, layer.data)
+
+
+def test_point_sizes_are_undone(make_napari_viewer):
+    viewer = make_napari_viewer()
+    layer = viewer.add_points(np.array([[1.0, 1.0], [2.0, 2.0]]), size=1)
+    widget = UndoRedoWidget(viewer, layer)
+
+    # like the size slider of the layer controls
+    layer.selected_data = {1}
+    layer.current_size = 5
+    widget.undo()
+    np.testing.assert_array_equal(layer.size, [1, 1])
+    widget.redo()
+    np.testing.assert_array_equal(layer.size, [1, 5])
+
+
+def test_shapes_edits_are_undone(make_napari_viewer):
+    viewer = make_napari_viewer()
+    square = np.array([[0, 0], [0, 5], [5, 5], [5, 0]], dtype=float)
+    layer = viewer.add_shapes([square, square + 10])
+    widget = UndoRedoWidget(viewer, layer)
+
+    layer.selected_data = {1}
+    layer.remove_selected()
+    assert len(layer.data) == 1
+
+    widget.undo()
+    assert len(layer.data) == 2
+    np.testing.assert_array_equal(layer.data[1], square + 10)
+
+
+def test_labels_paint_is_undone(make_napari_viewer):
     viewer = make_napari_viewer()
-    viewer.add_image(np.random.random((100, 100)))
+    layer = viewer.add_labels(np.zeros((10, 10), dtype=np.int32))
+    widget = UndoRedoWidget(viewer, layer)
+
+    layer.paint((5, 5), 3)
+    assert layer.data.any()
+
+    widget.undo()
+    assert not layer.data.any()
+    widget.redo()
+    assert layer.data.any()
+
 
-    # create our widget, passing in the viewer
-    my_widget = ExampleQWidget(viewer)
+def test_labels_data_replacement_drops_the_paint_history(qtbot):
+    viewer = ViewerModel()
+    layer = viewer.add_labels(np.zeros((10, 10), dtype=np.int32))
+    widget = UndoRedoWidget(viewer, layer)
+    layer.paint((5, 5), 3)
+    # napari's own labels history only holds the stroke
+    assert len(layer._undo_history) == 1
+    widget.undo()
+    widget.redo()
+    assert len(layer._undo_history) == 1
 
-    # call our widget method
-    my_widget._on_click()
+    layer.data = np.ones((10, 10), dtype=np.int32)
+    widget.undo()
+    np.testing.assert_array_equal(layer.data, 1)
+    assert widget.history_position() == (0, 0)
 
-    # read captured output and check that it's as we expected
-    captured = capsys.readouterr()
-    assert captured.out == "napari has 1 layers\n"
 
-def test_example_magic_widget(make_napari_viewer, capsys):
+def test_stats_report_latencies_and_history_bytes(make_napari_viewer):
     viewer = make_napari_viewer()
-    layer = viewer.add_image(np.random.random((100, 100)))
+    layer = viewer.add_points(np.array([[1.0, 1.0]]))
+    widget = UndoRedoWidget(viewer, layer)
+
+    metrics.enable()
+    try:
+        layer.add([3.0, 3.0])
+        widget.undo()
+        stats = widget.stats()
+        widget.update_stats()
+    finally:
+        metrics.disable()
+        metrics.reset()
+
+    assert stats["latency"]["capture"]["count"] >= 1
+    assert stats["latency"]["undo"]["count"] == 1
+    assert stats["events"]["data"] >= 1
+    assert stats["layer_bytes"] == {layer.name: stats["history_bytes"]}
+    assert stats["history_bytes"] > 0
+    assert "undo" in widget.stats_label.text()
+
+
+def test_replayed_commands_are_undone_one_at_a_time(make_napari_viewer):
+    viewer = make_napari_viewer()
+    data = np.array([[1.0, 1.0], [2.0, 2.0]])
+    layer = viewer.add_points(data)
+    widget = UndoRedoWidget(viewer, layer)
+    commands = [
+        AddCommand(None, [2], np.array([[3.0, 3.0]])),
+        DeleteCommand(None, [0], data[[0]]),
+    ]
+
+    widget.replay(commands)
+    np.testing.assert_array_equal(layer.data, [[2, 2], [3, 3]])
+
+    widget.undo()
+    np.testing.assert_array_equal(layer.data, [[1, 1], [2, 2], [3, 3]])
+    widget.undo()
+    np.testing.assert_array_equal(layer.data, data)
+
+
+def test_timeline_renders_only_the_last_position(make_napari_viewer):
+    viewer = make_napari_viewer()
+    layer = viewer.add_points(np.array([[0.0, 0.0]]))
+    widget = UndoRedoWidget(viewer, layer)
+    for i in range(1, 6):
+        layer.add([i, i])
+    widget.update_timeline()
+    assert widget.timeline.maximum() == 5
+
+    updates = []
+    layer.events.data.connect(
+        lambda event: (
+            updates.append(event) if event.action == "changed" else None
+        )
+    )
+    # dragged through several positions before the next frame
+    for position in (4, 3, 2):
+        widget.timeline.setValue(position)
+    widget.timeline.sliderReleased.emit()
+    assert len(layer.data) == 3
+    assert len(updates) == 1
+
+    widget.undo()
+    widget.update_timeline()
+    assert widget.timeline.value() == 1
+
+
+def test_timeline_of_image_states(qtbot):
+    # the widget only uses the layer list, no canvas is needed
+    viewer = ViewerModel()
+    layer = viewer.add_image(np.zeros((8, 8)))
+    widget = UndoRedoWidget(viewer, layer)
+    for value in range(1, 5):
+        layer.data = np.full((8, 8), float(value))
+    assert widget.history_position() == (4, 4)
+
+    widget.go_to(1)
+    assert layer.data[0, 0] == 1
+    widget.redo()
+    assert layer.data[0, 0] == 2
+    widget.go_to(10)
+    assert layer.data[0, 0] == 4
+
+
+def test_long_jump_is_a_single_layer_write(qtbot):
+    viewer = ViewerModel()
+    widget, points = _points_widget(viewer)
+    for i in range(2, 12):
+        points.add([i, i])
+    labels = viewer.add_labels(np.zeros((10, 10), dtype=np.int32))
+    viewer.layers.selection.active = labels
+    for i in range(10):
+        labels.paint((i, i), i + 1)
+
+    writes = []
+    points.events.data.connect(
+        lambda event: (
+            writes.append(event.action)
+            if event.action in ("added", "removed", "changed")
+            else None
+        )
+    )
+    labels.events.labels_update.connect(writes.append)
+    widget.go_to(0)
+    assert not labels.data.any()
+    assert len(writes) == 1
+    viewer.layers.selection.active = points
+    widget.go_to(0)
+    assert len(points.data) == 2
+    assert len(writes) == 2
+
+
+def test_image_edited_in_place_and_reassigned_is_saved(qtbot):
+    viewer = ViewerModel()
+    layer = viewer.add_image(np.zeros((20, 20)))
+    widget = UndoRedoWidget(viewer, layer)
+    layer.data[:10] = 5
+    layer.data = layer.data
+    layer.data[10:] = 1
+    layer.data = layer.data
+    assert widget.savedStates == 3
+
+    widget.undo()
+    assert layer.data.sum() == 5 * 200
+    widget.undo()
+    assert layer.data.sum() == 0
+    widget.redo()
+    widget.redo()
+    assert layer.data.sum() == 5 * 200 + 200
+
+
+def test_undo_tree_of_image_states(qtbot):
+    viewer = ViewerModel()
+    layer = viewer.add_image(np.zeros((8, 8)))
+    widget = UndoRedoWidget(viewer, layer, undo_tree=True)
+    layer.data = np.ones((8, 8))
+    widget.undo()
+    layer.data = np.full((8, 8), 2.0)
+
+    (branch,) = widget.branches()
+    widget.switch_branch(branch)
+    assert layer.data[0, 0] == 1
+    (branch,) = widget.branches()
+    widget.switch_branch(branch)
+    assert layer.data[0, 0] == 2
+    widget.undo()
+    assert layer.data[0, 0] == 0
+
+
+def _points_widget(viewer, **kwargs):
+    layer = viewer.add_points(np.array([[0.0, 0.0], [1.0, 1.0]]))
+    widget = UndoRedoWidget(viewer, layer, **kwargs)
+    return widget, layer
+
+
+class _MouseEvent:
+    def __init__(self, type):
+        self.type = type
+
+
+def _drag(widget, layer, positions):
+    """
+    drag the first point through `positions`, like the mouse would
+    """
+    event = _MouseEvent("mouse_press")
+    drag = widget._on_mouse_drag(layer, event)
+    next(drag)
+    event.type = "mouse_move"
+    for position in positions:
+        data = layer.data.copy()
+        data[0] = position
+        layer.data = data
+        next(drag)
+    event.type = "mouse_release"
+    with pytest.raises(StopIteration):
+        next(drag)
+
+
+def test_drag_is_one_undo_step(qtbot):
+    viewer = ViewerModel()
+    widget, layer = _points_widget(viewer)
+    original = layer.data.copy()
+
+    _drag(widget, layer, range(1, 6))
+    assert len(widget.get_command_manager(layer).undo_stack) == 1
+    widget.undo()
+    np.testing.assert_array_equal(layer.data, original)
+
+
+def test_separate_edits_are_separate_undo_steps(qtbot):
+    viewer = ViewerModel()
+    widget, layer = _points_widget(viewer)
+    manager = widget.get_command_manager(layer)
+
+    for i in range(2, 5):
+        layer.add([i, i])
+    assert len(manager.undo_stack) == 3
+    # two drags of the same point
+    _drag(widget, layer, [5, 6])
+    _drag(widget, layer, [7, 8])
+    assert len(manager.undo_stack) == 5
+
+    widget.undo()
+    np.testing.assert_array_equal(layer.data[0], [6, 6])
+    widget.undo()
+    np.testing.assert_array_equal(layer.data[0], [0, 0])
+    widget.undo()
+    assert len(layer.data) == 4
+
+
+def test_events_within_the_window_are_one_undo_step(qtbot):
+    viewer = ViewerModel()
+    widget, layer = _points_widget(viewer, coalesce_ms=50)
+    manager = widget.get_command_manager(layer)
+
+    layer.add([2.0, 2.0])
+    layer.add([3.0, 3.0])
+    assert len(manager.undo_stack) == 0
+    qtbot.wait(200)
+    assert len(manager.undo_stack) == 1
+
+    widget.undo()
+    assert len(layer.data) == 2
+
+
+def test_undo_saves_the_pending_edit_first(qtbot):
+    viewer = ViewerModel()
+    widget, layer = _points_widget(viewer, coalesce_ms=10_000)
+
+    layer.add([2.0, 2.0])
+    widget.undo()
+    assert len(layer.data) == 2
+    widget.redo()
+    assert len(layer.data) == 3
+
 
-    # this time, our widget will be a MagicFactory or FunctionGui instance
-    my_widget = example_magic_widget()
+def test_pending_edit_is_saved_when_switching_layers(qtbot):
+    viewer = ViewerModel()
+    widget, first = _points_widget(viewer, coalesce_ms=10_000)
+    second = viewer.add_points(np.zeros((1, 2)))
 
-    # if we "call" this object, it'll execute our function
-    my_widget(viewer.layers[0])
+    viewer.layers.selection.active = first
+    first.add([2.0, 2.0])
+    viewer.layers.selection.active = second
+    assert widget.layer is second
+    assert len(widget.get_command_manager(first).undo_stack) == 1
 
-    # read captured output and check that it's as we expected
-    captured = capsys.readouterr()
-    assert captured.out == f"you have selected {layer}\n"
+    viewer.layers.selection.active = first
+    widget.undo()
+    assert len(first.data) == 2
+    assert len(second.data) == 1
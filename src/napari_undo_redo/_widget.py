@@ -7,41 +7,167 @@ BUGS:
     'inserted'.
 """
 
+import time
 import warnings
-from pprint import pprint
-from typing import Dict, Optional
+import weakref
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Sequence, Tuple
 
 import napari
 import numpy as np
-from napari.layers import Layer
+from napari.layers import Labels, Layer, Points, Shapes
 from napari.utils.events import Event
 from napari.viewer import Viewer
 from qtpy import QtWidgets
+from qtpy.QtCore import Qt, QTimer
 
 from ._my_logger import logger
-from .command import CommandManager
+from .capture import CaptureQueue
+from .caretaker import CareTaker
+from .command import (
+    CommandManager,
+    HistoryRegistry,
+    PaintCommand,
+    infer_columns_command,
+    infer_command,
+    infer_shapes_command,
+    replay,
+    shapes_data,
+)
+from .command.base import Command
+from .command.columns import (
+    FEATURES_PREFIX,
+    column_names,
+    property_events,
+    read_columns,
+)
+from .compress import Codec
+from .delta import LayerData
+from .eviction import EvictionPolicy
+from .fingerprint import ChangeDetector
+from .layer_types import layer_type
+from .metrics import format_stats, metrics
+from .originator import Originator
+from .state import State
+from .tree import Branch
+
+# layers whose history is kept as commands instead of states
+COMMAND_LAYER_TYPES = (Points, Shapes, Labels)
+# the timeline renders at most one position per frame while dragged
+TIMELINE_FRAME_MS = 30
 
 
 class UndoRedoWidget(QtWidgets.QWidget):
-    def __init__(self, viewer: Viewer, layer: Optional[Layer] = None) -> None:
+    def __init__(
+        self,
+        viewer: Viewer,
+        layer: Optional[Layer] = None,
+        max_history_bytes: Optional[int] = None,
+        max_history_steps: Optional[int] = None,
+        eviction_policy: Optional[EvictionPolicy] = None,
+        hot_history_steps: Optional[int] = None,
+        spill_directory: Optional[str] = None,
+        coalesce_ms: Optional[int] = None,
+        global_undo: bool = False,
+        journal_directory: Optional[str] = None,
+        capture_workers: int = 0,
+        compression: Optional[Codec] = None,
+        undo_tree: bool = False,
+    ) -> None:
+        """
+        Args:
+            viewer: napari viewer
+            layer: layer to connect to, defaults to the active layer
+            max_history_bytes: memory budget of the history, in bytes
+            max_history_steps: maximum number of states kept in the history
+            eviction_policy: how old states are removed when over budget
+            hot_history_steps: number of recent steps kept in memory,
+                older ones are spilled to disk
+            spill_directory: where the spilled steps are written
+            coalesce_ms: data events closer than this many milliseconds
+                are saved as a single state, None saves them immediately.
+                Events during a mouse drag are always saved as one state
+                when the mouse is released.
+            global_undo: undo/redo the edits of all the Points, Shapes and
+                Labels layers in the order they were made, instead of only
+                the edits of the selected layer
+            journal_directory: where the history of the Points, Shapes and
+                Labels layers is logged, to be reloaded after a crash
+            capture_workers: number of background threads storing the
+                states of Image layers, 0 stores them on the GUI thread
+            compression: Codec compressing the history in memory,
+                eg: Codec("zlib"), None keeps it raw
+            undo_tree: keep what could be redone as a branch when a new
+                edit is made after an undo, see switch_branch
+        """
         super().__init__()
 
         warnings.filterwarnings(action="ignore", category=FutureWarning)
 
         self.viewer = viewer
         self.layer = None
-        self.command_managers: Dict[int:CommandManager] = {}
-        # self.originator = Originator()
-        # self.caretaker = CareTaker()
-        # self.savedStates = 0
-        # self.currentStateIdx = -1
+        # command history of every Points, Shapes and Labels layer
+        self.histories = HistoryRegistry(
+            max_bytes=max_history_bytes,
+            max_steps=max_history_steps,
+            global_timeline=global_undo,
+            journal_directory=journal_directory,
+            compression=compression,
+            undo_tree=undo_tree,
+        )
+        self.max_history_bytes = max_history_bytes
+        self.max_history_steps = max_history_steps
+        self.originator = Originator()
+        self.caretaker = CareTaker(
+            max_bytes=max_history_bytes,
+            max_steps=max_history_steps,
+            eviction_policy=eviction_policy,
+            hot_steps=hot_history_steps,
+            spill_directory=spill_directory,
+            compression=compression,
+            undo_tree=undo_tree,
+        )
+        self.savedStates = 0
+        self.currentStateIdx = -1
+        # False after undo, until the next state is saved
+        self._at_tip = True
+        # stores the states, see _store_state
+        self.capture = CaptureQueue(workers=capture_workers)
+        # fingerprint of the state at currentStateIdx
+        self.change_detector = ChangeDetector()
+        # copy of the points (or ShapesData) of the connected layer after its
+        # last command, diffed with the new data to infer the next command
+        self._last_data = None
+        # copy of its per-row properties and features, see command.columns
+        self._last_columns: Optional[dict] = None
+        # True while undo/redo writes to the layer,
+        # so that the resulting data events are not saved as new states
+        self._restoring = False
+
+        # coalescing of continuous edits, see on_data_event
+        self.coalesce_ms = coalesce_ms
+        self._dragging = False
+        # True inside transaction()
+        self._in_transaction = False
+        # layer with data events waiting to be saved as one state
+        self._pending_layer: Optional[Layer] = None
+        # shapes edited by the coalesced events, None if not known
+        self._pending_rows: Optional[set] = None
+        self._coalesce_timer = QTimer(self)
+        self._coalesce_timer.setSingleShot(True)
+        self._coalesce_timer.timeout.connect(self.flush_pending)
+        # layer and time of the last command pushed during the current
+        # interaction, see _push
+        self._last_push: Optional[Tuple[weakref.ref, float]] = None
+
+        # position the timeline was dragged to, see _seek_timeline
+        self._timeline_target: Optional[int] = None
 
         self.configure_gui()
 
         if layer:
-            print("inside if")
             self.layer = layer
-            self.command_managers[id(self.layer)] = CommandManager(layer)
+            self.get_command_manager(self.layer)
             self.connect_layer(self.layer)
 
             # when the widget is initalized,
@@ -51,10 +177,8 @@ class UndoRedoWidget(QtWidgets.QWidget):
             event._push_source(self.layer)  # _push_source sets event.source
             self.save_state(event)
         else:
-            print("inside else")
             active_layer = self.find_active_layers()
             if active_layer:
-                print("inside else if")
                 self.layer = active_layer
                 self.connect_layer(self.layer)
                 event = Event("init")
@@ -72,6 +196,7 @@ class UndoRedoWidget(QtWidgets.QWidget):
 
     # actual undo functionality:
 
+    @metrics.timed("capture")
     def save_state(self, event: Event) -> None:
         """
         Save the current state of the napari layer.
@@ -87,128 +212,773 @@ class UndoRedoWidget(QtWidgets.QWidget):
         3. Ask the caretaker to store this State in its list of states
         4. Increment the number of savedStates by 1
         5. Increment current state Idx to make it point to most recent state
+
+        If some states were undone before this change, they are dropped
+        from the caretaker first, since they cannot be redone anymore.
+
+        With capture_workers, only step 1 (copying the layer data) is done
+        here, the change check and steps 2 to 5 run in the background,
+        see _store_state.
+
+        Points and Shapes layers don't store states, the change is saved as
+        a command instead, see save_command.
         """
         if event.type != "init" and not event.source:
             # ignore event without source
             return
 
-        if not self._has_state_changed(event):
+        if self._restoring:
+            # ignore our own undo/redo
+            return
+
+        if layer_type(event.source) is None:
+            # no history for this layer type yet
+            return
+
+        if isinstance(event.source, Labels):
+            # labels history is kept as paint commands, see save_paint.
+            # Like napari's own labels history, they are dropped when the
+            # data is replaced: they can't be applied to the new data
+            if event.type != "init":
+                self.histories.clear(event.source)
+            return
+
+        layer = event.source
+        if isinstance(layer, Shapes):
+            # only the shapes listed by a "changed" event may have changed
+            rows = None
+            if getattr(event, "action", None) == "changed":
+                rows = getattr(event, "data_indices", None)
+            self.save_command(layer, init=event.type == "init", changed=rows)
+            return
+
+        if isinstance(layer, Points):
+            # a no op infers no command, no change check is needed
+            self.save_command(layer, init=event.type == "init")
+            return
+
+        # with capture_workers, a new array is compared in the background
+        checked = not self.capture.is_async
+        if not self._has_state_changed(event, full=checked):
             # this check is important because
             # there's no need to save state if no change has occured
             return
 
-        print("save_state")
-        pprint(event)
-        layer = event.source
-        # command_manager = self.command_managers.get(id(layer))
-        # command_manager.add_command_to_undo_stack()
-        print(f"layer: {layer}")
-        print(f"type(layer): {type(layer)}")
+        logger.debug(f"save_state of {layer}")
         self.originator.set_layer(layer)
+        # the only copy of the data, the layer may be edited in place next
         state = self.originator.store_in_state()
+        # the states that could be redone are dropped, unless it was
+        # done already by a state saved since the last undo
+        keep = None if self._at_tip else self.currentStateIdx + 1
+        self._at_tip = True
+        self.capture.submit(
+            self._store_state,
+            state,
+            keep,
+            checked or event.type == "init",
+            state.data if self.capture.is_async else layer.data,
+            getattr(event, "data_indices", None),
+        )
+        if not self.capture.is_async:
+            self._sync_states()
+        logger.debug(f"currentStateIdx: {self.currentStateIdx}")
+
+    @metrics.timed("store")
+    def _store_state(
+        self,
+        state: State,
+        keep: Optional[int],
+        changed: bool,
+        data: LayerData,
+        rows: Optional[Sequence[int]] = None,
+    ) -> None:
+        """
+        Add a state to the caretaker, on a capture thread
+        or right away, see CaptureQueue.
+
+        Args:
+            state: State copied from the layer
+            keep: number of states kept before adding it, None keeps all
+            changed: False if the state still has to be compared to the
+                last saved one
+            data: what the change detector fingerprints, the layer data
+                itself on the GUI thread, which lets data_indices hints
+                check only the edited rows of in-place edits
+            rows: rows named by the event, only their blocks are
+                fingerprinted again if `data` was edited in place
+        """
+        if not changed and not self.change_detector.has_changed(state.data):
+            return
+        if keep is not None:
+            # dropped, or kept as a branch with undo_tree
+            self.caretaker.branch(keep)
         self.caretaker.add_state(state)
-        self.savedStates += 1
-        self.currentStateIdx += 1
-        print(f"currentStateIdx: {self.currentStateIdx}")
+        self.change_detector.reset(data, rows)
+
+    def _sync_states(self) -> None:
+        """
+        wait for the states still being stored and update the indices,
+        older states may have been evicted meanwhile
+        """
+        self.capture.wait()
+        self.savedStates = len(self.caretaker)
+        if self._at_tip:
+            # the new state is the most recent one, even if older states
+            # were evicted to stay within the history budget
+            self.currentStateIdx = self.savedStates - 1
 
-    def _has_state_changed(self, event: Event) -> bool:
+    def save_command(
+        self,
+        layer: Layer,
+        init: bool = False,
+        changed: Optional[tuple] = None,
+    ) -> None:
+        """
+        Save the change of a Points or Shapes layer as the command that
+        replays it, inferred by diffing the data before and after the change.
+        The history then only holds the points or shapes that were edited.
+
+        Args:
+            layer: napari Points or Shapes layer that changed
+            init: only remember the current data, without saving a command
+            changed: indices of the only shapes that may have changed
+        """
+        if init or self._last_data is None:
+            self._track_data(layer)
+            return
+        if isinstance(layer, Shapes):
+            with metrics.timer("diff"):
+                cmd = infer_shapes_command(
+                    layer,
+                    self._last_data,
+                    shapes_data(layer, copy=False),
+                    changed,
+                )
+            if cmd is not None:
+                self._capture_columns(layer, cmd)
+                self._push(layer, cmd)
+                # only the edited shapes are copied, not the whole layer
+                self._last_data = cmd.redo_data(self._last_data)
+            return
+        with metrics.timer("diff"):
+            cmd = infer_command(layer, self._last_data, layer.data)
+        if cmd is None:
+            return
+        # only the edited points are copied, before push may compress them
+        last = cmd.redo_data(self._last_data)
+        if last.shape != layer.data.shape or last.dtype != layer.data.dtype:
+            # the whole data was replaced, eg: with another dtype
+            last = np.array(layer.data)
+        self._last_data = last
+        self._capture_columns(layer, cmd)
+        self._push(layer, cmd)
+
+    def _push(self, layer: Layer, cmd: Command) -> None:
+        """
+        push a command to the history of its layer. It is only merged into
+        the previous command of the layer if both are part of the same
+        interaction: a mouse drag, a transaction, or edits closer than
+        `coalesce_ms` milliseconds. Separate clicks stay separate steps.
+        """
+        now = time.monotonic()
+        merge = False
+        if self._last_push is not None:
+            last_layer, last_time = self._last_push
+            merge = last_layer() is layer and (
+                self._dragging
+                or self._in_transaction
+                or (
+                    self.coalesce_ms is not None
+                    and (now - last_time) * 1000 < self.coalesce_ms
+                )
+            )
+        self._last_push = (weakref.ref(layer), now)
+        self.histories.push(layer, cmd, merge=merge)
+
+    def _capture_columns(self, layer: Layer, cmd: Command) -> None:
+        """
+        keep the properties and features of the rows added or deleted by
+        a command in the command itself, so that undo/redo restores them
+        together with the rows
+        """
+        if self._last_columns is None:
+            return
+        new = read_columns(layer, list(self._last_columns), copy=False)
+        cmd.capture_columns(self._last_columns, new)
+        self._last_columns = cmd.redo_columns(self._last_columns)
+        if any(
+            len(values) != len(new[name])
+            for name, values in self._last_columns.items()
+            if name in new
+        ):
+            # out of sync, eg: columns edited without any event
+            self._last_columns = read_columns(layer)
+
+    @metrics.timed("capture")
+    def save_properties(self, event: Event) -> None:
+        """
+        Save an edit of the per-row properties (size, colors, ...) or of
+        the features of the connected Points or Shapes layer as
+        a ColumnsCommand, which only holds the rows and columns that changed.
+
+        Args:
+            event: property or features event of the layer
+        """
+        metrics.count(event.type)
+        layer = event.source
+        if self._restoring or layer is not self.layer:
+            return
+        if self._last_columns is None:
+            return
+        new = read_columns(layer, column_names(layer, event.type), copy=False)
+        # rows added or deleted but not saved yet (eg: during a drag)
+        # are skipped, save_command keeps their columns
+        with metrics.timer("diff"):
+            cmd = infer_columns_command(layer, self._last_columns, new)
+        if cmd is not None:
+            self._push(layer, cmd)
+            self._last_columns = cmd.redo_columns(self._last_columns)
+        if event.type == "features":
+            # columns added to or removed from the features table
+            for name in list(self._last_columns):
+                if name.startswith(FEATURES_PREFIX) and name not in new:
+                    del self._last_columns[name]
+            for name, values in new.items():
+                if name not in self._last_columns:
+                    self._last_columns[name] = np.array(values)
+
+    def _track_data(self, layer: Layer, columns: bool = True) -> None:
+        """
+        remember the current data of a command based layer
+
+        Args:
+            layer: layer to track
+            columns: also copy its properties and features
+        """
+        if isinstance(layer, Points):
+            self._last_data = np.array(layer.data)
+        elif isinstance(layer, Shapes):
+            self._last_data = shapes_data(layer)
+        if columns and isinstance(layer, (Points, Shapes)):
+            self._last_columns = read_columns(layer)
+
+    def on_data_event(self, event: Event) -> None:
+        """
+        Respond to a data event of the connected layer.
+
+        Continuous edits (eg: dragging points) emit a data event for every
+        mouse move. Instead of saving a state for each of them, the events
+        are coalesced: the state is saved once when the mouse is released,
+        or once no new event came for `coalesce_ms` milliseconds.
+
+        Args:
+            event: data event of the layer
+        """
+        metrics.count("data")
+        if self._restoring or getattr(event, "action", None) in (
+            "adding",
+            "removing",
+            "changing",
+        ):
+            # ignore our own undo/redo and the events fired before a change
+            return
+
+        held = self._dragging or self._in_transaction
+        if held or self.coalesce_ms:
+            # the event itself can't be kept, its source is only set
+            # while it is being emitted
+            self._pending_rows = self._merge_rows(event)
+            self._pending_layer = event.source
+            if not held:
+                # restart the time window
+                self._coalesce_timer.start(self.coalesce_ms)
+            return
+
+        self.save_state(event)
+
+    def flush_pending(self) -> None:
+        """
+        Save the state for the coalesced data events, if any.
+        """
+        self._coalesce_timer.stop()
+        layer, self._pending_layer = self._pending_layer, None
+        rows, self._pending_rows = self._pending_rows, None
+        if layer is not None:
+            if rows is None:
+                event = Event("data")
+            else:
+                event = Event(
+                    "data", action="changed", data_indices=tuple(sorted(rows))
+                )
+            event._push_source(layer)
+            self.save_state(event)
+
+    def _merge_rows(self, event: Event) -> Optional[set]:
+        """
+        returns the shapes edited by the coalesced events and this one,
+        None if any of them may have changed other shapes
+        """
+        if getattr(event, "action", None) != "changed":
+            return None
+        rows = getattr(event, "data_indices", None)
+        if rows is None:
+            return None
+        if self._pending_layer is None:
+            return set(rows)
+        if self._pending_rows is None:
+            return None
+        return self._pending_rows | set(rows)
+
+    def _on_mouse_drag(self, layer: Layer, event: Event):
+        """
+        Mouse drag callback of the connected layer,
+        data events are held back until the mouse is released.
+        """
+        self._dragging = True
+        # a drag is a new interaction
+        self._last_push = None
+        try:
+            yield
+            while event.type == "mouse_move":
+                yield
+        finally:
+            self._dragging = False
+            self.flush_pending()
+            self._last_push = None
+
+    @contextmanager
+    def transaction(self, layer: Optional[Layer] = None) -> Iterator[None]:
+        """
+        Make all the edits of a layer inside the `with` block
+        a single undo step, eg: for scripted bulk edits
+
+            with widget.transaction():
+                for point in points:
+                    layer.add(point)
+
+        Data events are held back and saved once when the block exits,
+        commands pushed to the layer's history are grouped
+        in a single CompositeCommand.
+
+        Args:
+            layer: layer being edited, defaults to the connected layer
+        """
+        if layer is None:
+            layer = self.layer
+        if self._in_transaction or layer is None:
+            yield
+            return
+        self._in_transaction = True
+        self._last_push = None
+        try:
+            with self.histories.transaction(layer):
+                try:
+                    yield
+                finally:
+                    self._in_transaction = False
+                    self.flush_pending()
+        finally:
+            self._in_transaction = False
+            self._last_push = None
+
+    @metrics.timed("diff")
+    def _has_state_changed(self, event: Event, full: bool = True) -> bool:
         """
         Checks if the layer's state has changed
 
         Args:
             event: Event
+            full: hash all the data if needed, False only checks the
+                shape, dtype and the rows named by the event
 
         What it's doing:
         0. If its the initial state then return true
         to store the layer's initial state
-        1. Use currentStateIdx to get the last stored
-        state (existing state) from the caretaker
-        2. Use originator to restore layer information
-        from the last stored state
-        3. check if layer information of current event
-        is different from last stored state
-        4. if yes, return true because state has changed
+        1. compare the layer data to the fingerprint of the
+        current state, see ChangeDetector.has_changed
+        2. if they differ, return true because state has changed
+
+        The stored state itself is never rebuilt here.
         """
         if event.type == "init":
             return True
 
-        existing_state = self.caretaker.get_state(self.currentStateIdx)
-        existing_data = self.originator.restore_from_state(existing_state).data
-        print(f"type(existing_data): {type(existing_data)}")
-        changed = not np.array_equal(event.source.data, existing_data)
-        print(f"type(changed): {type(changed)}")
-        print(f"changed: {changed}")
-        return changed
+        # rows touched by the event, if napari tells us
+        rows = getattr(event, "data_indices", None)
+        return self.change_detector.has_changed(
+            event.source.data, rows, full=full
+        )
+
+    @metrics.timed("capture")
+    def save_paint(self, event: Event) -> None:
+        """
+        Save a paint stroke of a Labels layer as a PaintCommand,
+        which only holds the painted voxels.
+
+        Args:
+            event: paint event, event.value is the napari history item
+        """
+        metrics.count("paint")
+        if self._restoring:
+            return
+        cmd = PaintCommand.from_history_item(event.source, event.value)
+        if cmd is not None:
+            self._push(event.source, cmd)
+
+    def replay(
+        self, commands: List[Command], layer: Optional[Layer] = None
+    ) -> None:
+        """
+        Apply recorded Add/Delete/Move commands to a Points layer with
+        a single update, see command.replay. They are added to its history
+        and can be undone one at a time.
+
+        Args:
+            commands: commands in the order they were done,
+                eg: read from the journal of another session
+            layer: Points layer, defaults to the connected layer
+        """
+        if layer is None:
+            layer = self.layer
+        self.flush_pending()
+        self._restoring = True
+        try:
+            with metrics.timer("replay"):
+                replay(commands, layer)
+        finally:
+            self._restoring = False
+        self.histories.extend(layer, commands)
+        if layer is self.layer:
+            self._track_data(layer)
+
+    def get_command_manager(self, layer: Layer) -> CommandManager:
+        """
+        returns the CommandManager of a layer, creating it if needed
+        """
+        return self.histories.get(layer)
 
+    def _run_command(self, layer: Optional[Layer], undo: bool) -> Layer:
+        """
+        undo or redo the last command of the layer's CommandManager,
+        or of any layer with global undo
+
+        Returns:
+            the layer that was changed, None if there was nothing to do
+        """
+        self._restoring = True
+        try:
+            if undo:
+                layer = self.histories.undo(layer)
+            else:
+                layer = self.histories.redo(layer)
+        finally:
+            self._restoring = False
+        if layer is self.layer:
+            self._track_data(layer)
+        return layer
+
+    @metrics.timed("undo")
     def undo(self) -> Layer:
         """
+        For Points, Shapes and Labels layers, undo the last command
+        (of any layer with global undo).
+        Otherwise:
         0. Cannot undo at currentStateIdx 0 since that is the initial state
         1. Decrement the currentStateIdx to the previous index
             (since that state will become the most recent state after undo)
         2. Get the state at that index
-        3. Get the layer at that state
+        3. Restore the active layer to that state
         4. return the layer
         """
+        # commit a pending edit first, so that it is the one undone
+        self.flush_pending()
+        if self.histories.global_timeline:
+            return self._run_command(None, undo=True)
+        active_layer = self.find_active_layers()
+        if isinstance(active_layer, COMMAND_LAYER_TYPES):
+            return self._run_command(active_layer, undo=True)
+
+        self._sync_states()
         if self.currentStateIdx >= 1:
-            self.currentStateIdx -= 1
-            print(f"currentStateIdx: {self.currentStateIdx}")
-            previous_state = self.caretaker.get_state(self.currentStateIdx)
-            layer_at_previous_state = self.originator.restore_from_state(
-                previous_state
-            )
-            self.layer = layer_at_previous_state
-            active_layer = self.find_active_layers()
-            active_layer.data = self.layer.data
-            return layer_at_previous_state
+            return self._restore_state(self.currentStateIdx - 1)
         else:
             # disable the undo button
-            print("undo not allowed")
+            logger.debug("undo not allowed")
             return None
 
+    @metrics.timed("redo")
     def redo(self) -> Layer:
         """
+        For Points, Shapes and Labels layers, redo the last undone command
+        (of any layer with global undo).
+        Otherwise:
         0. Cannot redo if currentStateIdx is at the last index
             -> because we are already at the most recent state
         1. Increment the currentStateIdx to the next index
             (since that state will become the most recent state after redo)
         2. Get the state at that index
-        3. Get the layer at that state
+        3. Restore the active layer to that state
         4. return the layer
         """
+        self.flush_pending()
+        if self.histories.global_timeline:
+            return self._run_command(None, undo=False)
+        active_layer = self.find_active_layers()
+        if isinstance(active_layer, COMMAND_LAYER_TYPES):
+            return self._run_command(active_layer, undo=False)
+
+        self._sync_states()
         if (
             self.savedStates - 1
         ) > self.currentStateIdx:  # revisit this condition to allow redo
-            self.currentStateIdx += 1
-            print(f"currentStateIdx: {self.currentStateIdx}")
-            next_state = self.caretaker.get_state(self.currentStateIdx)
-            layer_at_next_state = self.originator.restore_from_state(
-                next_state
-            )
-            self.layer = layer_at_next_state
-            active_layer = self.find_active_layers()
-            active_layer.data = self.layer.data
-            return layer_at_next_state
+            return self._restore_state(self.currentStateIdx + 1)
         else:
             # disable the redo button
-            print("redo not available")
+            logger.debug("redo not available")
+            return None
+
+    def branches(self) -> List[Branch]:
+        """
+        returns the branches of the history of the active layer, see
+        switch_branch, empty without undo_tree
+        """
+        active_layer = self.find_active_layers()
+        if isinstance(active_layer, COMMAND_LAYER_TYPES):
+            if self.histories.global_timeline:
+                return []
+            return self.get_command_manager(active_layer).branches
+        self._sync_states()
+        return self.caretaker.branches
+
+    @metrics.timed("seek")
+    def switch_branch(
+        self, branch: Branch, steps: Optional[int] = None
+    ) -> Optional[Layer]:
+        """
+        Go to a state of a branch of the history of the active layer, eg:
+        to compare two alternative edits. What was on the line after the
+        fork of the branch becomes a branch in turn.
+
+        Args:
+            branch: one of branches()
+            steps: number of edits of the branch to go to,
+                defaults to all of them
+
+        Returns:
+            the layer that was changed
+        """
+        self.flush_pending()
+        active_layer = self.find_active_layers()
+        if isinstance(active_layer, COMMAND_LAYER_TYPES):
+            self._restoring = True
+            try:
+                self.histories.switch_branch(active_layer, branch, steps)
+            finally:
+                self._restoring = False
+            if active_layer is self.layer:
+                self._track_data(active_layer)
+            return active_layer
+
+        self._sync_states()
+        index = self.caretaker.switch_branch(branch, steps)
+        self.savedStates = len(self.caretaker)
+        return self._restore_state(index)
+
+    def _restore_state(self, index: int) -> Layer:
+        """
+        restore the active layer to the state at `index`,
+        which becomes the current state
+        """
+        self.currentStateIdx = index
+        self._at_tip = index == self.savedStates - 1
+        logger.debug(f"currentStateIdx: {self.currentStateIdx}")
+        state = self.caretaker.get_state(index)
+        # self.layer stays the connected layer, only its data is restored
+        self.originator.set_layer(self.find_active_layers())
+        self._restoring = True
+        try:
+            layer = self.originator.restore_from_state(state)
+            self.change_detector.reset(layer.data)
+        finally:
+            self._restoring = False
+        return layer
+
+    def history_position(self) -> Tuple[int, int]:
+        """
+        returns the current position in the history of the active layer
+        (or in the global timeline) and the last position, for the timeline.
+        Position 0 is the oldest state kept.
+        """
+        active_layer = self.find_active_layers()
+        if self.histories.global_timeline or isinstance(
+            active_layer, COMMAND_LAYER_TYPES
+        ):
+            return self.histories.position(active_layer)
+        self._sync_states()
+        return max(self.currentStateIdx, 0), max(self.savedStates - 1, 0)
+
+    @metrics.timed("seek")
+    def go_to(self, position: int) -> Optional[Layer]:
+        """
+        Jump to a position of the history, see history_position, with a
+        single update of the layer: a history of states restores the
+        target state directly, a history of commands fuses all the
+        commands undone or redone, see CommandManager.go_to. The commands
+        of Shapes layers are applied one at a time, each one only updates
+        the shapes it edited.
+
+        Returns:
+            the layer that was changed, None if there was nothing to do
+        """
+        self.flush_pending()
+        active_layer = self.find_active_layers()
+        if self.histories.global_timeline or isinstance(
+            active_layer, COMMAND_LAYER_TYPES
+        ):
+            self._restoring = True
+            try:
+                layers = self.histories.go_to(position, active_layer)
+            finally:
+                self._restoring = False
+            if self.layer in layers:
+                self._track_data(self.layer)
+            return layers[-1] if layers else None
+
+        self._sync_states()
+        position = min(max(position, 0), self.savedStates - 1)
+        if position < 0 or position == self.currentStateIdx:
             return None
+        return self._restore_state(position)
+
+    def footprint(self) -> dict:
+        """
+        returns a summary of the memory held by the history
+        of the connected layer
+        """
+        if isinstance(self.layer, COMMAND_LAYER_TYPES):
+            return self.get_command_manager(self.layer).footprint()
+        self._sync_states()
+        return self.caretaker.footprint()
+
+    def stats(self) -> dict:
+        """
+        returns the latencies and event counts measured so far (see
+        metrics.Metrics.snapshot), the bytes held by the history of each
+        layer and their total
+        """
+        layers = self.histories.layer_nbytes()
+        if self.layer is not None and not isinstance(
+            self.layer, COMMAND_LAYER_TYPES
+        ):
+            # the states of the connected layer
+            self._sync_states()
+            layers[self.layer.name] = self.caretaker.nbytes
+        return {
+            **metrics.snapshot(),
+            "layer_bytes": layers,
+            "history_bytes": sum(layers.values()),
+        }
+
+    def update_stats(self) -> None:
+        """
+        refresh the stats readout, hidden while metrics are disabled
+        """
+        if not metrics.enabled:
+            self.stats_label.hide()
+            return
+        self.stats_label.setText(
+            format_stats(self.stats(), ["capture", "undo", "redo"])
+        )
+        self.stats_label.show()
+
+    def closeEvent(self, event) -> None:
+        """
+        delete the spilled history files and close the journals
+        when the widget is closed
+        """
+        self.capture.close()
+        self.caretaker.close()
+        self.histories.close()
+        super().closeEvent(event)
 
     # widget related functions:
     def configure_gui(self) -> None:
         """
-        Configure a QHBoxLayout to hold the undo and redo buttons.
+        Configure a QHBoxLayout to hold the undo and redo buttons,
+        and a stats readout below them, see update_stats.
         """
-        layout = QtWidgets.QHBoxLayout()
+        buttons = QtWidgets.QHBoxLayout()
+        # Qt would pass `checked` through the metrics wrappers of undo/redo
         undo_button = QtWidgets.QPushButton("Undo")
-        undo_button.clicked.connect(self.undo)
-        layout.addWidget(undo_button)
+        undo_button.clicked.connect(lambda: self.undo())
+        buttons.addWidget(undo_button)
 
         redo_button = QtWidgets.QPushButton("Redo")
-        redo_button.clicked.connect(self.redo)
-        layout.addWidget(redo_button)
+        redo_button.clicked.connect(lambda: self.redo())
+        buttons.addWidget(redo_button)
+        for button in (undo_button, redo_button):
+            button.clicked.connect(self.update_timeline)
 
+        layout = QtWidgets.QVBoxLayout()
+        layout.addLayout(buttons)
+
+        # positions of the history, see go_to
+        self.timeline = QtWidgets.QSlider(Qt.Horizontal)
+        self.timeline.setToolTip("History")
+        self.timeline.valueChanged.connect(self._on_timeline_changed)
+        self.timeline.sliderPressed.connect(self.update_timeline)
+        self.timeline.sliderReleased.connect(self._seek_timeline)
+        layout.addWidget(self.timeline)
+        self._timeline_timer = QTimer(self)
+        self._timeline_timer.setSingleShot(True)
+        self._timeline_timer.timeout.connect(self._seek_timeline)
+
+        self.stats_label = QtWidgets.QLabel()
+        self.stats_label.hide()
+        layout.addWidget(self.stats_label)
         self.setLayout(layout)
 
+        # refreshed once a second, so that the hot paths don't update it
+        self._stats_timer = QTimer(self)
+        self._stats_timer.timeout.connect(self.update_stats)
+        self._stats_timer.timeout.connect(self.update_timeline)
+        self._stats_timer.start(1000)
+
+    def update_timeline(self) -> None:
+        """
+        set the range and the value of the timeline to the history,
+        unless a position it was moved to is still to be rendered
+        """
+        if self._timeline_target is not None:
+            return
+        position, last = self.history_position()
+        self.timeline.blockSignals(True)
+        try:
+            self.timeline.setRange(0, last)
+            self.timeline.setValue(position)
+        finally:
+            self.timeline.blockSignals(False)
+
+    def _on_timeline_changed(self, position: int) -> None:
+        """
+        remember where the timeline was moved to, the layer is updated
+        at most once per TIMELINE_FRAME_MS: the positions it was dragged
+        through in the meantime are never rendered
+        """
+        self._timeline_target = position
+        if not self._timeline_timer.isActive():
+            self._timeline_timer.start(TIMELINE_FRAME_MS)
+
+    def _seek_timeline(self) -> None:
+        """
+        go to the last position the timeline was moved to, if any
+        """
+        self._timeline_timer.stop()
+        position, self._timeline_target = self._timeline_target, None
+        if position is not None:
+            self.go_to(position)
+
     def find_active_layers(self) -> Optional[Layer]:
         """
         Find pre-existing selected layer.
@@ -231,7 +1001,7 @@ class UndoRedoWidget(QtWidgets.QWidget):
 
         # first disconnect events from earlier layer if its not None
         if self.layer:
-            self.layer.events.data.disconnect(self.save_state)
+            self.disconnect_layer(self.layer)
             # self.layer.events.name.disconnect(self.save_state)
             # self.layer.events.symbol.disconnect(self.save_state)
             # self.layer.events.size.disconnect(self.save_state)
@@ -239,11 +1009,33 @@ class UndoRedoWidget(QtWidgets.QWidget):
 
         # set the global layer to the new layer and connect it to events
         self.layer = layer
-        self.layer.events.data.connect(self.save_state)
-        # self.layer.events.name.connect(self.save_state)
-        # self.layer.events.symbol.connect(self.save_state)
-        # self.layer.events.size.connect(self.save_state)
-        # self.layer.events.highlight.connect(self.save_state)
+        self._track_data(self.layer)
+        self.layer.events.data.connect(self.on_data_event)
+        self.layer.mouse_drag_callbacks.append(self._on_mouse_drag)
+        if isinstance(self.layer, Labels):
+            # painting modifies labels in place and only emits paint events
+            self.layer.events.paint.connect(self.save_paint)
+        for name in property_events(self.layer):
+            getattr(self.layer.events, name).connect(self.save_properties)
+
+    def disconnect_layer(self, layer: Layer) -> None:
+        """
+        Disconnect the events connected in connect_layer.
+
+        Args:
+            layer: Layer (Layer to disconnect from.)
+        """
+        # pending edits belong to this layer
+        self.flush_pending()
+        # the change detector is reset for the next layer
+        self._sync_states()
+        layer.events.data.disconnect(self.on_data_event)
+        if self._on_mouse_drag in layer.mouse_drag_callbacks:
+            layer.mouse_drag_callbacks.remove(self._on_mouse_drag)
+        if isinstance(layer, Labels):
+            layer.events.paint.disconnect(self.save_paint)
+        for name in property_events(layer):
+            getattr(layer.events, name).disconnect(self.save_properties)
 
     # Slots start here:
 
@@ -267,8 +1059,7 @@ class UndoRedoWidget(QtWidgets.QWidget):
         logger.info(
             f'New layer "{event.source}" was inserted at index {event.index}'
         )
-        pprint(f"event: {vars(event)}")
-        pprint(f"event type: {event.type}")
+        logger.debug(f"event: {vars(event)}")
 
         newly_inserted_layer = event.source
         if newly_inserted_layer:
@@ -283,6 +1074,22 @@ class UndoRedoWidget(QtWidgets.QWidget):
             event (Event): event.type == 'removed'
         """
         logger.info(f'Removed layer "{event.source}"')
+        # commands hold their layer, drop them so that it can be freed
+        self.histories.remove(event.value)
+        if event.value is self.layer:
+            # the history of a removed layer can't be used anymore,
+            # this also deletes its spilled files
+            self._pending_layer = None
+            self._pending_rows = None
+            self.disconnect_layer(self.layer)
+            self.layer = None
+            self.caretaker.close()
+            self.change_detector = ChangeDetector()
+            self._last_data = None
+            self._last_columns = None
+            self.savedStates = 0
+            self.currentStateIdx = -1
+            self._at_tip = True
         currently_selected_layer = self.find_active_layers()
         if currently_selected_layer and currently_selected_layer != self.layer:
             self.connect_layer(currently_selected_layer)
@@ -0,0 +1,602 @@
+"""
+Headless benchmarks of the history of napari layers.
+
+Times, and measures the peak memory of, capturing an edit in the history
+(UndoRedoWidget.save_state / save_paint), pushing its command to
+a CommandManager, and undoing/redoing it, for every command type,
+on Points, Shapes and Labels layers of 1e3 to 1e7 elements and edits of
+a single element up to bulk edits.
+
+    python -m napari_undo_redo.benchmarks --output results.jsonl
+    python -m napari_undo_redo.benchmarks --sizes 1e3 1e5 --edits 1 100
+    python -m napari_undo_redo.benchmarks --compare results.jsonl
+
+Results are written as json lines: an "environment" record (versions of
+python, numpy, napari and the plugin), then one record per measurement:
+
+    {"benchmark": "undo", "layer": "points", "command": "MoveCommand",
+     "elements": 1000000, "edit": 1000, "times_s": [...], "min_s": ...,
+     "median_s": ..., "peak_bytes": ..., "history_bytes": ...}
+
+--compare exits with status 1 if any median time or peak memory is more
+than --tolerance times the one of a previous run, so that a regression
+is caught before upgrading the plugin.
+
+Qt runs offscreen. Without qtpy (or a Qt binding), the capture benchmarks,
+which need the widget, are skipped and only the commands are measured.
+napari triangulates every shape, so Shapes layers are limited to
+--max-shapes shapes, and their edits to --max-shapes-edit shapes.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional
+
+import numpy as np
+
+DEFAULT_SIZES = (1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+DEFAULT_EDITS = (1, 1_000, 100_000)
+LAYER_TYPES = ("points", "shapes", "labels")
+MAX_SHAPES = 10_000
+MAX_SHAPES_EDIT = 100
+
+# measured values compared by --compare
+_METRICS = ("median_s", "peak_bytes")
+# differences below these are noise, not regressions
+_MIN_SECONDS = 1e-4
+_MIN_BYTES = 64 * 1024
+
+
+class Case(NamedTuple):
+    """
+    one edit of a layer: `make` returns its command, built from the layer
+    before the edit, `capture` saves the edit through the widget
+    """
+
+    layer: str
+    command: str
+    elements: int
+    edit: int
+    make: Callable
+    capture: Optional[Callable] = None
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = _parse_args(argv)
+    out = open(args.output, "w") if args.output else sys.stdout
+    records = []
+    try:
+        # the plugin logs to stdout, the results must stay parseable
+        with redirect_stdout(sys.stderr):
+            for record in run(
+                layers=args.layers,
+                sizes=args.sizes,
+                edits=args.edits,
+                repeat=args.repeat,
+                capture=not args.no_capture,
+                max_shapes=args.max_shapes,
+                max_shapes_edit=args.max_shapes_edit,
+            ):
+                records.append(record)
+                out.write(json.dumps(record) + "\n")
+                out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    if args.compare:
+        regressions = compare(
+            load_results(args.compare), records, args.tolerance
+        )
+        for message in regressions:
+            print(f"REGRESSION {message}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+def run(
+    layers=LAYER_TYPES,
+    sizes=DEFAULT_SIZES,
+    edits=DEFAULT_EDITS,
+    repeat: int = 3,
+    capture: bool = True,
+    max_shapes: int = MAX_SHAPES,
+    max_shapes_edit: int = MAX_SHAPES_EDIT,
+) -> Iterator[dict]:
+    """
+    run the benchmarks, yields the environment record then one record
+    per measurement
+
+    Args:
+        layers: layer types to benchmark, see LAYER_TYPES
+        sizes: number of elements of the layers (points, shapes or voxels)
+        edits: number of elements edited at once
+        repeat: number of timed runs of each measurement
+        capture: also benchmark capturing the edits with the widget
+        max_shapes: larger Shapes layers are skipped
+        max_shapes_edit: larger edits of Shapes layers are skipped
+    """
+    yield environment()
+    viewer_model = _viewer_model() if capture else None
+    for layer_type in layers:
+        for n in sizes:
+            if layer_type == "shapes" and n > max_shapes:
+                continue
+            layer = _LAYERS[layer_type](n)
+            for k in edits:
+                if k > n // 2:
+                    continue
+                if layer_type == "shapes" and k > max_shapes_edit:
+                    continue
+                for case in _CASES[layer_type](layer, n, k):
+                    yield from _bench_command(case, layer, repeat)
+                    if case.capture is not None and viewer_model:
+                        yield from _bench_capture(
+                            case, layer, repeat, viewer_model
+                        )
+
+
+def environment() -> dict:
+    import napari
+
+    from . import __version__
+
+    return {
+        "benchmark": "environment",
+        "plugin": __version__,
+        "napari": napari.__version__,
+        "numpy": np.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def load_results(path: str) -> List[dict]:
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def compare(
+    baseline: List[dict], results: List[dict], tolerance: float = 1.5
+) -> List[str]:
+    """
+    returns a message for every measurement of `results` which is more
+    than `tolerance` times slower, or bigger, than in `baseline`
+    """
+    previous = {_key(r): r for r in _measurements(baseline)}
+    messages = []
+    for record in _measurements(results):
+        old = previous.get(_key(record))
+        if old is None:
+            continue
+        for metric, floor in zip(_METRICS, (_MIN_SECONDS, _MIN_BYTES)):
+            before, after = old.get(metric), record.get(metric)
+            if before is None or after is None:
+                continue
+            if after > before * tolerance and after - before > floor:
+                messages.append(
+                    f"{'/'.join(map(str, _key(record)))} {metric}: "
+                    f"{before:.6g} -> {after:.6g}"
+                )
+    return messages
+
+
+def _measurements(records: List[dict]) -> Iterator[dict]:
+    return (r for r in records if r["benchmark"] != "environment")
+
+
+def _key(record: dict) -> tuple:
+    return (
+        record["benchmark"],
+        record["layer"],
+        record["command"],
+        record["elements"],
+        record["edit"],
+    )
+
+
+# measurements
+
+
+def _bench_command(case: Case, layer, repeat: int) -> Iterator[dict]:
+    """
+    push the command of an edit, then undo and redo it `repeat` times.
+    The layer is left as it was.
+    """
+    from .command import CommandManager
+
+    manager = CommandManager(layer, merge=False)
+    cmd = case.make()
+    cmd.redo()
+    push_times = [_timed(manager.add_command_to_undo_stack, cmd)]
+    undo_times, redo_times = [], []
+    for _ in range(repeat):
+        undo_times.append(_timed(manager.undo))
+        redo_times.append(_timed(manager.redo))
+    history_bytes = manager.nbytes
+    undo_peak = _peak(manager.undo)
+    redo_peak = _peak(manager.redo)
+    manager.undo()
+
+    for name, times, peak in (
+        ("push", push_times, None),
+        ("undo", undo_times, undo_peak),
+        ("redo", redo_times, redo_peak),
+    ):
+        yield _record(case, name, times, peak, history_bytes)
+
+
+def _bench_capture(case: Case, layer, repeat: int, viewer_model) -> Iterator:
+    """
+    save the edit in the history of an UndoRedoWidget, ie: infer its
+    command, `repeat` times. The layer is left as it was.
+    """
+    from qtpy.QtGui import QCloseEvent
+
+    viewer = viewer_model()
+    viewer.layers.append(layer)
+    try:
+        widget = _widget(viewer, layer)
+        times, peak = [], None
+        for i in range(repeat + 1):
+            cmd = case.make()
+            # napari's own update is not measured, only the capture:
+            # the widget ignores the edit like its own undo/redo
+            _unseen(widget, cmd.redo)
+            if i < repeat:
+                times.append(_timed(case.capture, widget, cmd))
+            else:
+                peak = _peak(case.capture, widget, cmd)
+            history_bytes = widget.get_command_manager(layer).nbytes
+            _unseen(widget, cmd.undo)
+            widget._track_data(layer)
+        widget.closeEvent(QCloseEvent())
+    finally:
+        viewer.layers.remove(layer)
+    yield _record(case, "capture", times, peak, history_bytes)
+
+
+def _unseen(widget, fn: Callable) -> None:
+    widget._restoring = True
+    try:
+        fn()
+    finally:
+        widget._restoring = False
+
+
+def _timed(fn: Callable, *args) -> float:
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def _peak(fn: Callable, *args) -> int:
+    """
+    returns the peak memory allocated while running fn, in bytes
+    """
+    tracemalloc.start()
+    try:
+        fn(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _record(
+    case: Case,
+    benchmark: str,
+    times: List[float],
+    peak: Optional[int],
+    history_bytes: int,
+) -> dict:
+    return {
+        "benchmark": benchmark,
+        "layer": case.layer,
+        "command": case.command,
+        "elements": case.elements,
+        "edit": case.edit,
+        "times_s": times,
+        "min_s": min(times),
+        "median_s": statistics.median(times),
+        "peak_bytes": peak,
+        "history_bytes": history_bytes,
+    }
+
+
+# Qt, only for the capture benchmarks
+
+
+def _viewer_model():
+    """
+    returns the napari ViewerModel class, after starting an offscreen
+    QApplication, None if Qt isn't available
+    """
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    try:
+        from qtpy.QtWidgets import QApplication
+    except Exception:
+        return None
+    if QApplication.instance() is None:
+        _viewer_model.app = QApplication([])
+    from napari.components import ViewerModel
+
+    return ViewerModel
+
+
+def _widget(viewer, layer):
+    from ._widget import UndoRedoWidget
+
+    return UndoRedoWidget(viewer, layer)
+
+
+def _capture_data(widget, cmd) -> None:
+    from napari.utils.events import Event
+
+    layer = widget.layer
+    event = Event("data", action="changed")
+    indices = getattr(cmd, "indices", None)
+    if indices is not None and not isinstance(indices, dict):
+        event = Event(
+            "data",
+            action="changed",
+            data_indices=tuple(np.asarray(indices).tolist()),
+        )
+    event._push_source(layer)
+    widget.save_state(event)
+
+
+def _capture_paint(widget, cmd) -> None:
+    from napari.utils.events import Event
+
+    layer = widget.layer
+    coords = np.unravel_index(cmd.indices, layer.data.shape)
+    event = Event(
+        "paint", value=[(coords, cmd.prev_values, cmd.new_values[0])]
+    )
+    event._push_source(layer)
+    widget.save_paint(event)
+
+
+def _capture_properties(widget, cmd) -> None:
+    from napari.utils.events import Event
+
+    event = Event(next(iter(cmd.indices)))
+    event._push_source(widget.layer)
+    widget.save_properties(event)
+
+
+# layers and edits
+
+
+def _points(n: int):
+    from napari.layers import Points
+
+    rng = np.random.default_rng(0)
+    return Points(rng.random((n, 2)) * 1000, size=np.ones(n))
+
+
+def _shapes(n: int):
+    from napari.layers import Shapes
+
+    square = np.array([[0, 0], [0, 5], [5, 5], [5, 0]], float)
+    offsets = np.stack([np.arange(n) % 1000, np.arange(n) // 1000], 1) * 10
+    return Shapes([square + offset for offset in offsets])
+
+
+def _labels(n: int):
+    from napari.layers import Labels
+
+    side = int(np.sqrt(n))
+    return Labels(np.zeros((side, n // side), dtype=np.int32))
+
+
+def _spread(n: int, k: int) -> np.ndarray:
+    """
+    returns k indices spread over n elements
+    """
+    return np.linspace(0, n - 1, k).astype(np.intp)
+
+
+def _points_cases(layer, n: int, k: int) -> List[Case]:
+    from .command import AddCommand, DeleteCommand, MoveCommand
+    from .command.columns import ColumnsCommand
+
+    indices = _spread(n, k)
+    rows = lambda: np.array(layer.data[indices])  # noqa: E731
+
+    def add():
+        # the rows end up at `indices` once added
+        inserted = indices + np.arange(k)
+        return AddCommand(layer, inserted.tolist(), rows() + 0.5)
+
+    def resize():
+        size = {"size": indices}
+        prev = {"size": np.array(layer.size[indices])}
+        return ColumnsCommand(layer, size, prev, {"size": prev["size"] * 2})
+
+    return [
+        Case(
+            "points",
+            "MoveCommand",
+            n,
+            k,
+            lambda: MoveCommand(layer, indices, rows(), rows() * 1.5),
+            _capture_data,
+        ),
+        Case(
+            "points",
+            "MoveCommand.offset",
+            n,
+            k,
+            lambda: MoveCommand(layer, indices, rows(), rows() + 8),
+            _capture_data,
+        ),
+        Case("points", "AddCommand", n, k, add, _capture_data),
+        Case(
+            "points",
+            "DeleteCommand",
+            n,
+            k,
+            lambda: DeleteCommand(layer, indices.tolist(), rows()),
+            _capture_data,
+        ),
+        Case("points", "ColumnsCommand", n, k, resize, _capture_properties),
+    ]
+
+
+def _shapes_cases(layer, n: int, k: int) -> List[Case]:
+    from .command import (
+        AddShapesCommand,
+        DeleteShapesCommand,
+        EditShapesCommand,
+        TransformShapesCommand,
+    )
+
+    indices = _spread(n, k)
+    vertices = lambda: [np.array(layer.data[i]) for i in indices]  # noqa
+
+    def edit():
+        prev = vertices()
+        new = [np.append(v, [[v[0, 0], v[0, 1] - 3]], axis=0) for v in prev]
+        types = [layer.shape_type[i] for i in indices]
+        return EditShapesCommand(
+            layer, indices, prev, new, types, ["polygon"] * k
+        )
+
+    def delete():
+        types = [layer.shape_type[i] for i in indices]
+        return DeleteShapesCommand(layer, indices, vertices(), types)
+
+    def add():
+        appended = np.arange(n, n + k)
+        return AddShapesCommand(
+            layer, appended, [v + 3 for v in vertices()], ["rectangle"] * k
+        )
+
+    return [
+        Case(
+            "shapes",
+            "TransformShapesCommand",
+            n,
+            k,
+            lambda: TransformShapesCommand(
+                layer, indices, vertices(), [v * 1.5 for v in vertices()]
+            ),
+            _capture_data,
+        ),
+        Case(
+            "shapes",
+            "TransformShapesCommand.offset",
+            n,
+            k,
+            lambda: TransformShapesCommand(
+                layer, indices, vertices(), [v + 8 for v in vertices()]
+            ),
+            _capture_data,
+        ),
+        Case("shapes", "EditShapesCommand", n, k, edit, _capture_data),
+        Case("shapes", "AddShapesCommand", n, k, add, _capture_data),
+        Case("shapes", "DeleteShapesCommand", n, k, delete, _capture_data),
+    ]
+
+
+def _labels_cases(layer, n: int, k: int) -> List[Case]:
+    from .command import PaintCommand
+
+    size = layer.data.size
+    # a brush stroke: contiguous voxels
+    stroke = np.arange(k, dtype=np.intp) + (size - k) // 2
+    scattered = _spread(size, k)
+
+    def paint(indices):
+        prev = layer.data.reshape(-1)[indices]
+        return PaintCommand(layer, indices, prev, np.full(k, 7))
+
+    return [
+        Case(
+            "labels",
+            "PaintCommand",
+            n,
+            k,
+            lambda: paint(stroke),
+            _capture_paint,
+        ),
+        Case(
+            "labels",
+            "PaintCommand.scattered",
+            n,
+            k,
+            lambda: paint(scattered),
+            _capture_paint,
+        ),
+    ]
+
+
+_LAYERS: Dict[str, Callable] = {
+    "points": _points,
+    "shapes": _shapes,
+    "labels": _labels,
+}
+_CASES: Dict[str, Callable] = {
+    "points": _points_cases,
+    "shapes": _shapes_cases,
+    "labels": _labels_cases,
+}
+
+
+def _parse_args(argv: Optional[List[str]]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m napari_undo_redo.benchmarks",
+        description=__doc__.strip().splitlines()[0],
+    )
+    parser.add_argument(
+        "--layers", nargs="+", choices=LAYER_TYPES, default=LAYER_TYPES
+    )
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        type=lambda s: int(float(s)),
+        default=DEFAULT_SIZES,
+        help="number of elements of the layers, eg: 1e3 1e6",
+    )
+    parser.add_argument(
+        "--edits",
+        nargs="+",
+        type=lambda s: int(float(s)),
+        default=DEFAULT_EDITS,
+        help="number of elements edited at once",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--no-capture",
+        action="store_true",
+        help="only benchmark the commands, without the widget",
+    )
+    parser.add_argument("--max-shapes", type=int, default=MAX_SHAPES)
+    parser.add_argument("--max-shapes-edit", type=int, default=MAX_SHAPES_EDIT)
+    parser.add_argument(
+        "--output", help="json lines file, defaults to the standard output"
+    )
+    parser.add_argument(
+        "--compare", help="results of a previous run to compare with"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1.5,
+        help="slowdown (or memory growth) ratio reported as a regression",
+    )
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,102 @@
+"""
+Ordered background jobs for storing the history of a layer.
+
+Saving a state has a cheap part, copying the layer data, which has to happen
+on the GUI thread before the next edit changes the data again, and an
+expensive part: diffing with the previous state, hashing the blocks of the
+chunk store, spilling to disk and fingerprinting for change detection.
+A CaptureQueue runs the expensive part on a thread pool,
+so that the GUI does not wait for it after every edit.
+
+Jobs of a queue always run one at a time, in the order they were submitted,
+even on a pool with several workers shared with other queues:
+each job first waits for the job submitted before it.
+Whoever reads the history (undo, redo, ...) calls wait() first.
+"""
+
+from collections import deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import Callable, Deque, Optional
+
+
+class CaptureQueue:
+    """
+    Jobs run in submission order, on an executor or inline
+    """
+
+    def __init__(
+        self, executor: Optional[Executor] = None, workers: int = 0
+    ) -> None:
+        """
+        Args:
+            executor: pool running the jobs, eg: shared between queues
+            workers: if no executor is given, number of threads of a pool
+                owned by this queue, 0 runs every job inline
+        """
+        self._owns_executor = executor is None and workers > 0
+        if self._owns_executor:
+            executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="napari-undo-redo"
+            )
+        self.executor = executor
+        self._pending: Deque[Future] = deque()
+
+    def __len__(self) -> int:
+        """
+        returns the number of jobs submitted and not waited for
+        """
+        return len(self._pending)
+
+    @property
+    def is_async(self) -> bool:
+        return self.executor is not None
+
+    def submit(self, fn: Callable, *args) -> Optional[Future]:
+        """
+        run fn(*args) after all the jobs submitted before,
+        right away if the queue is synchronous
+
+        Returns:
+            the future of the job, None if it was run inline
+        """
+        if self.executor is None:
+            fn(*args)
+            return None
+        previous = self._pending[-1] if self._pending else None
+        future = self.executor.submit(_after, previous, fn, *args)
+        self._pending.append(future)
+        return future
+
+    def wait(self) -> None:
+        """
+        wait until all the submitted jobs are done,
+        an error raised by a job is raised again here
+        """
+        while self._pending:
+            future = self._pending.popleft()
+            future.result()
+
+    def close(self) -> None:
+        """
+        wait for the submitted jobs and stop the pool owned by the queue
+        """
+        try:
+            self.wait()
+        finally:
+            self._pending.clear()
+            if self._owns_executor:
+                self.executor.shutdown()
+                self.executor = None
+                self._owns_executor = False
+
+
+def _after(previous: Optional[Future], fn: Callable, *args) -> None:
+    """
+    body of a job: wait for the previous job of the queue, then run fn.
+    The previous job was submitted first, so it is running or done already
+    and waiting for it can't starve the pool.
+    """
+    if previous is not None:
+        # its error is raised by wait(), this job still runs
+        previous.exception()
+    fn(*args)
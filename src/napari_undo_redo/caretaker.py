@@ -1,4 +1,17 @@
+from bisect import bisect_left
+from typing import Dict, List, Optional
+
+from .chunkstore import DEFAULT_CHUNK_BYTES, ChunkedArray, ChunkStore
+from .compress import Codec, compress_data, is_compressed
+from .delta import Delta, LayerData, _copy, _nbytes, compute_delta
+from .eviction import DropOldest, EvictionPolicy
+from .layer_types import DENSE_LAYER_TYPES
+from .spill import SpillStore, is_spilled, load_data, release_data, spill_data
 from .state import State
+from .tree import Branch, HistoryTree
+
+# bytes used by the key of one block of a ChunkedArray
+_KEY_NBYTES = 16
 
 
 class CareTaker:
@@ -6,14 +19,169 @@ class CareTaker:
     It is a collection of states.
     Each time an operation(add, delete, move) is done in a napari layer, the
     caretaker saves the current state of the layer.
+
+    Only the first state is stored as a full snapshot (the base),
+    every following state is stored as a Delta to the state before it.
+    So the memory used grows with the size of the edits,
+    and not with the size of the layer times the number of edits.
+
+    States of dense layers (Image, Labels) are instead stored as
+    ChunkedArrays in a ChunkStore, which shares the unchanged blocks
+    between all the states.
+
+    The history can be given a budget (max_bytes and/or max_steps).
+    When a new state goes over it, the eviction policy removes old states
+    until the history fits again.
+
+    With `hot_steps` set, only the most recent steps stay in memory:
+    older deltas, snapshot blocks and the base are spilled to memory-mapped
+    files, and paged back in only when undo/redo reaches them.
+
+    With `compression`, the base, the deltas and the blocks of the chunk
+    store are kept compressed in memory, except the most recent delta,
+    which the next undo reverts.
+
+    With `keyframe_interval`, a full copy of every keyframe_interval-th
+    state is kept as well, like the keyframes of a video: rebuilding any
+    state then starts from the closest keyframe (or the base, or the
+    cursor) and applies at most keyframe_interval / 2 deltas, instead of
+    up to one delta per state since the base.
+
+    With `undo_tree`, the states dropped by a new state added after an
+    undo are kept as a branch instead, see branch and switch_branch. A
+    branch holds its deltas (or the ChunkedArrays of its snapshots, whose
+    blocks stay shared in the chunk store), never the states it forks
+    from. Branches are pruned, least recently visited first, before the
+    eviction policy runs when over max_bytes.
     """
 
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        chunk_bytes: int = DEFAULT_CHUNK_BYTES,
+        max_bytes: Optional[int] = None,
+        max_steps: Optional[int] = None,
+        eviction_policy: Optional[EvictionPolicy] = None,
+        hot_steps: Optional[int] = None,
+        spill_directory: Optional[str] = None,
+        compression: Optional[Codec] = None,
+        keyframe_interval: Optional[int] = None,
+        undo_tree: bool = False,
+    ) -> None:
+        """
+        initializes CareTaker with an empty history
+        base: State (full snapshot of the first state)
+        deltas: List[Delta] (deltas[i] turns state i into state i + 1)
+        chunk_store: ChunkStore (blocks of the dense layer states)
+        snapshots: List[ChunkedArray] (one per dense layer state)
+        keyframes: Dict[int, LayerData] (full data of some row states)
+
+        Args:
+            chunk_bytes: block size of the chunk store, in bytes
+            max_bytes: maximum number of bytes held by the history
+            max_steps: maximum number of states kept
+            eviction_policy: how states are removed when over budget,
+                defaults to DropOldest
+            hot_steps: number of recent steps kept in memory,
+                None keeps everything in memory
+            spill_directory: where the files of spilled steps are written,
+                defaults to the system temporary directory
+            compression: Codec compressing the history in memory,
+                None keeps it raw
+            keyframe_interval: number of states between two keyframes,
+                None only keeps the base
+            undo_tree: keep the states dropped by `branch` as a branch
+        """
+        self.base: Optional[State] = None
+        self.deltas: List[Delta] = []
+        self.compression = compression
+        self.chunk_store = ChunkStore(chunk_bytes, compression)
+        self.snapshots: List[ChunkedArray] = []
+        self.keyframe_interval = keyframe_interval
+        self.keyframes: Dict[int, LayerData] = {}
+        # branches of the history, base, deltas and snapshots are its line
+        self.tree: Optional[HistoryTree] = None
+        if undo_tree:
+            self.tree = HistoryTree(self._edge_nbytes, self._release_edge)
+
+        self.max_bytes = max_bytes
+        self.max_steps = max_steps
+        self.eviction_policy = eviction_policy or DropOldest()
+
+        self.hot_steps = hot_steps
+        self.spill_directory = spill_directory
+        # created on the first spill
+        self.spill_store: Optional[SpillStore] = None
+
+        # the data of the last restored or added state is kept,
+        # so that stepping one state back or forth applies a single delta
+        self._cursor_index = -1
+        self._cursor_data: Optional[LayerData] = None
+
+        # running total of the bytes held by base, deltas and keyframes
+        self._row_nbytes = 0
+
+    def __len__(self) -> int:
+        """
+        returns the number of states stored
+        """
+        if self.base is None:
+            return 0
+        if self._is_dense:
+            return len(self.snapshots)
+        return len(self.deltas) + 1
+
+    @property
+    def _is_dense(self) -> bool:
+        return (
+            self.base is not None and self.base.layer_type in DENSE_LAYER_TYPES
+        )
+
+    @property
+    def nbytes(self) -> int:
+        """
+        number of bytes used by the stored history
+        """
+        branches = self.tree.nbytes if self.tree is not None else 0
+        if self._is_dense:
+            keys = sum(len(chunked.keys) for chunked in self.snapshots)
+            return self.chunk_store.nbytes + keys * _KEY_NBYTES + branches
+        return self._row_nbytes + branches
+
+    def footprint(self) -> dict:
         """
-        initializes CareTaker with an empty list of states
-        states: List[State]
+        returns a summary of what the history currently holds
         """
-        self.states = []
+        return {
+            "states": len(self),
+            "nbytes": self.nbytes,
+            "spilled_nbytes": (
+                self.spill_store.nbytes if self.spill_store else 0
+            ),
+            "max_bytes": self.max_bytes,
+            "max_steps": self.max_steps,
+            "branches": len(self.tree) if self.tree is not None else 0,
+        }
+
+    def set_budget(
+        self,
+        max_bytes: Optional[int] = None,
+        max_steps: Optional[int] = None,
+        eviction_policy: Optional[EvictionPolicy] = None,
+    ) -> None:
+        """
+        change the budget of the history, and evict states right away
+        if the history does not fit in it anymore
+
+        Args:
+            max_bytes: maximum number of bytes held by the history
+            max_steps: maximum number of states kept
+            eviction_policy: how states are removed when over budget
+        """
+        self.max_bytes = max_bytes
+        self.max_steps = max_steps
+        if eviction_policy is not None:
+            self.eviction_policy = eviction_policy
+        self._enforce_budget()
 
     def add_state(self, state: State) -> None:
         """
@@ -22,7 +190,28 @@ class CareTaker:
         Args:
             state: State
         """
-        self.states.append(state)
+        if self.base is None:
+            self.base = state
+            if not self._is_dense:
+                self._row_nbytes = _nbytes(state.data)
+        if self._is_dense:
+            self.snapshots.append(self.chunk_store.put(state.data))
+            # the chunk store holds the data now
+            self.base.data = None
+        else:
+            if self.base is not state:
+                last_data = self._materialize(len(self) - 1)
+                self._append_delta(compute_delta(last_data, state.data))
+            # the state data is a private copy of the layer data,
+            # so it can become the cursor (and a keyframe) without copying
+            self._cursor_index = len(self) - 1
+            self._cursor_data = state.data
+            if self._is_keyframe(self._cursor_index):
+                self.keyframes[self._cursor_index] = state.data
+                self._row_nbytes += _nbytes(state.data)
+        self._enforce_budget()
+        self._spill_cold()
+        self._compress()
 
     def get_state(self, index: int) -> State:
         """
@@ -31,4 +220,367 @@ class CareTaker:
         Args:
             index: int
         """
-        return self.states[index]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"state index {index} out of range")
+        if self._is_dense:
+            data = self.chunk_store.get(self.snapshots[index])
+        else:
+            data = _copy(self._materialize(index))
+        return State.from_data(self.base.layer_type, data)
+
+    def truncate(self, length: int) -> None:
+        """
+        drop all the states from `length` onwards,
+        eg: the states that could be redone before a new state is added
+
+        Args:
+            length: int (number of states to keep)
+        """
+        if length >= len(self):
+            return
+        if self.tree is not None:
+            self.tree.remove_states(length)
+        if self._is_dense:
+            for chunked in self.snapshots[length:]:
+                self.chunk_store.release(chunked)
+            del self.snapshots[length:]
+            if length <= 0:
+                self.base = None
+            return
+        self._drop_keyframes(length, len(self))
+        if length <= 0:
+            self._release_data(self.base.data)
+            for delta in self.deltas:
+                self._release_delta(delta)
+            self.base = None
+            self.deltas = []
+            self._row_nbytes = 0
+            self._cursor_index, self._cursor_data = -1, None
+            return
+        if self._cursor_index >= length:
+            self._materialize(length - 1)
+        for delta in self.deltas[length - 1 :]:
+            self._release_delta(delta)
+        del self.deltas[length - 1 :]
+
+    def remove_state(self, index: int) -> None:
+        """
+        remove one state from the history,
+        the states after it move back by one index
+
+        Args:
+            index: int
+        """
+        if index < 0:
+            index += len(self)
+        if index == len(self) - 1:
+            self.truncate(index)
+        elif index == 0:
+            self.merge_into_base(1)
+        elif self._is_dense:
+            self.chunk_store.release(self.snapshots.pop(index))
+            if self.tree is not None:
+                self.tree.remove_states(index, index + 1)
+        else:
+            # the deltas on both sides of the state become a single delta
+            prev = self._materialize(index - 1)
+            following = self._materialize(index + 1)
+            merged = compute_delta(prev, following)
+            for delta in self.deltas[index - 1 : index + 1]:
+                self._release_delta(delta)
+            self.deltas[index - 1 : index + 1] = [merged]
+            if self.compression is not None and index < len(self.deltas):
+                merged.compress(self.compression)
+            self._row_nbytes += merged.nbytes
+            self._cursor_index = index
+            self._drop_keyframes(index, index + 1)
+            if self.tree is not None:
+                self.tree.remove_states(index, index + 1)
+
+    def merge_into_base(self, steps: int) -> None:
+        """
+        make the state at index `steps` the new base,
+        and drop all the states before it
+
+        Args:
+            steps: number of states merged into the base
+        """
+        if steps <= 0:
+            return
+        if self.tree is not None:
+            self.tree.remove_states(0, steps)
+        if self._is_dense:
+            for chunked in self.snapshots[:steps]:
+                self.chunk_store.release(chunked)
+            del self.snapshots[:steps]
+            return
+        data = _copy(self._materialize(steps))
+        self._release_data(self.base.data)
+        for delta in self.deltas[:steps]:
+            self._release_delta(delta)
+        self.base = State.from_data(self.base.layer_type, data)
+        self._row_nbytes += _nbytes(data)
+        del self.deltas[:steps]
+        self._drop_keyframes(0, steps)
+        if 0 in self.keyframes:
+            # the base holds this state now
+            self._release_data(self.keyframes.pop(0))
+        self._cursor_index, self._cursor_data = 0, data
+
+    def branch(self, length: int) -> None:
+        """
+        drop all the states from `length` onwards, like truncate, but
+        with undo_tree they are kept as a branch forking from the state
+        before them
+
+        Args:
+            length: int (number of states kept on the line)
+        """
+        if self.tree is None or length <= 0 or length >= len(self):
+            self.truncate(length)
+            return
+        self.tree.stash(length - 1, self._detach(length - 1))
+
+    @property
+    def branches(self) -> List[Branch]:
+        """
+        the branches of the history, empty without undo_tree
+        """
+        return list(self.tree) if self.tree is not None else []
+
+    def switch_branch(
+        self, branch: Branch, steps: Optional[int] = None
+    ) -> int:
+        """
+        put a branch on the line of the history, the states it replaces
+        become a branch
+
+        Args:
+            branch: one of `branches`
+            steps: number of states of the branch to go to,
+                defaults to all of them
+
+        Returns:
+            the index of the state to restore
+        """
+        if steps is None:
+            steps = len(branch)
+        index = branch.fork_depth + min(max(steps, 0), len(branch))
+        self.tree.switch(branch, self._detach, self._attach)
+        return index
+
+    def close(self) -> None:
+        """
+        drop the whole history and delete the files of spilled steps
+        """
+        self.truncate(0)
+        if self.spill_store is not None:
+            self.spill_store.close()
+            self.spill_store = None
+
+    def _over_budget(self) -> bool:
+        if self.max_steps is not None and len(self) > self.max_steps:
+            return True
+        return self.max_bytes is not None and self.nbytes > self.max_bytes
+
+    def _enforce_budget(self) -> None:
+        while self._over_budget():
+            if (
+                self.tree is not None
+                and self.max_bytes is not None
+                and self.nbytes > self.max_bytes
+                and self.tree.prune_coldest()
+            ):
+                # cold branches go before any state of the line
+                continue
+            if not self.eviction_policy.evict(self):
+                break
+
+    def _detach(self, index: int) -> list:
+        """
+        remove the states after `index` from the line
+
+        Returns:
+            the deltas, or snapshots, of the removed states
+        """
+        self._drop_keyframes(index + 1, len(self))
+        if self._is_dense:
+            edges = self.snapshots[index + 1 :]
+            del self.snapshots[index + 1 :]
+            return edges
+        if self._cursor_index > index:
+            self._materialize(index)
+        edges = self.deltas[index:]
+        del self.deltas[index:]
+        self._row_nbytes -= sum(delta.nbytes for delta in edges)
+        return edges
+
+    def _attach(self, edges: list) -> None:
+        """
+        add the states of the deltas, or snapshots, at the end of the line
+        """
+        if self._is_dense:
+            self.snapshots.extend(edges)
+            return
+        start = len(self)
+        for delta in edges:
+            self._append_delta(delta)
+        for index in range(start, len(self)):
+            if self._is_keyframe(index):
+                data = self._materialize(index)
+                self.keyframes[index] = data
+                self._row_nbytes += _nbytes(data)
+
+    def _edge_nbytes(self, edge) -> int:
+        if self._is_dense:
+            # its blocks are still counted by the chunk store
+            return len(edge.keys) * _KEY_NBYTES
+        return edge.nbytes
+
+    def _release_edge(self, edge) -> None:
+        if self._is_dense:
+            self.chunk_store.release(edge)
+        elif self.spill_store is not None:
+            edge.release(self.spill_store)
+
+    def _append_delta(self, delta: Delta) -> None:
+        self.deltas.append(delta)
+        self._row_nbytes += delta.nbytes
+
+    def _release_delta(self, delta: Delta) -> None:
+        self._row_nbytes -= delta.nbytes
+        if self.spill_store is not None:
+            delta.release(self.spill_store)
+
+    def _release_data(self, data: LayerData) -> None:
+        self._row_nbytes -= _nbytes(data)
+        if self.spill_store is not None:
+            release_data(self.spill_store, data)
+
+    def _spill_cold(self) -> None:
+        """
+        write the steps older than the `hot_steps` most recent ones to disk
+        """
+        if self.hot_steps is None or len(self) <= self.hot_steps:
+            return
+        if self.spill_store is None:
+            self.spill_store = SpillStore(self.spill_directory)
+        cold = len(self) - self.hot_steps
+
+        if self._is_dense:
+            hot_keys = set()
+            for chunked in self.snapshots[cold:]:
+                hot_keys.update(chunked.keys)
+            cold_keys = set()
+            for chunked in self.snapshots[:cold]:
+                cold_keys.update(chunked.keys)
+            self.chunk_store.spill(cold_keys - hot_keys, self.spill_store)
+            return
+
+        if not is_spilled(self.base.data):
+            self._row_nbytes -= _nbytes(self.base.data)
+            (self.base.data,) = spill_data(self.spill_store, [self.base.data])
+            if self._cursor_index == 0:
+                self._cursor_data = load_data(self.base.data)
+        for delta in self.deltas[: cold - 1]:
+            if not delta.spilled:
+                self._row_nbytes -= delta.nbytes
+                delta.spill(self.spill_store)
+                # its indices stay in memory
+                self._row_nbytes += delta.nbytes
+        for index, data in self.keyframes.items():
+            if index < cold and not is_spilled(data):
+                self._row_nbytes -= _nbytes(data)
+                (self.keyframes[index],) = spill_data(self.spill_store, [data])
+
+    def _compress(self) -> None:
+        """
+        compress the base and the delta before the most recent one,
+        the steps that were spilled stay on disk
+        """
+        if self.compression is None or self._is_dense or len(self) < 2:
+            return
+        data = self.base.data
+        if not is_spilled(data) and not is_compressed(data):
+            self._row_nbytes -= _nbytes(data)
+            self.base.data = compress_data(self.compression, data)
+            self._row_nbytes += _nbytes(self.base.data)
+        for delta in self.deltas[-2:-1]:
+            if not delta.spilled and not delta.compressed:
+                self._row_nbytes -= delta.nbytes
+                delta.compress(self.compression)
+                self._row_nbytes += delta.nbytes
+        for index, data in self.keyframes.items():
+            # the keyframe of the most recent state is also the cursor
+            if index < len(self) - 1 and not (
+                is_spilled(data) or is_compressed(data)
+            ):
+                self._row_nbytes -= _nbytes(data)
+                self.keyframes[index] = compress_data(self.compression, data)
+                self._row_nbytes += _nbytes(self.keyframes[index])
+
+    def _is_keyframe(self, index: int) -> bool:
+        """
+        whether the new state at `index` is a keyframe: a state
+        keyframe_interval states after the previous keyframe or the base,
+        which stays true when states are evicted
+        """
+        if not self.keyframe_interval:
+            return False
+        previous = max(self.keyframes, default=0)
+        return index - previous >= self.keyframe_interval
+
+    def _drop_keyframes(self, start: int, stop: int) -> None:
+        """
+        forget the keyframes of the states [start, stop) that are removed,
+        the keyframes of the following states move back with them
+        """
+        if not self.keyframes:
+            return
+        keyframes = {}
+        for index, data in self.keyframes.items():
+            if start <= index < stop:
+                self._release_data(data)
+            else:
+                keyframes[index - (stop - start) * (index >= stop)] = data
+        self.keyframes = keyframes
+
+    def _closest_keyframe(self, index: int) -> int:
+        """
+        returns the index of the keyframe closest to `index`, 0 (the base)
+        if there is none closer
+        """
+        if not self.keyframes:
+            return 0
+        keys = sorted(self.keyframes)
+        i = bisect_left(keys, index)
+        closest = min(
+            keys[max(i - 1, 0) : i + 1], key=lambda k: abs(k - index)
+        )
+        return closest if abs(closest - index) < index else 0
+
+    def _materialize(self, index: int) -> LayerData:
+        """
+        rebuild the data of the state at `index`, starting from the
+        base, the closest keyframe or the cursor, whichever is closer,
+        and move the cursor
+        """
+        keyframe = self._closest_keyframe(index)
+        if abs(index - self._cursor_index) <= abs(index - keyframe):
+            position, data = self._cursor_index, self._cursor_data
+        elif keyframe:
+            position, data = keyframe, load_data(self.keyframes[keyframe])
+        else:
+            position, data = 0, load_data(self.base.data)
+
+        while position < index:
+            data = self.deltas[position].apply(data)
+            position += 1
+        while position > index:
+            position -= 1
+            data = self.deltas[position].revert(data)
+
+        self._cursor_index, self._cursor_data = index, data
+        return data
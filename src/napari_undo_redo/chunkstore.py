@@ -0,0 +1,196 @@
+"""
+Content-addressed storage for the dense arrays of Image and Labels layers.
+
+Consecutive snapshots of a large image or label volume are nearly identical:
+a paint stroke only touches a few blocks of the array. The ChunkStore splits
+every array into fixed-size blocks, keys each block by the hash of its bytes,
+and stores a block only once, no matter how many snapshots contain it.
+A snapshot is then only a ChunkedArray, ie: the list of its block keys.
+
+Blocks that are only used by old snapshots can be spilled to disk,
+and blocks can be kept compressed in memory.
+"""
+
+import hashlib
+from typing import Dict, Iterable, Optional, Tuple, Union
+
+import numpy as np
+
+from .compress import Codec, CompressedArray
+from .spill import SpilledArray, SpillStore
+
+# default size of a block, in bytes
+DEFAULT_CHUNK_BYTES = 64 * 1024
+
+
+class ChunkedArray:
+    """
+    Reference to an array stored in a ChunkStore
+    """
+
+    __slots__ = ("shape", "dtype", "keys")
+
+    def __init__(
+        self, shape: Tuple[int, ...], dtype: np.dtype, keys: Tuple[bytes, ...]
+    ) -> None:
+        """
+        Args:
+            shape: shape of the stored array
+            dtype: dtype of the stored array
+            keys: hashes of the blocks of the array, in order
+        """
+        self.shape = shape
+        self.dtype = dtype
+        self.keys = keys
+
+    @property
+    def nbytes(self) -> int:
+        """
+        number of bytes of the array once restored
+        """
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+
+class ChunkStore:
+    """
+    Reference counted collection of unique blocks of array data
+    """
+
+    def __init__(
+        self,
+        chunk_bytes: int = DEFAULT_CHUNK_BYTES,
+        compression: Optional[Codec] = None,
+    ) -> None:
+        """
+        Args:
+            chunk_bytes: size of a block in bytes
+            compression: compresses the blocks kept in memory
+        """
+        self.chunk_bytes = chunk_bytes
+        self.compression = compression
+        self.chunks: Dict[
+            bytes, Union[bytes, SpilledArray, CompressedArray]
+        ] = {}
+        self.refcounts: Dict[bytes, int] = {}
+        # number of bytes held in memory by the unique blocks
+        self.nbytes = 0
+        # where spilled blocks are written, see spill()
+        self.spill_store: Optional[SpillStore] = None
+
+    def __len__(self) -> int:
+        """
+        returns the number of unique blocks stored
+        """
+        return len(self.chunks)
+
+    def put(self, data: np.ndarray) -> ChunkedArray:
+        """
+        store an array, only copying the blocks that are not stored yet
+
+        Args:
+            data: array to store
+        """
+        data = np.ascontiguousarray(data)
+        raw = memoryview(data.reshape(-1).view(np.uint8))
+        keys = []
+        for start in range(0, len(raw), self.chunk_bytes):
+            block = raw[start : start + self.chunk_bytes]
+            key = hashlib.blake2b(block, digest_size=16).digest()
+            if key in self.chunks:
+                self.refcounts[key] += 1
+            else:
+                stored = self._compress(block, data.dtype)
+                self.chunks[key] = stored
+                self.refcounts[key] = 1
+                self.nbytes += _stored_nbytes(stored)
+            keys.append(key)
+        return ChunkedArray(data.shape, data.dtype, tuple(keys))
+
+    def get(self, chunked: ChunkedArray) -> np.ndarray:
+        """
+        returns a new writable array with the content of `chunked`
+
+        Args:
+            chunked: reference returned by put()
+        """
+        data = np.empty(chunked.shape, dtype=chunked.dtype)
+        raw = data.reshape(-1).view(np.uint8)
+        start = 0
+        for key in chunked.keys:
+            block = self.chunks[key]
+            if isinstance(block, (SpilledArray, CompressedArray)):
+                block = block.load().reshape(-1).view(np.uint8)
+            else:
+                block = np.frombuffer(block, np.uint8)
+            raw[start : start + block.size] = block
+            start += block.size
+        return data
+
+    def spill(self, keys: Iterable[bytes], store: SpillStore) -> None:
+        """
+        move blocks from memory to disk, they are paged back in by get()
+
+        Args:
+            keys: keys of the blocks to spill
+            store: SpillStore to write to
+        """
+        self.spill_store = store
+        keys = [
+            key
+            for key in keys
+            if not isinstance(self.chunks[key], SpilledArray)
+        ]
+        if not keys:
+            return
+        stored = [self.chunks[key] for key in keys]
+        blocks = [
+            (
+                block.load(cache=False).reshape(-1).view(np.uint8)
+                if isinstance(block, CompressedArray)
+                else np.frombuffer(block, np.uint8)
+            )
+            for block in stored
+        ]
+        for key, block, spilled in zip(keys, stored, store.write(blocks)):
+            self.chunks[key] = spilled
+            self.nbytes -= _stored_nbytes(block)
+
+    def release(self, chunked: ChunkedArray) -> None:
+        """
+        drop a reference returned by put(),
+        blocks that are not referenced anymore are freed
+
+        Args:
+            chunked: reference returned by put()
+        """
+        for key in chunked.keys:
+            self.refcounts[key] -= 1
+            if self.refcounts[key] == 0:
+                del self.refcounts[key]
+                block = self.chunks.pop(key)
+                if isinstance(block, SpilledArray):
+                    self.spill_store.release(block)
+                else:
+                    self.nbytes -= _stored_nbytes(block)
+
+    def _compress(
+        self, block: memoryview, dtype: np.dtype
+    ) -> Union[bytes, CompressedArray]:
+        """
+        returns what is stored for a block: its bytes, or the block
+        compressed as elements of `dtype` if that is smaller
+        """
+        if self.compression is None:
+            return block.tobytes()
+        if dtype.hasobject or len(block) % dtype.itemsize:
+            dtype = np.dtype(np.uint8)
+        compressed = self.compression.compress(np.frombuffer(block, dtype))
+        if isinstance(compressed, CompressedArray):
+            return compressed
+        return block.tobytes()
+
+
+def _stored_nbytes(block: Union[bytes, CompressedArray]) -> int:
+    if isinstance(block, CompressedArray):
+        return block.nbytes
+    return len(block)
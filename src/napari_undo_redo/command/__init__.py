@@ -0,0 +1,42 @@
+from .add import AddCommand
+from .base import Command
+from .columns import ColumnsCommand, infer_columns_command
+from .composite import CompositeCommand
+from .delete import DeleteCommand
+from .infer import infer_command
+from .manager import CommandManager
+from .move import MoveCommand
+from .paint import PaintCommand
+from .registry import HistoryRegistry
+from .replay import replay
+from .shapes import (
+    AddShapesCommand,
+    DeleteShapesCommand,
+    EditShapesCommand,
+    ShapesData,
+    TransformShapesCommand,
+    infer_shapes_command,
+    shapes_data,
+)
+
+__all__ = [
+    "AddCommand",
+    "AddShapesCommand",
+    "ColumnsCommand",
+    "Command",
+    "CommandManager",
+    "CompositeCommand",
+    "DeleteCommand",
+    "DeleteShapesCommand",
+    "EditShapesCommand",
+    "HistoryRegistry",
+    "MoveCommand",
+    "PaintCommand",
+    "ShapesData",
+    "TransformShapesCommand",
+    "infer_columns_command",
+    "infer_command",
+    "infer_shapes_command",
+    "replay",
+    "shapes_data",
+]
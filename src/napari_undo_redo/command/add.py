@@ -1,13 +1,37 @@
-from typing import List
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, List, Optional
 
 import numpy as np
-from base import Command
-from napari.layers import Layer
+
+from ..compress import Payload, payload_nbytes
+from ..delta import insert_rows
+from .base import Command
+from .columns import (
+    Columns,
+    columns_nbytes,
+    delete_column_rows,
+    insert_column_rows,
+    set_data,
+    take_rows,
+)
+from .delete import DeleteCommand
+
+if TYPE_CHECKING:
+    from napari.layers import Layer
 
 
 class AddCommand(Command):
+    fusable = True
+    payloads = ("data",)
+    data = Payload()
+
     def __init__(
-        self, layer: Layer, indices: List[int], data: np.ndarray
+        self,
+        layer: Layer,
+        indices: List[int],
+        data: np.ndarray,
+        columns: Optional[Columns] = None,
     ) -> None:
         """
         Initialize the AddCommand instance
@@ -16,11 +40,14 @@ class AddCommand(Command):
             layer: napari layer for which we want to undo/redo add operation
             data: list of points that we're added
             indices: indices of added points
+            columns: properties and features of the added points,
+                see command.columns
         """
         super().__init__()
         self.layer = layer
         self.indices = indices
         self.data = data
+        self.columns = columns
 
     def __eq__(self, __o: Command) -> bool:
         """
@@ -42,20 +69,104 @@ class AddCommand(Command):
             np.array_equal(self.data, __o.data)
         )
 
+    @property
+    def nbytes(self) -> int:
+        return (
+            np.asarray(self.indices).nbytes
+            + payload_nbytes(self, "data")
+            + columns_nbytes(self.columns)
+        )
+
+    def merge(self, other: Command) -> Optional[Command]:
+        """
+        Back-to-back adds become a single add of the rows of both.
+        The indices of this command are shifted by the rows that
+        `other` inserted before them.
+        """
+        if not isinstance(other, AddCommand) or other.layer is not self.layer:
+            return None
+        if (self.columns or {}).keys() != (other.columns or {}).keys():
+            return None
+        inserted = np.sort(np.asarray(other.indices, dtype=np.intp))
+        # number of rows before each inserted row, in the data before other
+        rows_before = inserted - np.arange(len(inserted))
+        indices = np.asarray(self.indices, dtype=np.intp)
+        indices = indices + np.searchsorted(rows_before, indices, side="right")
+        order = np.argsort(other.indices, kind="stable")
+        columns = None
+        if self.columns is not None:
+            columns = {
+                name: np.concatenate([values, other.columns[name][order]])
+                for name, values in self.columns.items()
+            }
+        return AddCommand(
+            self.layer,
+            np.concatenate([indices, inserted]).tolist(),
+            np.concatenate(
+                [np.asarray(self.data), np.asarray(other.data)[order]]
+            ),
+            columns,
+        )
+
+    def cancels(self, other: Command) -> bool:
+        """
+        deleting the rows that were just added cancels the add
+        """
+        if (
+            not isinstance(other, DeleteCommand)
+            or other.layer is not self.layer
+        ):
+            return False
+        return _same_rows(self.indices, self.data, other.indices, other.data)
+
     def undo(self):
         """
         For an Add command, undo implements delete
         This will involve removing the point that was added before the undo
         """
-        # axis 0 for deleting row-wisefrom 2D array
-        print(self.indices)
-        self.layer.data = np.delete(self.layer.data, self.indices, 0)
+        set_data(self.layer, self, undo=True)
 
     def redo(self):
         """
         redo should simply add data
         """
-        for i in range(len(self.indices)):
-            self.layer.data = np.insert(
-                self.layer.data, self.indices[i], self.data[i], 0
-            )
+        set_data(self.layer, self, undo=False)
+
+    def undo_data(self, data: np.ndarray) -> np.ndarray:
+        # axis 0 for deleting row-wisefrom 2D array
+        return np.delete(data, self.indices, 0)
+
+    def redo_data(self, data: np.ndarray) -> np.ndarray:
+        # all the rows are inserted at once, so that the layer data
+        # is reassigned (and napari refreshes) a single time
+        return insert_rows(data, self.indices, self.data)
+
+    def column_names(self) -> List[str]:
+        return list(self.columns or ())
+
+    def capture_columns(self, prev: Columns, new: Columns) -> None:
+        self.columns = take_rows(new, self.indices)
+
+    def undo_columns(self, columns: Columns) -> Columns:
+        return delete_column_rows(columns, self.indices)
+
+    def redo_columns(self, columns: Columns) -> Columns:
+        return insert_column_rows(columns, self.indices, self.columns or {})
+
+
+def _same_rows(indices, data, other_indices, other_data) -> bool:
+    """
+    returns True if both commands hold the same rows at the same indices,
+    in whatever order they were given
+    """
+    indices = np.asarray(indices, dtype=np.intp)
+    other_indices = np.asarray(other_indices, dtype=np.intp)
+    if indices.shape != other_indices.shape:
+        return False
+    order = np.argsort(indices)
+    other_order = np.argsort(other_indices)
+    return np.array_equal(
+        indices[order], other_indices[other_order]
+    ) and np.array_equal(
+        np.asarray(data)[order], np.asarray(other_data)[other_order]
+    )
@@ -6,13 +6,99 @@ eg: Having AddShapeCommand, DeleteShapeCommand...
 """
 
 from abc import ABC, abstractmethod
+from typing import List, Optional, Tuple
+
+from ..compress import Codec, compress_payloads
 
 
 class Command(ABC):
+    # True if the command can also be undone/redone on a bare array of rows
+    # with undo_data/redo_data, so that a CompositeCommand can apply
+    # many commands with a single update of the layer
+    fusable = False
+    # names of the array attributes (compress.Payload) that compress()
+    # may store compressed
+    payloads: Tuple[str, ...] = ()
+
     @abstractmethod
     def undo(self):
         pass
 
+    def undo_data(self, data):
+        """
+        returns the layer data with the command undone.
+        `data` is a private copy, it can be modified in place.
+        """
+        raise NotImplementedError
+
+    def redo_data(self, data):
+        """
+        returns the layer data with the command redone.
+        `data` is a private copy, it can be modified in place.
+        """
+        raise NotImplementedError
+
+    def column_names(self) -> List[str]:
+        """
+        returns the names of the columns (per-row properties and features,
+        see command.columns) changed by the command besides the layer data
+        """
+        return []
+
+    def capture_columns(self, prev: dict, new: dict) -> None:
+        """
+        keep the values of the rows the command adds or deletes,
+        for every column
+
+        Args:
+            prev: columns of the layer before the command
+            new: columns of the layer after the command
+        """
+
+    def undo_columns(self, columns: dict) -> dict:
+        """
+        returns the columns with the command undone, like undo_data.
+        `columns` are private copies, they can be modified in place.
+        """
+        return columns
+
+    def redo_columns(self, columns: dict) -> dict:
+        """
+        returns the columns with the command redone, like redo_data.
+        `columns` are private copies, they can be modified in place.
+        """
+        return columns
+
+    @property
+    def nbytes(self) -> int:
+        """
+        approximate number of bytes held by this command,
+        used by the CommandManager to stay within its memory budget
+        """
+        return 0
+
     @abstractmethod
     def redo(self):
         pass
+
+    def compress(self, codec: Codec) -> None:
+        """
+        store the payloads of the command compressed,
+        they are decompressed when they are read
+        """
+        compress_payloads(self, codec)
+
+    def merge(self, other: "Command") -> Optional["Command"]:
+        """
+        returns a single command doing this command then `other`,
+        or None if they can't be merged.
+        It is called when `other` was just done, right after this command.
+        """
+        return None
+
+    def cancels(self, other: "Command") -> bool:
+        """
+        returns True if doing this command then `other`
+        leaves the layer as it was before this command
+        """
+        return False
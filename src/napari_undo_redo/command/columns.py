@@ -0,0 +1,416 @@
+"""
+History of the per-row properties of Points and Shapes layers.
+
+Besides their data, these layers hold one value per point or shape for
+visual properties (size, colors, ...) and for every column of their
+features table. They are handled as columns: one typed array per property,
+named after the layer attribute, or "features.<name>" for a feature.
+
+    - ColumnsCommand: rows of some columns that were edited,
+      the values before and after the edit
+    - the commands adding or deleting rows also hold the values of
+      these rows for every column (see Command.capture_columns),
+      so that undoing a delete gives back their colors and features
+
+Only the rows that changed are stored, the features table is never copied
+as a whole to save an edit, nor written as a whole to undo one.
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from ..delta import insert_rows, read_only, writable
+from ..layer_types import layer_type
+from .base import Command
+
+if TYPE_CHECKING:
+    from napari.layers import Layer
+
+Columns = Dict[str, np.ndarray]
+
+FEATURES_PREFIX = "features."
+
+# per-row visual properties, each has an event of the same name
+ROW_PROPERTIES = {
+    "Points": ("size", "face_color", "border_color"),
+    "Shapes": ("edge_width", "edge_color", "face_color"),
+}
+# per-row values without an event, only kept with the rows that are
+# added or deleted
+ROW_VALUES = {
+    "Shapes": ("z_index",),
+}
+# events changing the visual properties of the selected rows,
+# without emitting the event of the property itself
+CURRENT_PROPERTY_EVENTS = {
+    "Points": ("current_size", "current_face_color", "current_border_color"),
+    "Shapes": (),
+}
+
+
+def property_events(layer: Layer) -> List[str]:
+    """
+    returns the names of the events emitted when the columns of a layer
+    change, empty if the layer has no per-row properties
+    """
+    kind = layer_type(layer)
+    if kind not in ROW_PROPERTIES:
+        return []
+    return [*ROW_PROPERTIES[kind], *CURRENT_PROPERTY_EVENTS[kind], "features"]
+
+
+def column_names(layer: Layer, event_type: Optional[str] = None) -> List[str]:
+    """
+    returns the names of the columns of a layer
+
+    Args:
+        layer: napari Points or Shapes layer
+        event_type: only the columns this event may have changed,
+            the visual properties or the features
+    """
+    names = []
+    if event_type != "features":
+        names.extend(ROW_PROPERTIES.get(layer_type(layer), ()))
+    if event_type is None:
+        names.extend(ROW_VALUES.get(layer_type(layer), ()))
+    if event_type is None or event_type == "features":
+        names.extend(FEATURES_PREFIX + str(c) for c in layer.features.columns)
+    return names
+
+
+def read_columns(
+    layer: Layer, names: Optional[Sequence[str]] = None, copy: bool = True
+) -> Columns:
+    """
+    returns the columns of a layer, see column_names
+
+    Args:
+        layer: napari Points or Shapes layer
+        names: columns to read, defaults to all of them
+        copy: copy the values, read-only views of the arrays of
+            the layer are returned otherwise
+    """
+    if names is None:
+        names = column_names(layer)
+    columns = {}
+    for name in names:
+        if name.startswith(FEATURES_PREFIX):
+            feature = name[len(FEATURES_PREFIX) :]
+            if feature not in layer.features.columns:
+                continue
+            values = layer.features[feature].to_numpy(copy=copy)
+        else:
+            values = np.asarray(getattr(layer, name))
+        columns[name] = np.array(values) if copy else read_only(values)
+    return columns
+
+
+def write_columns(layer: Layer, columns: Columns) -> None:
+    """
+    set whole columns of a layer, eg: after rows were inserted or deleted
+
+    Args:
+        layer: napari Points or Shapes layer
+        columns: one value per row of the layer for each column
+    """
+    features = {}
+    for name, values in columns.items():
+        if name.startswith(FEATURES_PREFIX):
+            features[name[len(FEATURES_PREFIX) :]] = (slice(None), values)
+        else:
+            _set_property(layer, name, values)
+    _write_features(layer, features)
+
+
+def write_changed_rows(layer: Layer, columns: Columns) -> None:
+    """
+    set whole columns of a layer, only writing the rows that differ
+    from the layer, eg: the rows after the first inserted or deleted one
+
+    Args:
+        layer: napari Points or Shapes layer
+        columns: one value per row of the layer for each column
+    """
+    current = read_columns(layer, list(columns), copy=False)
+    whole, indices, values = {}, {}, {}
+    for name, new in columns.items():
+        old = current.get(name)
+        if old is None:
+            continue
+        if len(old) != len(new):
+            whole[name] = new
+            continue
+        rows = _changed_rows(old, new)
+        if rows.size:
+            indices[name] = rows
+            values[name] = new[rows]
+    write_columns(layer, whole)
+    write_rows(layer, indices, values)
+
+
+def write_rows(
+    layer: Layer,
+    indices: Dict[str, np.ndarray],
+    values: Columns,
+) -> None:
+    """
+    set some rows of some columns of a layer, each property is set
+    (and napari notified) once
+
+    Args:
+        layer: napari Points or Shapes layer
+        indices: rows of each column to set
+        values: values of these rows, for each column
+    """
+    features = {}
+    for name, rows in values.items():
+        if name.startswith(FEATURES_PREFIX):
+            features[name[len(FEATURES_PREFIX) :]] = (indices[name], rows)
+            continue
+        column = np.array(getattr(layer, name))
+        if len(column) == 0:
+            continue
+        column[indices[name]] = rows
+        _set_property(layer, name, column)
+    _write_features(layer, features)
+
+
+def set_data(layer: Layer, cmd: Command, undo: bool) -> None:
+    """
+    set the layer data with a command undone or redone, then the columns
+    of the command: napari only trims or pads the columns at the end
+    when the number of rows changes
+
+    Args:
+        layer: napari Points layer
+        cmd: command adding or deleting rows
+        undo: undo the command, redo it otherwise
+    """
+    names = cmd.column_names()
+    # the commands only copy the columns they write in place
+    columns = read_columns(layer, names, copy=False) if names else {}
+    if undo:
+        layer.data = cmd.undo_data(layer.data)
+    else:
+        layer.data = cmd.redo_data(layer.data)
+    if columns:
+        if undo:
+            write_changed_rows(layer, cmd.undo_columns(columns))
+        else:
+            write_changed_rows(layer, cmd.redo_columns(columns))
+
+
+def take_rows(columns: Optional[Columns], indices: Sequence[int]) -> Columns:
+    """
+    returns a copy of the given rows of every column
+    """
+    if not columns:
+        return {}
+    indices = np.asarray(indices, dtype=np.intp)
+    return {name: values[indices] for name, values in columns.items()}
+
+
+def insert_column_rows(
+    columns: Columns, indices: Sequence[int], rows: Columns
+) -> Columns:
+    """
+    returns the columns with rows inserted at `indices`, see insert_rows.
+    Columns without rows to insert are dropped, they can't be aligned.
+    """
+    return {
+        name: insert_rows(values, indices, rows[name])
+        for name, values in columns.items()
+        if name in rows
+    }
+
+
+def delete_column_rows(columns: Columns, indices: Sequence[int]) -> Columns:
+    """
+    returns the columns without the rows at `indices`
+    """
+    indices = np.asarray(indices, dtype=np.intp)
+    return {
+        name: np.delete(values, indices, 0) for name, values in columns.items()
+    }
+
+
+def columns_nbytes(columns: Optional[Columns]) -> int:
+    if not columns:
+        return 0
+    return sum(values.nbytes for values in columns.values())
+
+
+class ColumnsCommand(Command):
+    # the layer data is left as it is, see undo_columns/redo_columns
+    fusable = True
+
+    def __init__(
+        self,
+        layer: Layer,
+        indices: Dict[str, np.ndarray],
+        prev_values: Columns,
+        new_values: Columns,
+    ) -> None:
+        """
+        Args:
+            layer: napari Points or Shapes layer
+            indices: edited rows of each column
+            prev_values: values of the edited rows before the edit
+            new_values: values of the edited rows after the edit
+        """
+        super().__init__()
+        self.layer = layer
+        self.indices = {
+            name: np.asarray(rows, dtype=np.intp)
+            for name, rows in indices.items()
+        }
+        self.prev_values = dict(prev_values)
+        self.new_values = dict(new_values)
+
+    def __eq__(self, __o: Command) -> bool:
+        if not isinstance(__o, ColumnsCommand):
+            return False
+        return self.indices.keys() == __o.indices.keys() and all(
+            np.array_equal(rows, __o.indices[name])
+            and _same_values(self.prev_values[name], __o.prev_values[name])
+            and _same_values(self.new_values[name], __o.new_values[name])
+            for name, rows in self.indices.items()
+        )
+
+    @property
+    def nbytes(self) -> int:
+        return (
+            sum(rows.nbytes for rows in self.indices.values())
+            + columns_nbytes(self.prev_values)
+            + columns_nbytes(self.new_values)
+        )
+
+    def merge(self, other: Command) -> Optional[Command]:
+        """
+        Consecutive edits of the same rows of the same columns,
+        eg: while a size slider is dragged, become a single edit
+        """
+        if (
+            not isinstance(other, ColumnsCommand)
+            or other.layer is not self.layer
+            or self.indices.keys() != other.indices.keys()
+            or not all(
+                np.array_equal(rows, other.indices[name])
+                for name, rows in self.indices.items()
+            )
+        ):
+            return None
+        return ColumnsCommand(
+            self.layer, self.indices, self.prev_values, other.new_values
+        )
+
+    def column_names(self) -> List[str]:
+        return list(self.indices)
+
+    def undo(self):
+        write_rows(self.layer, self.indices, self.prev_values)
+
+    def redo(self):
+        write_rows(self.layer, self.indices, self.new_values)
+
+    def undo_data(self, data):
+        return data
+
+    def redo_data(self, data):
+        return data
+
+    def undo_columns(self, columns: Columns) -> Columns:
+        return self._set_rows(columns, self.prev_values)
+
+    def redo_columns(self, columns: Columns) -> Columns:
+        return self._set_rows(columns, self.new_values)
+
+    def _set_rows(self, columns: Columns, values: Columns) -> Columns:
+        for name, rows in values.items():
+            if name in columns:
+                columns[name] = writable(columns[name])
+                columns[name][self.indices[name]] = rows
+        return columns
+
+
+def infer_columns_command(
+    layer: Layer, prev: Columns, new: Columns
+) -> Optional[ColumnsCommand]:
+    """
+    returns the command turning the columns `prev` into `new`,
+    or None if no row changed.
+    Only the columns of `new` are compared, they must have as many rows
+    as the ones of `prev`.
+
+    Args:
+        layer: napari layer the command applies to
+        prev: columns before the edit
+        new: columns after the edit
+    """
+    indices, prev_values, new_values = {}, {}, {}
+    for name, values in new.items():
+        old = prev.get(name)
+        if old is None or len(old) != len(values):
+            continue
+        rows = _changed_rows(old, values)
+        if rows.size:
+            indices[name] = rows
+            prev_values[name] = old[rows]
+            new_values[name] = np.array(values[rows])
+    if not indices:
+        return None
+    return ColumnsCommand(layer, indices, prev_values, new_values)
+
+
+def _changed_rows(prev: np.ndarray, new: np.ndarray) -> np.ndarray:
+    """
+    returns the indices of the rows that differ, vectorized.
+    Missing values (nan, None, ...) are equal to each other.
+    """
+    if prev.dtype.hasobject or new.dtype.hasobject:
+        # eg: strings, missing values can't be compared with ==
+        import pandas as pd
+
+        prev_missing, new_missing = pd.isna(prev), pd.isna(new)
+        different = prev_missing != new_missing
+        both = ~(prev_missing | new_missing)
+        different[both] = prev[both] != new[both]
+    else:
+        different = prev != new
+        if np.issubdtype(new.dtype, np.floating):
+            different &= ~(np.isnan(prev) & np.isnan(new))
+    if different.ndim > 1:
+        different = different.reshape(len(new), -1).any(axis=1)
+    return np.flatnonzero(different)
+
+
+def _same_values(a: np.ndarray, b: np.ndarray) -> bool:
+    return len(a) == len(b) and not _changed_rows(a, b).size
+
+
+def _set_property(layer: Layer, name: str, values: np.ndarray) -> None:
+    if name in ("edge_width", "z_index") and layer_type(layer) == "Shapes":
+        # the setters of Shapes only take a list or a single value
+        values = np.asarray(values).tolist()
+    setattr(layer, name, values)
+
+
+def _write_features(layer: Layer, features: dict) -> None:
+    """
+    write rows of the features table in place, then notify napari once
+
+    Args:
+        layer: napari Points or Shapes layer
+        features: name -> (rows, values) of the features to write
+    """
+    if not features:
+        return
+    table = layer.features
+    for name, (rows, values) in features.items():
+        if name not in table.columns or len(table) == 0:
+            continue
+        table.iloc[rows, table.columns.get_loc(name)] = values
+    layer.events.features()
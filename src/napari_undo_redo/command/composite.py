@@ -0,0 +1,143 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, List, Optional
+
+import numpy as np
+
+from ..compress import Codec
+from ..delta import read_only
+from .base import Command
+from .columns import read_columns, write_changed_rows
+from .paint import PaintCommand
+
+if TYPE_CHECKING:
+    from napari.layers import Layer
+
+
+class CompositeCommand(Command):
+    def __init__(self, commands: List[Command]) -> None:
+        """
+        Initialize the CompositeCommand instance
+
+        Args:
+            commands: commands undone and redone together as a single step,
+                in the order they were done
+
+        When all the commands apply to the same layer, their changes are
+        fused: the layer data is rewritten (and napari notified) only once
+        per undo/redo, no matter how many commands there are.
+        """
+        super().__init__()
+        self.commands = list(commands)
+
+    def __eq__(self, __o: Command) -> bool:
+        if not isinstance(__o, CompositeCommand):
+            return False
+
+        return self.commands == __o.commands
+
+    @property
+    def layer(self) -> Optional[Layer]:
+        """
+        the layer of all the commands, None if they don't share one
+        """
+        layers = {id(getattr(cmd, "layer", None)) for cmd in self.commands}
+        if len(layers) != 1 or not self.commands:
+            return None
+        return self.commands[0].layer
+
+    @property
+    def fusable(self) -> bool:
+        return all(cmd.fusable for cmd in self.commands)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(cmd.nbytes for cmd in self.commands)
+
+    def compress(self, codec: Codec) -> None:
+        for cmd in self.commands:
+            cmd.compress(codec)
+
+    def undo(self):
+        """
+        undo the commands from the last one to the first one
+        """
+        if not self._fused(undo=True):
+            for cmd in reversed(self.commands):
+                cmd.undo()
+
+    def redo(self):
+        if not self._fused(undo=False):
+            for cmd in self.commands:
+                cmd.redo()
+
+    def undo_data(self, data: np.ndarray) -> np.ndarray:
+        for cmd in reversed(self.commands):
+            data = cmd.undo_data(data)
+        return data
+
+    def redo_data(self, data: np.ndarray) -> np.ndarray:
+        for cmd in self.commands:
+            data = cmd.redo_data(data)
+        return data
+
+    def column_names(self) -> List[str]:
+        names = {}
+        for cmd in self.commands:
+            names.update(dict.fromkeys(cmd.column_names()))
+        return list(names)
+
+    def capture_columns(self, prev: dict, new: dict) -> None:
+        for cmd in self.commands:
+            cmd.capture_columns(prev, new)
+
+    def undo_columns(self, columns: dict) -> dict:
+        for cmd in reversed(self.commands):
+            columns = cmd.undo_columns(columns)
+        return columns
+
+    def redo_columns(self, columns: dict) -> dict:
+        for cmd in self.commands:
+            columns = cmd.redo_columns(columns)
+        return columns
+
+    def _fused(self, undo: bool) -> bool:
+        """
+        apply all the commands with a single update of their layer
+
+        Returns:
+            False if the commands can't be fused
+        """
+        layer = self.layer
+        if layer is None:
+            return False
+
+        if all(isinstance(cmd, PaintCommand) for cmd in self.commands):
+            # a single scatter of the voxels painted by any of the commands
+            cmd = PaintCommand.combine(self.commands)
+            if cmd is not None and undo:
+                cmd.undo()
+            elif cmd is not None:
+                cmd.redo()
+            return True
+
+        if self.fusable and isinstance(layer.data, np.ndarray):
+            # the commands get read-only views of the data and columns,
+            # copied by the first command writing them in place. The layer
+            # data is replaced once, then only the rows of the columns
+            # that changed are written
+            names = self.column_names()
+            columns = read_columns(layer, names, copy=False) if names else {}
+            data = read_only(layer.data)
+            if undo:
+                new_data = self.undo_data(data)
+                columns = self.undo_columns(columns)
+            else:
+                new_data = self.redo_data(data)
+                columns = self.redo_columns(columns)
+            if new_data is not data:
+                layer.data = new_data
+            if columns:
+                write_changed_rows(layer, columns)
+            return True
+        return False
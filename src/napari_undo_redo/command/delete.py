@@ -1,18 +1,50 @@
-from typing import List
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, List, Optional
 
 import numpy as np
-from base import Command
-from napari.layers import Layer
+
+from ..compress import Payload, payload_nbytes
+from ..delta import insert_rows
+from .base import Command
+from .columns import (
+    Columns,
+    columns_nbytes,
+    delete_column_rows,
+    insert_column_rows,
+    set_data,
+    take_rows,
+)
+
+if TYPE_CHECKING:
+    from napari.layers import Layer
 
 
 class DeleteCommand(Command):
+    fusable = True
+    payloads = ("data",)
+    data = Payload()
+
     def __init__(
-        self, layer: Layer, indices: List[int], data: np.ndarray
+        self,
+        layer: Layer,
+        indices: List[int],
+        data: np.ndarray,
+        columns: Optional[Columns] = None,
     ) -> None:
+        """
+        Args:
+            layer: napari layer the points are deleted from
+            indices: indices of the deleted points
+            data: the deleted points
+            columns: properties and features of the deleted points,
+                see command.columns
+        """
         super().__init__()
         self.layer = layer
         self.indices = indices
         self.data = data
+        self.columns = columns
 
     def __eq__(self, __o: Command) -> bool:
         if not isinstance(__o, DeleteCommand):
@@ -22,14 +54,19 @@ class DeleteCommand(Command):
             np.array_equal(self.data, __o.data)
         )
 
+    @property
+    def nbytes(self) -> int:
+        return (
+            np.asarray(self.indices).nbytes
+            + payload_nbytes(self, "data")
+            + columns_nbytes(self.columns)
+        )
+
     def undo(self):
         """
         Undo of DeleteCommand should be an add operation
         """
-        for i in range(len(self.indices)):
-            self.layer.data = np.insert(
-                self.layer.data, self.indices[i], self.data[i], 0
-            )
+        set_data(self.layer, self, undo=True)
 
     def redo(self):
         """
@@ -37,5 +74,25 @@ class DeleteCommand(Command):
         This will involve removing the point that
         was added back because of the undo
         """
+        set_data(self.layer, self, undo=False)
+
+    def undo_data(self, data: np.ndarray) -> np.ndarray:
+        # all the rows are inserted at once, so that the layer data
+        # is reassigned (and napari refreshes) a single time
+        return insert_rows(data, self.indices, self.data)
+
+    def redo_data(self, data: np.ndarray) -> np.ndarray:
         # axis 0 for deleting row-wisefrom 2D array
-        self.layer.data = np.delete(self.layer.data, self.indices, 0)
+        return np.delete(data, self.indices, 0)
+
+    def column_names(self) -> List[str]:
+        return list(self.columns or ())
+
+    def capture_columns(self, prev: Columns, new: Columns) -> None:
+        self.columns = take_rows(prev, self.indices)
+
+    def undo_columns(self, columns: Columns) -> Columns:
+        return insert_column_rows(columns, self.indices, self.columns or {})
+
+    def redo_columns(self, columns: Columns) -> Columns:
+        return delete_column_rows(columns, self.indices)
@@ -0,0 +1,79 @@
+"""
+Build the command of an edit from the layer data before and after it.
+
+napari only tells us that the data of a layer changed, not what the user did.
+infer_command diffs the two arrays of rows with compute_delta, which matches
+rows with vectorized comparisons, and turns the result into the smallest
+command that replays the edit:
+
+    - rows changed in place: MoveCommand
+    - rows removed: DeleteCommand
+    - rows added: AddCommand
+    - anything else: DeleteCommand + AddCommand of the rows in between
+      the unchanged rows, grouped in a CompositeCommand
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Optional
+
+import numpy as np
+
+from ..delta import compute_delta
+from .add import AddCommand
+from .base import Command
+from .composite import CompositeCommand
+from .delete import DeleteCommand
+from .move import MoveCommand
+
+if TYPE_CHECKING:
+    from napari.layers import Layer
+
+
+def infer_command(
+    layer: Layer, prev: np.ndarray, new: np.ndarray
+) -> Optional[Command]:
+    """
+    returns the command turning `prev` into `new`,
+    or None if the data did not change
+
+    Args:
+        layer: napari layer the command applies to
+        prev: array of rows of the layer before the edit
+        new: array of rows of the layer after the edit
+    """
+    delta = compute_delta(prev, new)
+    if delta.is_empty():
+        return None
+
+    if delta.replaced is not None:
+        # different dtype, every row is replaced
+        return CompositeCommand(
+            [
+                DeleteCommand(layer, list(range(len(prev))), np.array(prev)),
+                AddCommand(layer, list(range(len(new))), np.array(new)),
+            ]
+        )
+
+    commands = []
+    if delta.changed_indices.size:
+        commands.append(
+            MoveCommand(
+                layer, delta.changed_indices, delta.old_rows, delta.new_rows
+            )
+        )
+    if delta.deleted_indices.size:
+        commands.append(
+            DeleteCommand(
+                layer, delta.deleted_indices.tolist(), delta.deleted_rows
+            )
+        )
+    if delta.inserted_indices.size:
+        commands.append(
+            AddCommand(
+                layer, delta.inserted_indices.tolist(), delta.inserted_rows
+            )
+        )
+    if len(commands) == 1:
+        return commands[0]
+    return CompositeCommand(commands)
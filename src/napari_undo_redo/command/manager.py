@@ -1,13 +1,23 @@
-from collections import deque
+from __future__ import annotations
 
-from napari.layers import Layer
+import os
+from collections import deque
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Iterator, List, Optional
 
+from napari_undo_redo import journal as _journal
+from napari_undo_redo._my_logger import logger
 from napari_undo_redo.command.add import AddCommand
 from napari_undo_redo.command.base import Command
+from napari_undo_redo.command.composite import CompositeCommand
 from napari_undo_redo.command.delete import DeleteCommand
 from napari_undo_redo.command.move import MoveCommand
+from napari_undo_redo.compress import Codec
+from napari_undo_redo.fingerprint import data_signature
+from napari_undo_redo.tree import Branch, HistoryTree
 
-# from _my_logger import logger
+if TYPE_CHECKING:
+    from napari.layers import Layer
 
 
 class CommandManager:
@@ -15,38 +25,451 @@ class CommandManager:
     It has internal stacks that keeps track of our commands for our:
     1. undo functionality
     2. redo functionality
+
+    The stacks can be given a budget (max_bytes and/or max_steps),
+    the oldest commands of the undo stack are dropped to stay within it.
+
+    A pushed command is merged into the command on top of the undo stack
+    when possible (see Command.merge and Command.cancels), so that
+    fine-grained editing doesn't pile up thousands of tiny commands.
+
+    With `undo_tree`, the commands that could be redone when a new command
+    is pushed are kept as a branch of a HistoryTree instead of being
+    dropped, see switch_branch. Branches are pruned, least recently
+    visited first, before the oldest commands when over max_bytes.
     """
 
-    def __init__(self, layer: Layer = None) -> None:
+    def __init__(
+        self,
+        layer: Layer = None,
+        max_bytes: Optional[int] = None,
+        max_steps: Optional[int] = None,
+        merge: bool = True,
+        journal: Optional["_journal.Journal"] = None,
+        compression: Optional[Codec] = None,
+        undo_tree: bool = False,
+    ) -> None:
         """
         Initialize the undo and redo stacks for a napari layer
+
+        Args:
+            layer: napari layer the commands apply to
+            max_bytes: maximum number of bytes held by both stacks
+            max_steps: maximum number of commands in the undo stack
+            merge: merge pushed commands into the top of the undo stack
+            journal: log of every change of the stacks, see load_journal
+            compression: compresses the payloads of the commands
+                below the top of the undo stack
+            undo_tree: keep the undone commands as a branch when
+                a new command is pushed
         """
         self.layer = layer
         self.undo_stack = deque()
         self.redo_stack = deque()
-        print(f"layer id: {id(self.layer)}")
+        self.max_bytes = max_bytes
+        self.max_steps = max_steps
+        self.merge = merge
+        # branches of the history, the stacks hold its line
+        self.tree: Optional[HistoryTree] = None
+        if undo_tree:
+            self.tree = HistoryTree(lambda cmd: cmd.nbytes)
+        # running total of the bytes held by both stacks and the branches
+        self.nbytes = 0
+        # commands pushed during the current transaction, see transaction()
+        self._transaction: Optional[List[Command]] = None
+        self.committed_steps = 0
+        self.journal = journal
+        self.compression = compression
+        logger.debug(f"layer id: {id(self.layer)}")
 
     def set_layer(self, layer: Layer) -> None:
         self.layer = layer
 
-    def add_command_to_undo_stack(self, cmd: Command) -> None:
-        # compare and if unequal then append
-        if not self.undo_stack or cmd != self.undo_stack[-1]:
-            self.undo_stack.append(cmd)
+    @property
+    def in_transaction(self) -> bool:
+        return self._transaction is not None
+
+    @contextmanager
+    def transaction(self, merge: bool = True) -> Iterator["CommandManager"]:
+        """
+        Group all the commands pushed inside the `with` block
+        into a single CompositeCommand, ie: a single undo step.
+        Nested transactions are part of the outermost one.
+        The change of the number of undo steps is left in
+        `committed_steps`, see add_command_to_undo_stack.
+
+        Args:
+            merge: try to merge the transaction into the top of the stack
+
+        eg:
+            with manager.transaction():
+                for cmd in commands:
+                    manager.add_command_to_undo_stack(cmd)
+        """
+        if self.in_transaction:
+            yield self
+            return
+        self._transaction = []
+        try:
+            yield self
+        finally:
+            # the commands were done on the layer,
+            # so they are pushed even if the block raised
+            commands, self._transaction = self._transaction, None
+            self.committed_steps = 0
+            if len(commands) == 1:
+                self.committed_steps = self.add_command_to_undo_stack(
+                    commands[0], merge
+                )
+            elif commands:
+                self.committed_steps = self.add_command_to_undo_stack(
+                    CompositeCommand(commands), merge
+                )
+
+    def add_command_to_undo_stack(
+        self, cmd: Command, merge: bool = True
+    ) -> int:
+        """
+        push a command that was just done on the layer
+
+        Args:
+            cmd: Command
+            merge: try to merge it into the command on top of the stack
+
+        Returns:
+            change of the number of undo steps: 1 if the command was pushed,
+            0 if it was merged (or refused), -1 if it cancelled the top one
+        """
+        if self.in_transaction:
+            return self._push(self._transaction, cmd, merge)
+        # the same command object can't be pushed twice, but two equal
+        # commands are two edits (eg: moving points twice by the same offset)
+        if self.undo_stack and cmd is self.undo_stack[-1]:
+            logger.debug("Cannot add same commands to undo stack...")
+            return 0
+        # a new command makes the undone commands obsolete
+        self.clear_redo()
+        steps = self._push(self.undo_stack, cmd, merge)
+        self._enforce_budget()
+        return steps
+
+    def extend(self, commands: List[Command]) -> None:
+        """
+        push commands that were already done on the layer, eg: by
+        command.replay, one undo step each, without merging them
+
+        Args:
+            commands: commands in the order they were done
+        """
+        self.clear_redo()
+        for cmd in commands:
+            self._push(self.undo_stack, cmd, merge=False)
+        self._enforce_budget()
+
+    def _push(self, stack, cmd: Command, merge: bool) -> int:
+        """
+        push or merge the command on top of the stack (undo stack
+        or transaction), and keep the byte count of the undo stack
+        """
+        counted = stack is self.undo_stack
+        if counted and self._forks_at(len(stack)):
+            # the branches forking from the top state need it unchanged
+            merge = False
+        if stack and merge and self.merge:
+            top = stack[-1]
+            if top.cancels(cmd):
+                stack.pop()
+                if counted:
+                    self.nbytes -= top.nbytes
+                    self._log(_journal.POP)
+                return -1
+            merged = top.merge(cmd)
+            if merged is not None:
+                stack[-1] = merged
+                if counted:
+                    self.nbytes += merged.nbytes - top.nbytes
+                    self._log(_journal.REPLACE, merged)
+                return 0
+        if counted and stack and self.compression is not None:
+            # the top command is the one merged into or undone next,
+            # it is only compressed once another command covers it
+            top = stack[-1]
+            self.nbytes -= top.nbytes
+            top.compress(self.compression)
+            self.nbytes += top.nbytes
+        stack.append(cmd)
+        if counted:
+            self.nbytes += cmd.nbytes
+            self._log(_journal.APPEND, cmd)
+        return 1
+
+    def load_journal(self, path: str, **kwargs) -> None:
+        """
+        Rebuild the stacks from the journal of a previous session,
+        then keep appending to it. The layer must hold the data it had
+        at the end of that session: the journal of other data (eg: of
+        another layer with the same name) is left as it is, and the
+        history isn't journaled.
+
+        Args:
+            path: log file of the journal, created if needed
+            kwargs: passed to Journal
+        """
+        self.close_journal()
+        if os.path.exists(path):
+            try:
+                stacks = _journal.read_journal(
+                    path, self.layer, self.layer.data
+                )
+            except ValueError as e:
+                logger.warning(f"journal not loaded: {e}")
+                return
+            self.undo_stack, self.redo_stack = stacks
+            if self.tree is not None:
+                # they forked from the previous stacks
+                self.tree.clear()
+        self.nbytes = sum(
+            cmd.nbytes for cmd in self.undo_stack + self.redo_stack
+        )
+        self.journal = _journal.Journal(path, **kwargs)
+        # the next session won't have to replay this one again
+        self._checkpoint(digest=True)
+
+    def close_journal(self) -> None:
+        """
+        sign the data the history ends with and close the journal, if any
+        """
+        if self.journal is None:
+            return
+        if not self.journal.closed:
+            self.journal.sign(data_signature(self.layer.data))
+            self.journal.close()
+        self.journal = None
+
+    def _checkpoint(self, digest: bool = False) -> None:
+        """
+        log the whole stacks and the signature of the layer data,
+        only its shape and dtype unless `digest`
+        """
+        self.journal.checkpoint(self.undo_stack, self.redo_stack)
+        self.journal.sign(data_signature(self.layer.data, digest))
+
+    def _log(self, kind: int, cmd: Optional[Command] = None) -> None:
+        """
+        append a change of the stacks to the journal, if any
+        """
+        if self.journal is None:
+            return
+        try:
+            self.journal.append(kind, cmd)
+        except TypeError as e:
+            # the history can't be rebuilt without this command
+            logger.warning(f"journal stopped: {e}")
+            self.journal.close()
+            self.journal = None
+            return
+        if self.journal.checkpoint_due(
+            len(self.undo_stack) + len(self.redo_stack)
+        ):
+            self._checkpoint()
+
+    def clear(self) -> None:
+        """
+        drop every command, eg: when the layer data was replaced and they
+        can't be applied to it anymore. The journal starts over from the
+        new data.
+        """
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        if self.tree is not None:
+            self.tree.clear()
+        self.nbytes = 0
+        if self.journal is not None and not self.journal.closed:
+            self._checkpoint(digest=True)
+
+    def clear_redo(self) -> None:
+        """
+        drop the undone commands, they can't be redone anymore,
+        or keep them as a branch with undo_tree
+        """
+        if not self.redo_stack:
+            return
+        if self.tree is not None:
+            # their bytes are still held, by the tree
+            self.tree.stash(self.position, list(reversed(self.redo_stack)))
+            self.redo_stack.clear()
+        while self.redo_stack:
+            self.nbytes -= self.redo_stack.pop().nbytes
+        self._log(_journal.CLEAR_REDO)
+
+    @property
+    def branches(self) -> List[Branch]:
+        """
+        the branches of the history, empty without undo_tree
+        """
+        return list(self.tree) if self.tree is not None else []
+
+    def switch_branch(
+        self, branch: Branch, steps: Optional[int] = None
+    ) -> None:
+        """
+        Go to a state of a branch: its commands become the line of the
+        history, and the commands they replace a branch. Only the
+        commands between the current state and the target are undone,
+        then redone, each way as one fused update, see go_to.
+
+        Args:
+            branch: one of `branches`
+            steps: number of commands of the branch done at the end,
+                defaults to all of them
+        """
+        if steps is None:
+            steps = len(branch)
+        target = branch.fork_depth + min(max(steps, 0), len(branch))
+        # undo to the last state shared with the branch
+        top = branch
+        while top.parent is not None:
+            top = top.parent
+        self.go_to(min(self.position, top.fork))
+
+        def detach(fork: int) -> List[Command]:
+            line = list(reversed(self.redo_stack))
+            keep = fork - self.position
+            self.redo_stack = deque(reversed(line[:keep]))
+            return line[keep:]
+
+        def attach(commands: List[Command]) -> None:
+            # the end of the line is the bottom of the redo stack
+            self.redo_stack.extendleft(commands)
+
+        self.tree.switch(branch, detach, attach)
+        self.go_to(target)
+        if self.journal is not None:
+            # the journal only keeps the line
+            self._checkpoint()
+
+    def _forks_at(self, position: int) -> bool:
+        return self.tree is not None and any(
+            branch.fork == position for branch in self.tree.branches
+        )
+
+    def footprint(self) -> dict:
+        """
+        returns a summary of what the stacks currently hold
+        """
+        return {
+            "undo_steps": len(self.undo_stack),
+            "redo_steps": len(self.redo_stack),
+            "nbytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "max_steps": self.max_steps,
+        }
+
+    def set_budget(
+        self, max_bytes: Optional[int] = None, max_steps: Optional[int] = None
+    ) -> None:
+        """
+        change the budget of the stacks,
+        and drop the oldest commands right away if needed
+
+        Args:
+            max_bytes: maximum number of bytes held by both stacks
+            max_steps: maximum number of commands in the undo stack
+        """
+        self.max_bytes = max_bytes
+        self.max_steps = max_steps
+        self._enforce_budget()
+
+    def _enforce_budget(self) -> None:
+        """
+        drop the oldest undoable commands until the stacks fit the budget.
+        The commands left still undo correctly since they are applied
+        from the most recent one backwards.
+        Over max_bytes, the coldest branches are pruned first.
+        """
+        while self.max_bytes is not None and self.nbytes > self.max_bytes:
+            freed = self.tree.prune_coldest() if self.tree is not None else 0
+            if not freed:
+                break
+            self.nbytes -= freed
+        while self.undo_stack and (
+            (
+                self.max_steps is not None
+                and len(self.undo_stack) > self.max_steps
+            )
+            or (self.max_bytes is not None and self.nbytes > self.max_bytes)
+        ):
+            self.nbytes -= self.undo_stack.popleft().nbytes
+            if self.tree is not None:
+                # the branches forking from the dropped state go with it
+                self.nbytes -= self.tree.remove_states(0, 1)
+            self._log(_journal.EVICT)
+
+    @property
+    def position(self) -> int:
+        """
+        position in the history: the number of commands done
+        """
+        return len(self.undo_stack)
+
+    @property
+    def last_position(self) -> int:
+        """
+        position once every command is redone
+        """
+        return len(self.undo_stack) + len(self.redo_stack)
+
+    def go_to(self, position: int) -> int:
+        """
+        undo or redo as many commands as needed to reach a position of
+        the history, as a single CompositeCommand: their changes are
+        fused into one update of the layer when possible, eg: for Points
+        commands or paint commands
+
+        Args:
+            position: number of commands done at the end, clipped to
+                the history
+
+        Returns:
+            the number of commands undone (< 0) or redone (> 0)
+        """
+        position = min(max(position, 0), self.last_position)
+        steps = position - self.position
+        if steps < 0:
+            commands = [self.undo_stack.pop() for _ in range(-steps)]
+            self.redo_stack.extend(commands)
+            # in the order they were done
+            commands.reverse()
         else:
-            print("Cannot add same commands to undo stack...")
+            commands = [self.redo_stack.pop() for _ in range(steps)]
+            self.undo_stack.extend(commands)
+        if len(commands) == 1:
+            cmd = commands[0]
+        elif commands:
+            cmd = CompositeCommand(commands)
+        else:
+            return 0
+        if steps < 0:
+            cmd.undo()
+        else:
+            cmd.redo()
+        for _ in commands:
+            self._log(_journal.UNDO if steps < 0 else _journal.REDO)
+        return steps
 
     def undo(self) -> None:
         if self.undo_stack:
             cmd = self.undo_stack.pop()
             self.redo_stack.append(cmd)
             cmd.undo()
+            self._log(_journal.UNDO)
 
     def redo(self) -> None:
         if self.redo_stack:
             cmd = self.redo_stack.pop()
             self.undo_stack.append(cmd)
             cmd.redo()
+            self._log(_journal.REDO)
 
 
 def main():
@@ -1,11 +1,23 @@
-from typing import List
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, List, Optional
 
 import numpy as np
-from base import Command
-from napari.layers import Layer
+
+from ..compress import Payload, payload_nbytes
+from ..delta import writable
+from .base import Command
+
+if TYPE_CHECKING:
+    from napari.layers import Layer
 
 
 class MoveCommand(Command):
+    fusable = True
+    payloads = ("prev_coordinates", "new_coordinates")
+    prev_coordinates = Payload()
+    new_coordinates = Payload()
+
     def __init__(
         self,
         layer: Layer,
@@ -13,21 +25,90 @@ class MoveCommand(Command):
         prev_coordinates: np.ndarray,
         new_coordinates: np.ndarray,
     ) -> None:
+        """
+        Initialize the MoveCommand instance
+
+        Args:
+            layer: napari layer for which we want to undo/redo move operation
+            indices: indices of moved points
+            prev_coordinates: coordinates of the points before the move
+            new_coordinates: coordinates of the points after the move
 
+        If all the points were translated by the same offset,
+        only the offset is stored instead of both coordinate arrays.
+        """
         super().__init__()
         self.layer = layer
-        self.prev_coordinates = prev_coordinates
-        self.new_coordinates = new_coordinates
-        self.indices = indices
+        self.indices = np.asarray(indices, dtype=np.intp).reshape(-1)
+        self.prev_coordinates: Optional[np.ndarray] = np.asarray(
+            prev_coordinates
+        )
+        self.new_coordinates: Optional[np.ndarray] = np.asarray(
+            new_coordinates
+        )
+        self.offset: Optional[np.ndarray] = self._uniform_offset()
+        if self.offset is not None:
+            self.prev_coordinates = None
+            self.new_coordinates = None
+
+    def _uniform_offset(self) -> Optional[np.ndarray]:
+        """
+        returns the offset shared by all the moved points, or None.
+        The offset is only used if adding and subtracting it gives back
+        exactly the same coordinates, which isn't always the case for floats
+        """
+        if len(self.indices) < 2 or self.prev_coordinates.ndim != 2:
+            return None
+        offset = self.new_coordinates[0] - self.prev_coordinates[0]
+        if not np.array_equal(
+            self.prev_coordinates + offset, self.new_coordinates
+        ) or not np.array_equal(
+            self.new_coordinates - offset, self.prev_coordinates
+        ):
+            return None
+        return offset
 
     def __eq__(self, __o: Command) -> bool:
         if not isinstance(__o, MoveCommand):
             return False
 
+        if not np.array_equal(self.indices, __o.indices):
+            return False
+        if self.offset is not None or __o.offset is not None:
+            return self.offset is not None and (
+                np.array_equal(self.offset, __o.offset)
+            )
+        return np.array_equal(
+            self.prev_coordinates, __o.prev_coordinates
+        ) and np.array_equal(self.new_coordinates, __o.new_coordinates)
+
+    def merge(self, other: Command) -> Optional[Command]:
+        """
+        Consecutive moves of the same points become a single move,
+        from the coordinates before this move to the ones after `other`.
+        """
+        if (
+            not isinstance(other, MoveCommand)
+            or other.layer is not self.layer
+            or not np.array_equal(self.indices, other.indices)
+        ):
+            return None
+        # other was just done, the layer holds its new coordinates
+        new = other.new_coordinates
+        if new is None:
+            new = np.array(np.asarray(self.layer.data)[self.indices])
+        middle = other._prev_rows(new)
+        prev = self._prev_rows(middle)
+        return MoveCommand(self.layer, self.indices, prev, new)
+
+    @property
+    def nbytes(self) -> int:
+        if self.offset is not None:
+            return self.indices.nbytes + self.offset.nbytes
         return (
-            (self.indices == __o.indices)
-            and (np.array_equal(self.prev_coordinates, __o.prev_coordinates))
-            and (np.array_equal(self.new_coordinates, __o.new_coordinates))
+            self.indices.nbytes
+            + payload_nbytes(self, "prev_coordinates")
+            + payload_nbytes(self, "new_coordinates")
         )
 
     def undo(self):
@@ -35,9 +116,54 @@ class MoveCommand(Command):
         For undoing move, we need to set points to there previous coordinates
         using indices that changed
         """
-        for i in range(len(self.indices)):
-            self.layer.data[self.indices[i]] = self.prev_coordinates[i]
+        self._move(self._prev_rows)
 
     def redo(self):
-        for i in range(len(self.indices)):
-            self.layer.data[self.indices[i]] = self.new_coordinates[i]
+        self._move(self._new_rows)
+
+    def undo_data(self, data: np.ndarray) -> np.ndarray:
+        data = writable(data)
+        data[self.indices] = self._prev_rows(data[self.indices])
+        return data
+
+    def redo_data(self, data: np.ndarray) -> np.ndarray:
+        data = writable(data)
+        data[self.indices] = self._new_rows(data[self.indices])
+        return data
+
+    def _prev_rows(self, rows: np.ndarray) -> np.ndarray:
+        if self.offset is not None:
+            return rows - self.offset
+        return self.prev_coordinates
+
+    def _new_rows(self, rows: np.ndarray) -> np.ndarray:
+        if self.offset is not None:
+            return rows + self.offset
+        return self.new_coordinates
+
+    def _move(self, coordinates) -> None:
+        """
+        Write the coordinates of all the moved points in one shot,
+        then notify napari once, the same way napari does
+        when points are dragged.
+
+        Args:
+            coordinates: function giving the new coordinates
+                from the current coordinates of the moved points
+        """
+        data = self.layer.data
+        if not isinstance(data, np.ndarray):
+            # not an array of rows, the layer data has to be replaced
+            data = np.array(data)
+            data[self.indices] = coordinates(data[self.indices])
+            self.layer.data = data
+            return
+
+        data[self.indices] = coordinates(data[self.indices])
+        self.layer.refresh()
+        self.layer.events.data(
+            value=data,
+            action="changed",
+            data_indices=tuple(self.indices.tolist()),
+            vertex_indices=((),),
+        )
@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, List, Optional, Sequence
+
+import numpy as np
+
+from .._napari_compat import labels_setitem
+from ..compress import Payload, payload_nbytes
+from .base import Command
+
+if TYPE_CHECKING:
+    from napari.layers import Labels
+
+
+class PaintCommand(Command):
+    payloads = ("indices", "prev_values", "new_values")
+    indices = Payload()
+    prev_values = Payload()
+    new_values = Payload()
+
+    def __init__(
+        self,
+        layer: Labels,
+        indices: np.ndarray,
+        prev_values: np.ndarray,
+        new_values: np.ndarray,
+    ) -> None:
+        """
+        Initialize the PaintCommand instance
+
+        Only the voxels touched by a paint stroke are stored,
+        never a snapshot of the whole labels volume.
+
+        Args:
+            layer: napari Labels layer that was painted
+            indices: flat indices of the painted voxels in layer.data
+            prev_values: label of each voxel before painting
+            new_values: label of each voxel after painting
+        """
+        super().__init__()
+        self.layer = layer
+        # uint32 indices are enough for volumes up to 4 giga voxels
+        index_dtype = np.uint32 if layer.data.size < 2**32 else np.int64
+        self.indices = np.asarray(indices, dtype=index_dtype).reshape(-1)
+        dtype = layer.data.dtype
+        self.prev_values = np.asarray(prev_values, dtype=dtype).reshape(-1)
+        new_values = np.asarray(new_values, dtype=dtype).reshape(-1)
+        if new_values.size and (new_values == new_values[0]).all():
+            # a stroke usually paints a single label
+            new_values = new_values[:1]
+        self.new_values = new_values
+
+    @classmethod
+    def from_history_item(
+        cls, layer: Labels, item: Sequence
+    ) -> Optional["PaintCommand"]:
+        """
+        Create the command for one item of the napari labels history,
+        ie: the `value` of a `layer.events.paint` event
+
+        Args:
+            layer: napari Labels layer that was painted
+            item: list of history atoms, applied in order
+
+        Returns:
+            None if the item did not change any voxel
+        """
+        shape = layer.data.shape
+        indices, prev_values, new_values = [], [], []
+        for atom in item:
+            if hasattr(atom, "slice_key"):
+                # mask based edit of a bounding box
+                starts = [s.start or 0 for s in atom.slice_key]
+                stops = [
+                    s.stop if s.stop is not None else size
+                    for s, size in zip(atom.slice_key, shape)
+                ]
+                if atom.mask is None:
+                    box = tuple(
+                        np.arange(start, stop)
+                        for start, stop in zip(starts, stops)
+                    )
+                    coords = [
+                        c.ravel() for c in np.meshgrid(*box, indexing="ij")
+                    ]
+                else:
+                    coords = [
+                        c + start
+                        for c, start in zip(np.nonzero(atom.mask), starts)
+                    ]
+                old = np.asarray(atom.old_values).reshape(-1)
+                new = np.full(old.shape, atom.new_value)
+            else:
+                # (indices, values before, values after) of data_setitem
+                coords, old, new = atom
+                old = np.asarray(old).reshape(-1)
+                new = np.broadcast_to(new, old.shape)
+            indices.append(np.ravel_multi_index(tuple(coords), shape))
+            prev_values.append(old)
+            new_values.append(new)
+
+        if not indices:
+            return None
+        return cls._from_strokes(layer, indices, prev_values, new_values)
+
+    @classmethod
+    def combine(
+        cls, commands: List["PaintCommand"]
+    ) -> Optional["PaintCommand"]:
+        """
+        Create a single command doing all the given paint commands,
+        so that they are undone/redone with one write to the layer.
+
+        Args:
+            commands: paint commands of the same layer, in the order
+                they were done
+
+        Returns:
+            None if the commands cancel each other out
+        """
+        return cls._from_strokes(
+            commands[0].layer,
+            [cmd.indices for cmd in commands],
+            [cmd.prev_values for cmd in commands],
+            [
+                np.broadcast_to(cmd.new_values, cmd.prev_values.shape)
+                for cmd in commands
+            ],
+        )
+
+    @classmethod
+    def _from_strokes(
+        cls,
+        layer: Labels,
+        indices: List[np.ndarray],
+        prev_values: List[np.ndarray],
+        new_values: List[np.ndarray],
+    ) -> Optional["PaintCommand"]:
+        """
+        Create the command of consecutive strokes, given as lists of
+        (flat indices, values before, values after), one item per stroke
+        """
+        indices = np.concatenate(indices)
+        prev_values = np.concatenate(prev_values)
+        new_values = np.concatenate(new_values)
+
+        # a voxel painted several times keeps
+        # its first previous value and its last new value
+        unique, first = np.unique(indices, return_index=True)
+        _, last_reversed = np.unique(indices[::-1], return_index=True)
+        last = len(indices) - 1 - last_reversed
+        prev_values = prev_values[first]
+        new_values = new_values[last]
+
+        changed = prev_values != new_values
+        if not changed.any():
+            return None
+        return cls(
+            layer, unique[changed], prev_values[changed], new_values[changed]
+        )
+
+    def __eq__(self, __o: Command) -> bool:
+        if not isinstance(__o, PaintCommand):
+            return False
+
+        return (
+            np.array_equal(self.indices, __o.indices)
+            and np.array_equal(self.prev_values, __o.prev_values)
+            and np.array_equal(self.new_values, __o.new_values)
+        )
+
+    @property
+    def nbytes(self) -> int:
+        return sum(payload_nbytes(self, name) for name in self.payloads)
+
+    def undo(self):
+        """
+        scatter the previous labels back to the painted voxels
+        """
+        self._scatter(self.prev_values)
+
+    def redo(self):
+        """
+        scatter the painted labels to the voxels again
+        """
+        self._scatter(self.new_values)
+
+    def _scatter(self, values: np.ndarray) -> None:
+        """
+        Write the values in place, only refreshing the bounding box of the
+        written voxels on the current slice. The write isn't recorded in
+        napari's own labels history.
+        """
+        if len(values) == 1:
+            values = values[0].item()
+        coords = np.unravel_index(self.indices, self.layer.data.shape)
+        labels_setitem(self.layer, coords, values)
@@ -0,0 +1,353 @@
+from __future__ import annotations
+
+import os
+import re
+import weakref
+from collections import deque
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple
+
+from ..compress import Codec
+from ..tree import Branch
+from .base import Command
+from .manager import CommandManager
+
+if TYPE_CHECKING:
+    from napari.layers import Layer
+
+
+class HistoryRegistry:
+    """
+    One CommandManager per layer, created the first time a layer needs it.
+
+    Layers are weakly referenced keys, so a layer id reused by python after
+    garbage collection never picks up the history of a dead layer.
+    Commands keep a reference to their layer, so the history of a layer
+    removed from the viewer has to be dropped with remove().
+
+    With `global_timeline`, the registry also remembers in which layer each
+    command was pushed, so that undo/redo can walk back and forth through
+    the edits of all the layers in the order they were made.
+
+    With `journal_directory`, the history of every layer is also logged to
+    a journal file named after the layer, and reloaded from it when the
+    layer gets its history, eg: in the next session, if the layer holds
+    the data the journal ends with, see CommandManager.load_journal.
+
+    With `undo_tree`, the history of every layer keeps branches,
+    see CommandManager.switch_branch, unless the global timeline is used.
+    """
+
+    def __init__(
+        self,
+        max_bytes: Optional[int] = None,
+        max_steps: Optional[int] = None,
+        global_timeline: bool = False,
+        journal_directory: Optional[str] = None,
+        compression: Optional[Codec] = None,
+        undo_tree: bool = False,
+    ) -> None:
+        """
+        Args:
+            max_bytes: maximum number of bytes held by the history of a layer
+            max_steps: maximum number of commands in the history of a layer
+            global_timeline: keep the order of the commands across layers
+            journal_directory: where the journals of the layers are written,
+                None keeps the history in memory only
+            compression: compresses the payloads of the commands
+            undo_tree: keep the undone commands of a layer as a branch
+                when a new command is pushed to it
+        """
+        self.max_bytes = max_bytes
+        self.max_steps = max_steps
+        self.global_timeline = global_timeline
+        self.journal_directory = journal_directory
+        self.compression = compression
+        self.undo_tree = undo_tree
+        self.managers: "weakref.WeakKeyDictionary[Layer, CommandManager]" = (
+            weakref.WeakKeyDictionary()
+        )
+        # layers of the undoable and redoable commands, oldest first
+        self.undo_timeline = deque()
+        self.redo_timeline = deque()
+
+    def __len__(self) -> int:
+        """
+        returns the number of layers with a history
+        """
+        return len(self.managers)
+
+    def __contains__(self, layer: Optional[Layer]) -> bool:
+        return layer is not None and layer in self.managers
+
+    def get(self, layer: Layer) -> CommandManager:
+        """
+        returns the CommandManager of a layer, creating it if needed
+        """
+        manager = self.managers.get(layer)
+        if manager is None:
+            manager = CommandManager(
+                layer,
+                max_bytes=self.max_bytes,
+                max_steps=self.max_steps,
+                compression=self.compression,
+                # the global timeline only follows the line of every layer
+                undo_tree=self.undo_tree and not self.global_timeline,
+            )
+            if self.journal_directory is not None:
+                manager.load_journal(self.journal_path(layer))
+            self.managers[layer] = manager
+        return manager
+
+    def layer_nbytes(self) -> Dict[str, int]:
+        """
+        returns the bytes held by the history of each layer, by layer name
+        """
+        return {
+            layer.name: manager.nbytes
+            for layer, manager in list(self.managers.items())
+        }
+
+    def journal_path(self, layer: Layer) -> str:
+        """
+        returns the journal file of a layer
+        """
+        name = re.sub(r"[^\w.-]", "_", layer.name)
+        return os.path.join(self.journal_directory, f"{name}.journal")
+
+    def push(self, layer: Layer, cmd: Command, merge: bool = False) -> None:
+        """
+        add a command done on a layer to its history
+
+        Args:
+            layer: napari layer the command was done on
+            cmd: Command
+            merge: try to merge it into the last command of the layer,
+                only for commands of the same interaction (eg: a drag)
+        """
+        manager = self.get(layer)
+        steps = manager.add_command_to_undo_stack(
+            cmd, merge and self._can_merge(layer)
+        )
+        if not manager.in_transaction:
+            self._record(layer, steps)
+
+    def extend(self, layer: Layer, commands: List[Command]) -> None:
+        """
+        add commands already done on a layer to its history,
+        one undo step each, see CommandManager.extend
+        """
+        self.get(layer).extend(commands)
+        for _ in commands:
+            self._record(layer, 1)
+
+    @contextmanager
+    def transaction(
+        self, layer: Layer, merge: bool = False
+    ) -> Iterator[CommandManager]:
+        """
+        Group all the commands pushed to the layer inside the `with` block
+        into a single undo step, see CommandManager.transaction
+
+        Args:
+            layer: napari layer the commands are done on
+            merge: try to merge the step into the last command of the layer
+        """
+        manager = self.get(layer)
+        if manager.in_transaction:
+            yield manager
+            return
+        try:
+            with manager.transaction(merge and self._can_merge(layer)):
+                yield manager
+        finally:
+            self._record(layer, manager.committed_steps)
+
+    def _can_merge(self, layer: Layer) -> bool:
+        """
+        commands are only merged if they follow each other in the timeline,
+        otherwise undo would skip the edits of the layers in between
+        """
+        if not self.global_timeline:
+            return True
+        return bool(self.undo_timeline) and self.undo_timeline[-1]() is layer
+
+    def _record(self, layer: Layer, steps: int) -> None:
+        """
+        update the global timeline after a push to the layer
+
+        Args:
+            layer: napari layer the command was pushed to
+            steps: change of the number of undo steps of the layer
+        """
+        if not self.global_timeline:
+            return
+        # a new edit makes the undone edits of every layer obsolete
+        for ref in set(self.redo_timeline):
+            if ref() in self:
+                self.managers[ref()].clear_redo()
+        self.redo_timeline.clear()
+        if steps > 0:
+            self.undo_timeline.append(weakref.ref(layer))
+        elif steps < 0:
+            # the command cancelled the last one of the layer
+            self.undo_timeline.pop()
+
+    def clear(self, layer: Layer) -> None:
+        """
+        drop the commands of a layer but keep its history,
+        see CommandManager.clear
+        """
+        if layer not in self:
+            return
+        self.managers[layer].clear()
+        for timeline in (self.undo_timeline, self.redo_timeline):
+            kept = [ref for ref in timeline if ref() is not layer]
+            timeline.clear()
+            timeline.extend(kept)
+
+    def remove(self, layer: Layer) -> None:
+        """
+        drop the history of a layer, eg: when it is removed from the viewer.
+        Its entries in the global timeline are skipped from now on.
+        """
+        manager = self.managers.pop(layer, None)
+        if manager is not None:
+            manager.close_journal()
+
+    def close(self) -> None:
+        """
+        write and close the journals of all the layers
+        """
+        for manager in self.managers.values():
+            manager.close_journal()
+
+    def undo(self, layer: Optional[Layer] = None) -> Optional[Layer]:
+        """
+        undo the last command of `layer`, or, with the global timeline,
+        the last command of any layer
+
+        Returns:
+            the layer that was changed, None if there was nothing to undo
+        """
+        return self._step(layer, undo=True)
+
+    def redo(self, layer: Optional[Layer] = None) -> Optional[Layer]:
+        """
+        redo the last undone command of `layer`, or, with the global
+        timeline, the last undone command of any layer
+
+        Returns:
+            the layer that was changed, None if there was nothing to redo
+        """
+        return self._step(layer, undo=False)
+
+    def position(self, layer: Optional[Layer] = None) -> Tuple[int, int]:
+        """
+        returns the position in the history of `layer`, or, with the
+        global timeline, in the timeline, and the last position
+        """
+        if layer is not None and not self.global_timeline:
+            manager = self.get(layer)
+            return manager.position, manager.last_position
+        position = len(self.undo_timeline)
+        return position, position + len(self.redo_timeline)
+
+    def go_to(
+        self, position: int, layer: Optional[Layer] = None
+    ) -> List[Layer]:
+        """
+        undo or redo up to a position of the history of `layer`, or, with
+        the global timeline, of the timeline. The commands of different
+        layers don't depend on each other: all the commands of a layer are
+        undone or redone together, see CommandManager.go_to
+
+        Returns:
+            the layers that were changed
+        """
+        if layer is not None and not self.global_timeline:
+            return [layer] if self.get(layer).go_to(position) else []
+
+        undo = position < len(self.undo_timeline)
+        source, target = (
+            (self.undo_timeline, self.redo_timeline)
+            if undo
+            else (self.redo_timeline, self.undo_timeline)
+        )
+        steps = abs(position - len(self.undo_timeline))
+        # id of each layer -> [layer, number of commands]
+        counts = {}
+        # commands left in the stack of each layer
+        left = {}
+        while source and steps:
+            ref = source.pop()
+            layer = ref()
+            if layer not in self:
+                # removed layer
+                continue
+            manager = self.managers[layer]
+            stack = manager.undo_stack if undo else manager.redo_stack
+            left.setdefault(layer, len(stack))
+            if not left[layer]:
+                # its oldest commands were dropped to fit the budget
+                continue
+            left[layer] -= 1
+            target.append(ref)
+            steps -= 1
+            counts.setdefault(id(layer), [layer, 0])[1] += 1
+
+        for layer, count in counts.values():
+            manager = self.managers[layer]
+            manager.go_to(manager.position + (-count if undo else count))
+        return [layer for layer, _ in counts.values()]
+
+    def switch_branch(
+        self, layer: Layer, branch: Branch, steps: Optional[int] = None
+    ) -> None:
+        """
+        go to a state of a branch of the history of a layer,
+        see CommandManager.switch_branch
+        """
+        if self.global_timeline:
+            raise ValueError("the global timeline has no branches")
+        self.get(layer).switch_branch(branch, steps)
+
+    def _step(self, layer: Optional[Layer], undo: bool) -> Optional[Layer]:
+        if layer is not None and not self.global_timeline:
+            if not self._run(self.get(layer), undo):
+                return None
+            return layer
+
+        source, target = (
+            (self.undo_timeline, self.redo_timeline)
+            if undo
+            else (self.redo_timeline, self.undo_timeline)
+        )
+        while source:
+            ref = source.pop()
+            layer = ref()
+            if layer not in self:
+                # removed layer
+                continue
+            if not self._run(self.managers[layer], undo):
+                # its oldest commands were dropped to fit the budget
+                continue
+            target.append(ref)
+            return layer
+        return None
+
+    @staticmethod
+    def _run(manager: CommandManager, undo: bool) -> bool:
+        """
+        undo or redo one command of the manager,
+        returns False if there was none
+        """
+        if undo:
+            if not manager.undo_stack:
+                return False
+            manager.undo()
+        else:
+            if not manager.redo_stack:
+                return False
+            manager.redo()
+        return True
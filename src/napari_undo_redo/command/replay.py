@@ -0,0 +1,368 @@
+"""
+Replay of recorded Points commands, eg: to apply a curation session again
+to a new version of the data.
+
+Redoing the commands one at a time copies, and writes to the layer, the
+whole data at every step. replay() instead only follows where every row
+comes from:
+
+    - the order of the rows is kept in a RowIndex, a list of blocks of row
+      ids: adding or deleting rows only rewrites the blocks they fall in
+    - the coordinates of the added rows and of the moved rows are kept in
+      a pool, the original rows are never copied
+
+The data is then gathered once, from the original rows and the pool,
+and written to the target in a single assignment, with the columns
+(properties and features) of the rows for a napari layer.
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Iterable, List, Optional, Union
+
+import numpy as np
+
+from .add import AddCommand
+from .base import Command
+from .columns import Columns, read_columns, write_columns
+from .composite import CompositeCommand
+from .delete import DeleteCommand
+from .move import MoveCommand
+
+if TYPE_CHECKING:
+    from napari.layers import Layer
+
+    from .manager import CommandManager
+
+BLOCK_SIZE = 1024
+
+
+class RowIndex:
+    """
+    ids of the rows of an array, in order, kept as blocks of at most
+    2 * block_size ids: inserting or deleting a few rows only rewrites
+    the blocks they fall in, larger edits rebuild all the blocks
+    """
+
+    def __init__(self, ids: np.ndarray, block_size: int = BLOCK_SIZE):
+        self.block_size = block_size
+        self._split(np.asarray(ids, dtype=np.intp))
+
+    def __len__(self) -> int:
+        return int(self._bounds()[-1])
+
+    def to_array(self) -> np.ndarray:
+        return np.concatenate(self.blocks)
+
+    def get(self, positions: np.ndarray) -> np.ndarray:
+        """
+        returns the ids of the rows at `positions`
+        """
+        if len(positions) > len(self.blocks):
+            return self.to_array()[positions]
+        blocks, offsets = self._locate(positions)
+        return np.fromiter(
+            (
+                self.blocks[b][o]
+                for b, o in zip(blocks.tolist(), offsets.tolist())
+            ),
+            dtype=np.intp,
+            count=len(positions),
+        )
+
+    def delete(self, positions: np.ndarray) -> None:
+        """
+        delete the rows at `positions`, like np.delete
+        """
+        positions = np.unique(positions)
+        if len(positions) > len(self.blocks):
+            self._split(np.delete(self.to_array(), positions))
+            return
+        blocks, offsets = self._locate(positions)
+        emptied = []
+        for b, block_offsets in _groups(blocks, offsets):
+            self.blocks[b] = np.delete(self.blocks[b], block_offsets)
+            self.sizes[b] = len(self.blocks[b])
+            if not self.sizes[b]:
+                emptied.append(b)
+        if emptied and len(emptied) < len(self.blocks):
+            for b in reversed(emptied):
+                del self.blocks[b]
+            self.sizes = np.delete(self.sizes, emptied)
+        self._starts = None
+
+    def insert(self, positions: np.ndarray, ids: np.ndarray) -> None:
+        """
+        insert rows so that ids[i] ends up at positions[i],
+        like delta.insert_rows
+        """
+        order = np.argsort(positions, kind="stable")
+        ids = np.asarray(ids, dtype=np.intp)[order]
+        # position of each row in the current array, before the insertion
+        before = positions[order] - np.arange(len(order))
+        if len(before) > len(self.blocks):
+            self._split(np.insert(self.to_array(), before, ids))
+            return
+        blocks, offsets = self._locate(before)
+        start = 0
+        for b, block_offsets in _groups(blocks, offsets):
+            stop = start + len(block_offsets)
+            self.blocks[b] = np.insert(
+                self.blocks[b], block_offsets, ids[start:stop]
+            )
+            self.sizes[b] = len(self.blocks[b])
+            start = stop
+        self._starts = None
+        for b in np.flatnonzero(self.sizes > 2 * self.block_size)[::-1]:
+            # split the blocks that grew too large
+            halves = np.array_split(self.blocks[b], 2)
+            self.blocks[b : b + 1] = halves
+            self.sizes = np.insert(self.sizes, b + 1, len(halves[1]))
+            self.sizes[b] = len(halves[0])
+
+    def _split(self, ids: np.ndarray) -> None:
+        size = self.block_size
+        self.blocks = [ids[i : i + size] for i in range(0, len(ids), size)]
+        if not self.blocks:
+            self.blocks = [np.empty(0, dtype=np.intp)]
+        # number of ids of every block, kept up to date by delete/insert
+        self.sizes = np.array([len(block) for block in self.blocks])
+        self._starts = None
+
+    def _bounds(self) -> np.ndarray:
+        """
+        returns the position of the first row of every block,
+        then the number of rows
+        """
+        if self._starts is None:
+            self._starts = np.concatenate([[0], np.cumsum(self.sizes)])
+        return self._starts
+
+    def _locate(self, positions: np.ndarray):
+        """
+        returns the block of each position and the offset in that block,
+        the end of the array is located at the end of the last block
+        """
+        bounds = self._bounds()
+        blocks = np.searchsorted(bounds, positions, side="right") - 1
+        blocks = np.minimum(blocks, len(self.blocks) - 1)
+        return blocks, positions - bounds[blocks]
+
+
+class _Pool:
+    """
+    growing array of rows, appended in amortized constant time
+    """
+
+    def __init__(self, row_shape: tuple, dtype: np.dtype) -> None:
+        self.rows = np.empty((16, *row_shape), dtype=dtype)
+        self.size = 0
+
+    def append(self, rows: np.ndarray) -> np.ndarray:
+        """
+        returns the slots of the appended rows
+        """
+        stop = self.size + len(rows)
+        if stop > len(self.rows):
+            grown = np.empty(
+                (max(stop, 2 * len(self.rows)), *self.rows.shape[1:]),
+                dtype=self.rows.dtype,
+            )
+            grown[: self.size] = self.rows[: self.size]
+            self.rows = grown
+        self.rows[self.size : stop] = rows
+        slots = np.arange(self.size, stop)
+        self.size = stop
+        return slots
+
+
+class _Replay:
+    """
+    net effect of a stream of commands on rows of `base`, see replay.
+    Row ids below len(base) are the original rows, the others are added
+    rows, numbered in the order they were added.
+    """
+
+    def __init__(
+        self,
+        base: np.ndarray,
+        columns: Columns,
+        block_size: int,
+    ) -> None:
+        self.base = base
+        self.n = len(base)
+        self.rows = RowIndex(np.arange(self.n), block_size)
+        self.coordinates = _Pool(base.shape[1:], base.dtype)
+        # slot of the coordinates of every moved original row, -1 if none
+        self.moved = np.full(self.n, -1, dtype=np.intp)
+        # slot of the coordinates of every added row
+        self.added = _Pool((), np.intp)
+        # columns of the added rows, and whether their add recorded them
+        self.columns = columns
+        self.added_columns = {
+            name: _Pool(values.shape[1:], values.dtype)
+            for name, values in columns.items()
+        }
+        self.recorded = {name: _Pool((), bool) for name in columns}
+
+    def apply(self, cmd: Command) -> None:
+        if isinstance(cmd, AddCommand):
+            self._add(cmd)
+        elif isinstance(cmd, DeleteCommand):
+            self.rows.delete(_indices(cmd.indices))
+        elif isinstance(cmd, MoveCommand):
+            self._move(cmd)
+        else:
+            raise TypeError(f"Cannot replay {type(cmd).__name__} commands")
+
+    def _add(self, cmd: AddCommand) -> None:
+        data = np.asarray(cmd.data).reshape(-1, *self.base.shape[1:])
+        slots = self.coordinates.append(data)
+        ids = self.n + self.added.append(slots)
+        self.rows.insert(_indices(cmd.indices), ids)
+        recorded = cmd.columns or {}
+        for name, added in self.added_columns.items():
+            values = recorded.get(name)
+            if values is None:
+                values = np.empty((len(ids), *added.rows.shape[1:]))
+            added.append(values)
+            self.recorded[name].append(np.full(len(ids), name in recorded))
+
+    def _move(self, cmd: MoveCommand) -> None:
+        ids = self.rows.get(_indices(cmd.indices))
+        slots = self._slots(ids)
+        new = np.asarray(cmd._new_rows(self._coordinates(ids, slots)))
+        # original rows moved for the first time get a slot
+        first = slots < 0
+        if first.any():
+            self.moved[ids[first]] = self.coordinates.append(new[first])
+        self.coordinates.rows[slots[~first]] = new[~first]
+
+    def _slots(self, ids: np.ndarray) -> np.ndarray:
+        """
+        returns the slot of the coordinates of rows,
+        -1 for the original rows that were not moved
+        """
+        original = ids < self.n
+        slots = np.empty(len(ids), dtype=np.intp)
+        slots[original] = self.moved[ids[original]]
+        slots[~original] = self.added.rows[ids[~original] - self.n]
+        return slots
+
+    def _coordinates(
+        self, ids: np.ndarray, slots: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        """
+        returns the current coordinates of rows
+        """
+        if slots is None:
+            slots = self._slots(ids)
+        out = np.empty((len(ids), *self.base.shape[1:]), self.base.dtype)
+        in_pool = slots >= 0
+        out[~in_pool] = self.base[ids[~in_pool]]
+        out[in_pool] = self.coordinates.rows[slots[in_pool]]
+        return out
+
+    def data(self) -> np.ndarray:
+        return self._coordinates(self.rows.to_array())
+
+    def result_columns(self, defaults: Columns) -> Columns:
+        """
+        returns the columns of the rows after the commands
+
+        Args:
+            defaults: values of the added rows whose add didn't record
+                the column, eg: the ones napari gave them
+        """
+        ids = self.rows.to_array()
+        original = ids < self.n
+        added_ids = ids[~original] - self.n
+        result = {}
+        for name, added in self.added_columns.items():
+            values = self.columns[name]
+            column = defaults.get(name)
+            if column is None or len(column) != len(ids):
+                column = np.empty((len(ids), *values.shape[1:]), values.dtype)
+            column = np.array(column, dtype=values.dtype)
+            column[original] = values[ids[original]]
+            recorded = self.recorded[name].rows[added_ids]
+            rows = np.flatnonzero(~original)[recorded]
+            column[rows] = added.rows[added_ids[recorded]]
+            result[name] = column
+        return result
+
+
+def replay(
+    commands: Iterable[Command],
+    target: Union[np.ndarray, Layer],
+    manager: Optional[CommandManager] = None,
+    block_size: int = BLOCK_SIZE,
+) -> np.ndarray:
+    """
+    Apply a stream of recorded commands at once: their net effect is
+    computed on row ids, then written to the target in one assignment.
+
+    Args:
+        commands: AddCommand, DeleteCommand and MoveCommand, or
+            CompositeCommand of them, in the order they were done
+        target: array of rows (not modified), or napari Points layer
+            whose data, properties and features are updated once.
+            The commands are then bound to the layer.
+        manager: history of the layer, the commands are pushed to its
+            undo stack so that they can be undone one at a time
+        block_size: number of rows of the blocks of the RowIndex
+
+    Returns:
+        the rows after the commands
+    """
+    commands = list(commands)
+    layer = None if isinstance(target, np.ndarray) else target
+    if manager is not None and layer is None:
+        raise ValueError("a history can only be rebuilt for a layer")
+    base = np.asarray(target if layer is None else layer.data)
+    columns = read_columns(layer) if layer is not None else {}
+
+    replayed = _Replay(base, columns, block_size)
+    for cmd in _flatten(commands):
+        replayed.apply(cmd)
+    data = replayed.data()
+    if layer is None:
+        return data
+
+    # napari gives default values to the added rows, for the columns
+    # that weren't recorded
+    layer.data = data
+    if columns:
+        write_columns(
+            layer, replayed.result_columns(read_columns(layer, list(columns)))
+        )
+    for cmd in _flatten(commands):
+        cmd.layer = layer
+    if manager is not None:
+        manager.extend(commands)
+    return data
+
+
+def _flatten(commands: Iterable[Command]) -> List[Command]:
+    flat = []
+    for cmd in commands:
+        if isinstance(cmd, CompositeCommand):
+            flat.extend(_flatten(cmd.commands))
+        else:
+            flat.append(cmd)
+    return flat
+
+
+def _indices(indices) -> np.ndarray:
+    return np.asarray(indices, dtype=np.intp).reshape(-1)
+
+
+def _groups(blocks: np.ndarray, offsets: np.ndarray):
+    """
+    yields each block and its offsets, `blocks` is sorted
+    """
+    starts = np.flatnonzero(np.diff(blocks, prepend=-1))
+    for b, block_offsets in zip(
+        blocks[starts].tolist(), np.split(offsets, starts[1:])
+    ):
+        yield b, block_offsets
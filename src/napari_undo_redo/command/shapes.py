@@ -0,0 +1,676 @@
+"""
+Commands of Shapes layers, holding only the shapes that were edited.
+
+Assigning `layer.data` of a Shapes layer rebuilds, and triangulates again,
+every shape of the layer. These commands instead update the edited shapes
+only, through the same ShapeList calls napari uses when a shape is edited
+with the mouse:
+
+    - AddShapesCommand / DeleteShapesCommand: vertices and type of the
+      added or deleted shapes
+    - EditShapesCommand: vertices and type of the shapes before and after
+      an edit of their vertices (vertex added, removed or moved, ...)
+    - TransformShapesCommand: vertices of shapes that were moved, scaled or
+      rotated as a whole, or only the offset if they were all translated
+      by the same vector
+
+infer_shapes_command builds the command of an edit from the shapes before
+and after it, see ShapesData.
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, List, NamedTuple, Optional, Sequence
+
+import numpy as np
+
+from .._napari_compat import (
+    append_shapes,
+    edit_shapes,
+    insert_feature_rows,
+    new_shape,
+    pop_shapes,
+    shape_vertices,
+)
+from ..delta import _same_array, compute_delta
+from .base import Command
+from .columns import (
+    FEATURES_PREFIX,
+    Columns,
+    columns_nbytes,
+    delete_column_rows,
+    insert_column_rows,
+    take_rows,
+    write_rows,
+)
+from .composite import CompositeCommand
+
+if TYPE_CHECKING:
+    from napari.layers import Shapes
+
+
+class ShapesData(NamedTuple):
+    """
+    vertices and type of every shape of a Shapes layer
+    """
+
+    data: List[np.ndarray]
+    shape_types: List[str]
+
+
+def shapes_data(layer: Shapes, copy: bool = True) -> ShapesData:
+    """
+    returns the vertices and types of the shapes of a layer
+
+    Args:
+        layer: napari Shapes layer
+        copy: copy the vertices, napari modifies them in place
+            when shapes are moved
+    """
+    data = layer.data
+    if copy:
+        data = [np.array(vertices) for vertices in data]
+    return ShapesData(list(data), list(layer.shape_type))
+
+
+class _WholeShapesCommand(Command):
+    """
+    Base of the commands adding or deleting whole shapes
+    """
+
+    def __init__(
+        self,
+        layer: Shapes,
+        indices: Sequence[int],
+        data: List[np.ndarray],
+        shape_types: List[str],
+        columns: Optional[Columns] = None,
+    ) -> None:
+        """
+        Args:
+            layer: napari Shapes layer of the shapes
+            indices: indices of the shapes, where they are in the layer
+                after adding them / before deleting them
+            data: vertices of each shape
+            shape_types: type of each shape
+            columns: colors, edge widths, z indices and features of the
+                shapes, see command.columns
+        """
+        super().__init__()
+        self.layer = layer
+        self.indices = np.asarray(indices, dtype=np.intp).reshape(-1)
+        self.data = list(data)
+        self.shape_types = list(shape_types)
+        self.columns = columns
+
+    def __eq__(self, __o: Command) -> bool:
+        return type(__o) is type(self) and _same_shapes(
+            self.indices, self.data, __o.indices, __o.data
+        )
+
+    @property
+    def nbytes(self) -> int:
+        return (
+            self.indices.nbytes
+            + _shapes_nbytes(self.data)
+            + columns_nbytes(self.columns)
+        )
+
+    def column_names(self) -> List[str]:
+        return list(self.columns or ())
+
+    def _remove(self) -> None:
+        _remove_shapes(self.layer, self.indices)
+
+    def _insert(self) -> None:
+        _insert_shapes(
+            self.layer,
+            self.indices,
+            self.data,
+            self.shape_types,
+            self.columns,
+        )
+        # the shapes were inserted with their style, not their features
+        features = {
+            name: values
+            for name, values in (self.columns or {}).items()
+            if name.startswith(FEATURES_PREFIX)
+        }
+        if features:
+            write_rows(
+                self.layer, dict.fromkeys(features, self.indices), features
+            )
+
+    def _insert_columns(self, columns: Columns) -> Columns:
+        return insert_column_rows(columns, self.indices, self.columns or {})
+
+    def _delete_columns(self, columns: Columns) -> Columns:
+        return delete_column_rows(columns, self.indices)
+
+
+class AddShapesCommand(_WholeShapesCommand):
+    def cancels(self, other: Command) -> bool:
+        """
+        deleting the shapes that were just added cancels the add
+        """
+        return (
+            isinstance(other, DeleteShapesCommand)
+            and other.layer is self.layer
+            and _same_shapes(
+                self.indices, self.data, other.indices, other.data
+            )
+        )
+
+    def undo(self):
+        self._remove()
+
+    def redo(self):
+        self._insert()
+
+    def undo_data(self, shapes: ShapesData) -> ShapesData:
+        return _delete_items(shapes, self.indices)
+
+    def redo_data(self, shapes: ShapesData) -> ShapesData:
+        return _insert_items(shapes, self.indices, self.data, self.shape_types)
+
+    def capture_columns(self, prev: Columns, new: Columns) -> None:
+        self.columns = take_rows(new, self.indices)
+
+    def undo_columns(self, columns: Columns) -> Columns:
+        return self._delete_columns(columns)
+
+    def redo_columns(self, columns: Columns) -> Columns:
+        return self._insert_columns(columns)
+
+
+class DeleteShapesCommand(_WholeShapesCommand):
+    def cancels(self, other: Command) -> bool:
+        """
+        adding back the shapes that were just deleted cancels the delete
+        """
+        return (
+            isinstance(other, AddShapesCommand)
+            and other.layer is self.layer
+            and _same_shapes(
+                self.indices, self.data, other.indices, other.data
+            )
+        )
+
+    def undo(self):
+        self._insert()
+
+    def redo(self):
+        self._remove()
+
+    def undo_data(self, shapes: ShapesData) -> ShapesData:
+        return _insert_items(shapes, self.indices, self.data, self.shape_types)
+
+    def redo_data(self, shapes: ShapesData) -> ShapesData:
+        return _delete_items(shapes, self.indices)
+
+    def capture_columns(self, prev: Columns, new: Columns) -> None:
+        self.columns = take_rows(prev, self.indices)
+
+    def undo_columns(self, columns: Columns) -> Columns:
+        return self._insert_columns(columns)
+
+    def redo_columns(self, columns: Columns) -> Columns:
+        return self._delete_columns(columns)
+
+
+class EditShapesCommand(Command):
+    def __init__(
+        self,
+        layer: Shapes,
+        indices: Sequence[int],
+        prev_data: List[np.ndarray],
+        new_data: List[np.ndarray],
+        prev_types: List[str],
+        new_types: List[str],
+    ) -> None:
+        """
+        Args:
+            layer: napari Shapes layer of the edited shapes
+            indices: indices of the edited shapes
+            prev_data: vertices of each shape before the edit
+            new_data: vertices of each shape after the edit
+            prev_types: type of each shape before the edit
+            new_types: type of each shape after the edit,
+                eg: a rectangle becomes a polygon when a vertex is added
+        """
+        super().__init__()
+        self.layer = layer
+        self.indices = np.asarray(indices, dtype=np.intp).reshape(-1)
+        self.prev_data = list(prev_data)
+        self.new_data = list(new_data)
+        self.prev_types = list(prev_types)
+        self.new_types = list(new_types)
+
+    def __eq__(self, __o: Command) -> bool:
+        return (
+            isinstance(__o, EditShapesCommand)
+            and _same_shapes(
+                self.indices, self.prev_data, __o.indices, __o.prev_data
+            )
+            and _same_shapes(
+                self.indices, self.new_data, __o.indices, __o.new_data
+            )
+        )
+
+    @property
+    def nbytes(self) -> int:
+        return (
+            self.indices.nbytes
+            + _shapes_nbytes(self.prev_data)
+            + _shapes_nbytes(self.new_data)
+        )
+
+    def merge(self, other: Command) -> Optional[Command]:
+        """
+        Consecutive edits of the same shapes become a single edit
+        """
+        if (
+            not isinstance(other, EditShapesCommand)
+            or other.layer is not self.layer
+            or not np.array_equal(self.indices, other.indices)
+        ):
+            return None
+        return EditShapesCommand(
+            self.layer,
+            self.indices,
+            self.prev_data,
+            other.new_data,
+            self.prev_types,
+            other.new_types,
+        )
+
+    def undo(self):
+        _set_shapes(self.layer, self.indices, self.prev_data, self.prev_types)
+
+    def redo(self):
+        _set_shapes(self.layer, self.indices, self.new_data, self.new_types)
+
+    def undo_data(self, shapes: ShapesData) -> ShapesData:
+        return _set_items(
+            shapes, self.indices, self.prev_data, self.prev_types
+        )
+
+    def redo_data(self, shapes: ShapesData) -> ShapesData:
+        return _set_items(shapes, self.indices, self.new_data, self.new_types)
+
+
+class TransformShapesCommand(Command):
+    def __init__(
+        self,
+        layer: Shapes,
+        indices: Sequence[int],
+        prev_data: List[np.ndarray],
+        new_data: List[np.ndarray],
+    ) -> None:
+        """
+        Args:
+            layer: napari Shapes layer of the transformed shapes
+            indices: indices of the transformed shapes
+            prev_data: vertices of each shape before the transform
+            new_data: vertices of each shape after the transform,
+                the shapes keep their number of vertices and their type
+
+        If all the shapes were translated by the same offset,
+        only the offset is stored instead of the vertices.
+        """
+        super().__init__()
+        self.layer = layer
+        self.indices = np.asarray(indices, dtype=np.intp).reshape(-1)
+        self.prev_data: Optional[List[np.ndarray]] = list(prev_data)
+        self.new_data: Optional[List[np.ndarray]] = list(new_data)
+        self.offset: Optional[np.ndarray] = _uniform_offset(
+            self.prev_data, self.new_data
+        )
+        if self.offset is not None:
+            self.prev_data = None
+            self.new_data = None
+
+    def __eq__(self, __o: Command) -> bool:
+        if not isinstance(__o, TransformShapesCommand):
+            return False
+        if not np.array_equal(self.indices, __o.indices):
+            return False
+        if self.offset is not None or __o.offset is not None:
+            return self.offset is not None and np.array_equal(
+                self.offset, __o.offset
+            )
+        return _same_shapes(
+            self.indices, self.prev_data, __o.indices, __o.prev_data
+        ) and _same_shapes(
+            self.indices, self.new_data, __o.indices, __o.new_data
+        )
+
+    @property
+    def nbytes(self) -> int:
+        if self.offset is not None:
+            return self.indices.nbytes + self.offset.nbytes
+        return (
+            self.indices.nbytes
+            + _shapes_nbytes(self.prev_data)
+            + _shapes_nbytes(self.new_data)
+        )
+
+    def merge(self, other: Command) -> Optional[Command]:
+        """
+        Consecutive transforms of the same shapes become a single one
+        """
+        if (
+            not isinstance(other, TransformShapesCommand)
+            or other.layer is not self.layer
+            or not np.array_equal(self.indices, other.indices)
+        ):
+            return None
+        if self.offset is not None and other.offset is not None:
+            # a single offset may not give back exactly the same vertices
+            return None
+        # other was just done, the layer holds its vertices
+        new = other.new_data
+        if new is None:
+            new = [
+                np.array(shape_vertices(self.layer, i)) for i in self.indices
+            ]
+        prev = self._prev_vertices(other._prev_vertices(new))
+        return TransformShapesCommand(self.layer, self.indices, prev, new)
+
+    def undo(self):
+        current = [shape_vertices(self.layer, i) for i in self.indices]
+        _set_shapes(self.layer, self.indices, self._prev_vertices(current))
+
+    def redo(self):
+        current = [shape_vertices(self.layer, i) for i in self.indices]
+        _set_shapes(self.layer, self.indices, self._new_vertices(current))
+
+    def undo_data(self, shapes: ShapesData) -> ShapesData:
+        current = [shapes.data[i] for i in self.indices]
+        return _set_items(shapes, self.indices, self._prev_vertices(current))
+
+    def redo_data(self, shapes: ShapesData) -> ShapesData:
+        current = [shapes.data[i] for i in self.indices]
+        return _set_items(shapes, self.indices, self._new_vertices(current))
+
+    def _prev_vertices(self, current: List[np.ndarray]) -> List[np.ndarray]:
+        if self.offset is not None:
+            return [vertices - self.offset for vertices in current]
+        return self.prev_data
+
+    def _new_vertices(self, current: List[np.ndarray]) -> List[np.ndarray]:
+        if self.offset is not None:
+            return [vertices + self.offset for vertices in current]
+        return self.new_data
+
+
+def infer_shapes_command(
+    layer: Shapes,
+    prev: ShapesData,
+    new: ShapesData,
+    changed: Optional[Sequence[int]] = None,
+) -> Optional[Command]:
+    """
+    returns the command turning the shapes `prev` into `new`,
+    or None if they did not change
+
+    Args:
+        layer: napari Shapes layer the command applies to
+        prev: shapes before the edit
+        new: shapes after the edit, may be the vertices of the layer itself,
+            the command keeps copies
+        changed: indices of the only shapes that may have changed,
+            as given by the `data_indices` of a "changed" data event,
+            None compares all the shapes
+    """
+    n, m = len(prev.data), len(new.data)
+    if changed is not None and n == m:
+        candidates = np.unique(np.asarray(changed, dtype=np.intp))
+        candidates = candidates[(candidates >= 0) & (candidates < n)]
+    elif n == m:
+        candidates = np.arange(n)
+    else:
+        candidates = None
+
+    if candidates is not None:
+        # same number of shapes, only edits or transforms
+        indices = [
+            i
+            for i in candidates.tolist()
+            if prev.shape_types[i] != new.shape_types[i]
+            or not _same_array(prev.data[i], new.data[i])
+        ]
+        return _changed_shapes_command(layer, indices, prev, new)
+
+    delta = compute_delta(prev.data, new.data)
+    if delta.is_empty():
+        return None
+    commands = []
+    if delta.changed_indices.size:
+        commands.append(
+            _changed_shapes_command(
+                layer, delta.changed_indices.tolist(), prev, new
+            )
+        )
+    if delta.deleted_indices.size:
+        indices = delta.deleted_indices.tolist()
+        commands.append(
+            DeleteShapesCommand(
+                layer,
+                indices,
+                [prev.data[i] for i in indices],
+                [prev.shape_types[i] for i in indices],
+            )
+        )
+    if delta.inserted_indices.size:
+        indices = delta.inserted_indices.tolist()
+        commands.append(
+            AddShapesCommand(
+                layer,
+                indices,
+                [np.array(new.data[i]) for i in indices],
+                [new.shape_types[i] for i in indices],
+            )
+        )
+    if len(commands) == 1:
+        return commands[0]
+    return CompositeCommand(commands)
+
+
+def _changed_shapes_command(
+    layer: Shapes, indices: List[int], prev: ShapesData, new: ShapesData
+) -> Optional[Command]:
+    """
+    returns the command of shapes edited in place: a transform if they kept
+    their type and number of vertices, an edit otherwise
+    """
+    if not indices:
+        return None
+    prev_data = [prev.data[i] for i in indices]
+    # the vertices of the layer are modified in place by later edits
+    new_data = [np.array(new.data[i]) for i in indices]
+    prev_types = [prev.shape_types[i] for i in indices]
+    new_types = [new.shape_types[i] for i in indices]
+    if prev_types == new_types and all(
+        a.shape == b.shape for a, b in zip(prev_data, new_data)
+    ):
+        return TransformShapesCommand(layer, indices, prev_data, new_data)
+    return EditShapesCommand(
+        layer, indices, prev_data, new_data, prev_types, new_types
+    )
+
+
+# updates of the layer, only touching the given shapes
+
+
+def _set_shapes(
+    layer: Shapes,
+    indices: np.ndarray,
+    data: List[np.ndarray],
+    shape_types: Optional[List[str]] = None,
+) -> None:
+    """
+    replace the vertices (and type) of some shapes, then notify napari once
+    """
+    from napari.layers.base._base_constants import ActionType
+
+    edit_shapes(layer, indices.tolist(), data, shape_types)
+    layer.events.data(
+        value=layer.data,
+        action=ActionType.CHANGED,
+        data_indices=tuple(indices.tolist()),
+        vertex_indices=((),),
+    )
+    layer.refresh()
+
+
+def _remove_shapes(layer: Shapes, indices: np.ndarray) -> None:
+    layer.remove(indices.tolist())
+
+
+def _insert_shapes(
+    layer: Shapes,
+    indices: np.ndarray,
+    data: List[np.ndarray],
+    shape_types: List[str],
+    columns: Optional[Columns] = None,
+) -> None:
+    """
+    insert shapes so that they end up at `indices`.
+    napari can only append shapes: the shapes after the first insertion
+    point are removed and appended again after the inserted ones.
+    They are appended as the Shape objects they were, with their colors,
+    so only the inserted shapes are triangulated. The inserted shapes get
+    default feature rows, and their style and z index from `columns`,
+    or the current style of the layer above the other shapes.
+    """
+    from napari.layers.base._base_constants import ActionType
+    from napari.utils.colormaps.standardize_color import transform_color
+
+    order = np.argsort(indices, kind="stable")
+    indices = indices[order]
+    data = [np.array(data[i]) for i in order]
+    shape_types = [shape_types[i] for i in order]
+    styles = {
+        "edge_width": [layer.current_edge_width] * len(order),
+        "edge_color": [transform_color(layer.current_edge_color)[0]]
+        * len(order),
+        "face_color": [transform_color(layer.current_face_color)[0]]
+        * len(order),
+        "z_index": [max(layer.z_index, default=-1) + 1] * len(order),
+    }
+    for name in styles:
+        if columns and name in columns:
+            styles[name] = [columns[name][i] for i in order]
+    styles["z_index"] = [int(z) for z in styles["z_index"]]
+    first = int(indices[0])
+    if first >= layer.nshapes:
+        layer.add(data, shape_type=shape_types, **styles)
+        return
+
+    shapes, face_colors, edge_colors = pop_shapes(layer, first)
+    for k, (index, vertices, shape_type) in enumerate(
+        zip(indices.tolist(), data, shape_types)
+    ):
+        shape = new_shape(
+            layer,
+            vertices,
+            shape_type,
+            edge_width=styles["edge_width"][k],
+            z_index=styles["z_index"][k],
+        )
+        position = index - first
+        shapes.insert(position, shape)
+        face_colors.insert(position, styles["face_color"][k])
+        edge_colors.insert(position, styles["edge_color"][k])
+    append_shapes(layer, shapes, face_colors, edge_colors)
+    insert_feature_rows(layer, indices)
+    layer.text.refresh(layer.features)
+
+    if layer.selected_data:
+        # selected shapes after the insertion points moved
+        selected = np.fromiter(layer.selected_data, dtype=np.intp)
+        before = indices - np.arange(len(indices))
+        selected += np.searchsorted(before, selected, side="right")
+        layer.selected_data = set(selected.tolist())
+
+    layer.events.data(
+        value=layer.data,
+        action=ActionType.ADDED,
+        data_indices=tuple(indices.tolist()),
+        vertex_indices=((),),
+    )
+    layer.refresh()
+
+
+# the same updates on ShapesData
+
+
+def _set_items(
+    shapes: ShapesData,
+    indices: np.ndarray,
+    data: List[np.ndarray],
+    shape_types: Optional[List[str]] = None,
+) -> ShapesData:
+    shapes = ShapesData(list(shapes.data), list(shapes.shape_types))
+    for k, index in enumerate(indices.tolist()):
+        shapes.data[index] = np.array(data[k])
+        if shape_types is not None:
+            shapes.shape_types[index] = shape_types[k]
+    return shapes
+
+
+def _delete_items(shapes: ShapesData, indices: np.ndarray) -> ShapesData:
+    removed = set(indices.tolist())
+    keep = [i for i in range(len(shapes.data)) if i not in removed]
+    return ShapesData(
+        [shapes.data[i] for i in keep], [shapes.shape_types[i] for i in keep]
+    )
+
+
+def _insert_items(
+    shapes: ShapesData,
+    indices: np.ndarray,
+    data: List[np.ndarray],
+    shape_types: List[str],
+) -> ShapesData:
+    shapes = ShapesData(list(shapes.data), list(shapes.shape_types))
+    for k in np.argsort(indices, kind="stable").tolist():
+        shapes.data.insert(int(indices[k]), np.array(data[k]))
+        shapes.shape_types.insert(int(indices[k]), shape_types[k])
+    return shapes
+
+
+def _same_shapes(indices, data, other_indices, other_data) -> bool:
+    """
+    returns True if both hold the same vertices for the same shapes
+    """
+    return np.array_equal(indices, other_indices) and all(
+        _same_array(a, b) for a, b in zip(data, other_data)
+    )
+
+
+def _shapes_nbytes(data: List[np.ndarray]) -> int:
+    return sum(np.asarray(vertices).nbytes for vertices in data)
+
+
+def _uniform_offset(
+    prev: List[np.ndarray], new: List[np.ndarray]
+) -> Optional[np.ndarray]:
+    """
+    returns the offset by which all the shapes were translated, or None.
+    Like for MoveCommand, the offset is only used if it gives back
+    exactly the same vertices both ways
+    """
+    if not prev:
+        return None
+    prev_vertices = np.concatenate(prev)
+    new_vertices = np.concatenate(new)
+    if prev_vertices.shape != new_vertices.shape or len(prev_vertices) < 2:
+        return None
+    offset = new_vertices[0] - prev_vertices[0]
+    if not np.array_equal(
+        prev_vertices + offset, new_vertices
+    ) or not np.array_equal(new_vertices - offset, prev_vertices):
+        return None
+    return offset
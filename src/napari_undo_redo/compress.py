@@ -0,0 +1,263 @@
+"""
+Transparent compression of the arrays held by the history.
+
+Labels and coordinates compress very well: few distinct values, and most of
+the high bytes of a number are the same from one element to the next.
+A Codec compresses arrays with a codec of the standard library (zlib or
+lzma) into CompressedArrays, which only keep the compressed bytes in memory.
+
+Before compressing, the bytes of the elements are shuffled (byte-transposed):
+the first byte of every element, then the second byte of every element, ...
+so that the similar high bytes end up next to each other.
+
+Arrays are decompressed lazily, when an undo or redo actually needs them.
+The most recently decompressed arrays are kept in a small cache, so that
+toggling undo/redo over the same steps does not decompress them every time.
+"""
+
+import lzma
+import threading
+import weakref
+import zlib
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import numpy as np
+
+_COMPRESSORS = {
+    "zlib": (zlib.compress, zlib.decompress, 6),
+    "lzma": (
+        lambda raw, level: lzma.compress(raw, preset=level),
+        lzma.decompress,
+        1,
+    ),
+}
+
+
+class CompressedArray:
+    """
+    Array stored as compressed bytes, see Codec.compress
+    """
+
+    __slots__ = (
+        "codec",
+        "payload",
+        "shape",
+        "dtype",
+        "shuffled",
+        "__weakref__",
+    )
+
+    def __init__(
+        self,
+        codec: "Codec",
+        payload: bytes,
+        shape: Tuple[int, ...],
+        dtype: np.dtype,
+        shuffled: bool,
+    ) -> None:
+        self.codec = codec
+        self.payload = payload
+        self.shape = shape
+        self.dtype = dtype
+        self.shuffled = shuffled
+
+    @property
+    def nbytes(self) -> int:
+        """
+        number of bytes held in memory, ie: of the compressed array
+        """
+        return len(self.payload)
+
+    def load(self, cache: bool = True) -> np.ndarray:
+        """
+        returns the decompressed array, read-only if it is cached
+
+        Args:
+            cache: keep the decompressed array in the cache of the codec
+        """
+        return self.codec.decompress(self, cache)
+
+
+class Codec:
+    """
+    Compresses arrays, and caches the ones decompressed recently
+    """
+
+    def __init__(
+        self,
+        name: str = "zlib",
+        level: Optional[int] = None,
+        shuffle: bool = True,
+        min_bytes: int = 1024,
+        cache_bytes: int = 32 * 1024**2,
+    ) -> None:
+        """
+        Args:
+            name: "zlib" (fast) or "lzma" (smaller)
+            level: compression level, defaults to a fast one
+            shuffle: shuffle the bytes of the elements before compressing
+            min_bytes: smaller arrays are not worth compressing
+            cache_bytes: size of the cache of decompressed arrays
+        """
+        if name not in _COMPRESSORS:
+            raise ValueError(
+                f"unknown codec {name!r}, use one of {sorted(_COMPRESSORS)}"
+            )
+        self.name = name
+        self._compress, self._decompress, default_level = _COMPRESSORS[name]
+        self.level = default_level if level is None else level
+        self.shuffle = shuffle
+        self.min_bytes = min_bytes
+        self.cache_bytes = cache_bytes
+        # id(compressed) -> (weakref to compressed, decompressed array)
+        self._cache: "OrderedDict[int, tuple]" = OrderedDict()
+        self._cached_nbytes = 0
+        # capture threads compress while undo decompresses
+        self._lock = threading.Lock()
+
+    def compress(self, value, force: bool = False):
+        """
+        returns the value compressed, or the value itself if it isn't worth
+        it: too small, not numeric, or not smaller once compressed
+
+        Args:
+            value: array, or anything else which is returned as is
+            force: compress arrays of any size, as long as they are numeric
+        """
+        if not isinstance(value, np.ndarray) or value.dtype.hasobject:
+            return value
+        if not force and value.nbytes < self.min_bytes:
+            return value
+        data = np.ascontiguousarray(value)
+        shuffled = self.shuffle and data.dtype.itemsize > 1
+        raw = data.reshape(-1).view(np.uint8)
+        if shuffled:
+            raw = raw.reshape(-1, data.dtype.itemsize).T.copy()
+        payload = self._compress(raw.tobytes(), self.level)
+        if not force and len(payload) >= data.nbytes:
+            return value
+        return CompressedArray(self, payload, data.shape, data.dtype, shuffled)
+
+    def decompress(
+        self, compressed: CompressedArray, cache: bool = True
+    ) -> np.ndarray:
+        """
+        returns the array of a CompressedArray made by this codec
+
+        Args:
+            compressed: CompressedArray to decompress
+            cache: keep the decompressed array in the cache
+        """
+        key = id(compressed)
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and entry[0]() is compressed:
+                self._cache.move_to_end(key)
+                return entry[1]
+
+        raw = np.frombuffer(self._decompress(compressed.payload), np.uint8)
+        itemsize = compressed.dtype.itemsize
+        if compressed.shuffled:
+            raw = raw.reshape(itemsize, -1).T
+        data = (
+            np.ascontiguousarray(raw)
+            .view(compressed.dtype)
+            .reshape(compressed.shape)
+        )
+        if not cache or data.nbytes > self.cache_bytes:
+            return data
+
+        # shared by every caller, nobody may modify it
+        data.flags.writeable = False
+        with self._lock:
+            self._uncache(key)
+            self._cache[key] = (weakref.ref(compressed), data)
+            self._cached_nbytes += data.nbytes
+            while self._cached_nbytes > self.cache_bytes:
+                self._uncache(next(iter(self._cache)))
+        return data
+
+    def clear_cache(self) -> None:
+        with self._lock:
+            self._cache.clear()
+            self._cached_nbytes = 0
+
+    def _uncache(self, key: int) -> None:
+        entry = self._cache.pop(key, None)
+        if entry is not None:
+            self._cached_nbytes -= entry[1].nbytes
+
+
+# helpers to compress layer data, ie: arrays or lists of arrays (shapes)
+
+
+def compress_data(codec: Codec, value):
+    """
+    returns the value with its arrays compressed.
+    The arrays of a list are all compressed, or none of them.
+    """
+    if isinstance(value, list):
+        if not value or sum(np.asarray(item).nbytes for item in value) < (
+            codec.min_bytes
+        ):
+            return value
+        if any(not isinstance(item, np.ndarray) for item in value):
+            return value
+        return [codec.compress(item, force=True) for item in value]
+    return codec.compress(value)
+
+
+def is_compressed(value) -> bool:
+    return isinstance(value, CompressedArray) or (
+        isinstance(value, list)
+        and bool(value)
+        and isinstance(value[0], CompressedArray)
+    )
+
+
+class Payload:
+    """
+    Attribute of a command holding an array which may be compressed,
+    reading it always gives the decompressed array
+
+        class MyCommand(Command):
+            data = Payload()
+    """
+
+    def __set_name__(self, owner: type, name: str) -> None:
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        value = obj.__dict__[self.name]
+        if isinstance(value, CompressedArray):
+            return value.load()
+        return value
+
+    def __set__(self, obj, value) -> None:
+        obj.__dict__[self.name] = value
+
+
+def payload_nbytes(obj, name: str) -> int:
+    """
+    returns the number of bytes held by the Payload `name` of obj,
+    without decompressing it
+    """
+    value = obj.__dict__.get(name)
+    if value is None:
+        return 0
+    if isinstance(value, CompressedArray):
+        return value.nbytes
+    return np.asarray(value).nbytes
+
+
+def compress_payloads(obj, codec: Codec) -> None:
+    """
+    compress the Payload attributes of obj, listed in obj.payloads
+    """
+    for name in obj.payloads:
+        value = obj.__dict__.get(name)
+        if isinstance(value, np.ndarray):
+            obj.__dict__[name] = codec.compress(value)
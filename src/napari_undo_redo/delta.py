@@ -0,0 +1,450 @@
+"""
+Compact differences between two consecutive snapshots of layer data.
+
+A napari Points layer stores its data as an (N, D) array and a Shapes layer
+as a list of (V, D) vertex arrays. In both cases a user edit only touches a
+handful of rows (points or shapes), so instead of storing the whole data of
+every state we store one Delta per step:
+
+    - changed rows: rows whose values changed in place (move)
+    - deleted rows: rows that were removed, with their values (delete)
+    - inserted rows: rows that were added, with their values (add)
+
+Every Delta keeps the values on both sides, so it can be applied forward
+(previous state -> next state) and backward (next state -> previous state).
+"""
+
+from typing import List, Optional, Sequence, Union
+
+import numpy as np
+
+from .compress import Codec, CompressedArray, compress_data
+from .spill import (
+    SpilledArray,
+    SpillStore,
+    load_data,
+    release_data,
+    spill_data,
+)
+
+# layer data is either an array of rows (Points)
+# or a list of arrays, one per shape (Shapes)
+LayerData = Union[np.ndarray, List[np.ndarray]]
+
+_EMPTY_INDICES = np.empty(0, dtype=np.intp)
+
+# attributes of a Delta holding row values
+_PAYLOADS = ("old_rows", "new_rows", "deleted_rows", "inserted_rows")
+
+
+class Delta:
+    """
+    Represents the change between the data of two consecutive states.
+
+    Forward application (`apply`) on the previous data does:
+        1. set `changed_indices` to `new_rows`
+        2. remove `deleted_indices` (indices into the previous data)
+        3. insert `inserted_rows` so that they end up at `inserted_indices`
+           (indices into the next data)
+
+    `revert` does the exact opposite on the next data.
+
+    If the two snapshots are not row compatible (different dtype or row
+    shape), the delta simply holds both full snapshots in `replaced`.
+    """
+
+    def __init__(
+        self,
+        changed_indices: np.ndarray = _EMPTY_INDICES,
+        old_rows: Optional[LayerData] = None,
+        new_rows: Optional[LayerData] = None,
+        deleted_indices: np.ndarray = _EMPTY_INDICES,
+        deleted_rows: Optional[LayerData] = None,
+        inserted_indices: np.ndarray = _EMPTY_INDICES,
+        inserted_rows: Optional[LayerData] = None,
+        replaced: Optional[tuple] = None,
+    ) -> None:
+        self.changed_indices = np.asarray(changed_indices, dtype=np.intp)
+        self.old_rows = old_rows
+        self.new_rows = new_rows
+        self.deleted_indices = np.asarray(deleted_indices, dtype=np.intp)
+        self.deleted_rows = deleted_rows
+        self.inserted_indices = np.asarray(inserted_indices, dtype=np.intp)
+        self.inserted_rows = inserted_rows
+        self.replaced = replaced
+        # True once the row values were written to a SpillStore
+        self.spilled = False
+        self.compressed = False
+
+    def is_empty(self) -> bool:
+        """
+        returns True if applying the delta does not change anything
+        """
+        return (
+            self.replaced is None
+            and self.changed_indices.size == 0
+            and self.deleted_indices.size == 0
+            and self.inserted_indices.size == 0
+        )
+
+    @property
+    def nbytes(self) -> int:
+        """
+        approximate number of bytes held by this delta
+        """
+        if self.replaced is not None:
+            return sum(_nbytes(data) for data in self.replaced)
+        return (
+            self.changed_indices.nbytes
+            + self.deleted_indices.nbytes
+            + self.inserted_indices.nbytes
+            + _nbytes(self.old_rows)
+            + _nbytes(self.new_rows)
+            + _nbytes(self.deleted_rows)
+            + _nbytes(self.inserted_rows)
+        )
+
+    def spill(self, store: SpillStore) -> None:
+        """
+        write the row values of this delta to disk,
+        they are paged back in when the delta is applied or reverted
+
+        Args:
+            store: SpillStore to write to
+        """
+        if self.spilled:
+            return
+        names = [name for name in _PAYLOADS if getattr(self, name) is not None]
+        values = [getattr(self, name) for name in names]
+        if self.replaced is not None:
+            values.extend(self.replaced)
+        spilled = spill_data(store, values)
+        for name, value in zip(names, spilled):
+            setattr(self, name, value)
+        if self.replaced is not None:
+            self.replaced = tuple(spilled[len(names) :])
+        self.spilled = True
+
+    def compress(self, codec: Codec) -> None:
+        """
+        keep the row values of this delta compressed in memory,
+        they are decompressed when the delta is applied or reverted
+
+        Args:
+            codec: Codec to compress with
+        """
+        if self.spilled or self.compressed:
+            return
+        for name in _PAYLOADS:
+            setattr(self, name, compress_data(codec, getattr(self, name)))
+        if self.replaced is not None:
+            self.replaced = tuple(
+                compress_data(codec, value) for value in self.replaced
+            )
+        self.compressed = True
+
+    def release(self, store: SpillStore) -> None:
+        """
+        free the files used by a spilled delta that is dropped from history
+
+        Args:
+            store: SpillStore the delta was spilled to
+        """
+        if not self.spilled:
+            return
+        for name in _PAYLOADS:
+            release_data(store, getattr(self, name))
+        for value in self.replaced or ():
+            release_data(store, value)
+
+    def apply(self, data: LayerData) -> LayerData:
+        """
+        returns the next data, given the previous data.
+        `data` itself is never modified.
+
+        Args:
+            data: layer data of the previous state
+        """
+        if self.replaced is not None:
+            return _copy(load_data(self.replaced[1]))
+        data = _assign(data, self.changed_indices, load_data(self.new_rows))
+        data = _delete(data, self.deleted_indices)
+        return _insert(
+            data, self.inserted_indices, load_data(self.inserted_rows)
+        )
+
+    def revert(self, data: LayerData) -> LayerData:
+        """
+        returns the previous data, given the next data.
+        `data` itself is never modified.
+
+        Args:
+            data: layer data of the next state
+        """
+        if self.replaced is not None:
+            return _copy(load_data(self.replaced[0]))
+        data = _delete(data, self.inserted_indices)
+        data = _insert(
+            data, self.deleted_indices, load_data(self.deleted_rows)
+        )
+        return _assign(data, self.changed_indices, load_data(self.old_rows))
+
+
+def compute_delta(prev: LayerData, new: LayerData) -> Delta:
+    """
+    Compute the Delta that turns `prev` into `new`.
+
+    Unchanged rows at the start and at the end are skipped with vectorized
+    comparisons. What is left in the middle is recognised as
+    changed rows (same length), a pure insertion, a pure deletion or,
+    failing all of those, a replacement of the middle rows.
+
+    Args:
+        prev: layer data of the previous state
+        new: layer data of the next state
+    """
+    if not _row_compatible(prev, new):
+        return Delta(replaced=(_copy(prev), _copy(new)))
+
+    n, m = len(prev), len(new)
+    common = min(n, m)
+
+    # length of the unchanged prefix
+    equal = _rows_equal(prev[:common], new[:common])
+    prefix = common if equal.all() else int(np.argmin(equal))
+
+    # length of the unchanged suffix, not overlapping the prefix
+    tail = common - prefix
+    suffix = 0
+    if tail:
+        equal = _rows_equal(prev[n - tail :], new[m - tail :])[::-1]
+        suffix = tail if equal.all() else int(np.argmin(equal))
+
+    old_middle = prev[prefix : n - suffix]
+    new_middle = new[prefix : m - suffix]
+
+    if len(old_middle) == len(new_middle):
+        changed = np.flatnonzero(~_rows_equal(old_middle, new_middle))
+        return Delta(
+            changed_indices=changed + prefix,
+            old_rows=_take(old_middle, changed),
+            new_rows=_take(new_middle, changed),
+        )
+
+    if len(old_middle) > len(new_middle):
+        removed = _removed_rows(old_middle, new_middle)
+        if removed is not None:
+            return Delta(
+                deleted_indices=removed + prefix,
+                deleted_rows=_take(old_middle, removed),
+            )
+    else:
+        added = _removed_rows(new_middle, old_middle)
+        if added is not None:
+            return Delta(
+                inserted_indices=added + prefix,
+                inserted_rows=_take(new_middle, added),
+            )
+
+    # mixed edit, replace the middle rows
+    return Delta(
+        deleted_indices=np.arange(prefix, n - suffix),
+        deleted_rows=_copy(old_middle),
+        inserted_indices=np.arange(prefix, m - suffix),
+        inserted_rows=_copy(new_middle),
+    )
+
+
+# helpers working on both arrays of rows and lists of arrays:
+
+
+def _row_compatible(prev: LayerData, new: LayerData) -> bool:
+    if isinstance(prev, np.ndarray) and isinstance(new, np.ndarray):
+        return (
+            prev.ndim >= 1
+            and prev.shape[1:] == new.shape[1:]
+            and prev.dtype == new.dtype
+        )
+    return isinstance(prev, list) and isinstance(new, list)
+
+
+def _rows_equal(a: LayerData, b: LayerData) -> np.ndarray:
+    """
+    element-wise equality of the rows of two sequences of the same length
+    """
+    if isinstance(a, np.ndarray):
+        if len(a) == 0:
+            return np.ones(0, dtype=bool)
+        return (a == b).reshape(len(a), -1).all(axis=1)
+    return np.fromiter(
+        (_same_array(x, y) for x, y in zip(a, b)), dtype=bool, count=len(a)
+    )
+
+
+def _same_array(a: np.ndarray, b: np.ndarray) -> bool:
+    """
+    returns True if both arrays hold the same bytes,
+    much faster than np.array_equal on the small arrays of shapes
+    """
+    if a is b:
+        return True
+    a, b = np.asarray(a), np.asarray(b)
+    return (
+        a.shape == b.shape
+        and a.dtype == b.dtype
+        and (a.tobytes() == b.tobytes())
+    )
+
+
+def _removed_rows(
+    longer: LayerData, shorter: LayerData
+) -> Optional[np.ndarray]:
+    """
+    returns the indices of the rows of `longer` that have to be removed
+    to obtain `shorter`, or None if `shorter` is not a subsequence of `longer`
+    """
+    if isinstance(longer, np.ndarray):
+        keys_longer = _row_keys(longer)
+        keys_shorter = _row_keys(shorter)
+        removed = np.flatnonzero(~np.isin(keys_longer, keys_shorter))
+        if len(removed) != len(longer) - len(shorter):
+            # duplicated rows are ambiguous, give up
+            return None
+        if not _rows_equal(np.delete(longer, removed, 0), shorter).all():
+            return None
+        return removed
+
+    removed = []
+    j = 0
+    for i, item in enumerate(longer):
+        if j < len(shorter) and _same_array(item, shorter[j]):
+            j += 1
+        else:
+            removed.append(i)
+    if j != len(shorter):
+        return None
+    return np.asarray(removed, dtype=np.intp)
+
+
+def _row_keys(data: np.ndarray) -> np.ndarray:
+    """
+    view every row of an array as a single opaque value, so that rows
+    can be matched with vectorized set operations
+    """
+    width = int(np.prod(data.shape[1:]))
+    rows = np.ascontiguousarray(data.reshape(len(data), width))
+    return rows.view(
+        np.dtype((np.void, rows.dtype.itemsize * rows.shape[1]))
+    ).ravel()
+
+
+def _take(data: LayerData, indices: np.ndarray) -> LayerData:
+    if isinstance(data, np.ndarray):
+        return data[indices]
+    return [np.copy(data[i]) for i in indices]
+
+
+def _copy(data: LayerData) -> LayerData:
+    if isinstance(data, np.ndarray):
+        # np.array also turns memory-mapped arrays into regular ones
+        return np.array(data)
+    return [np.copy(item) for item in data]
+
+
+def _assign(
+    data: LayerData, indices: np.ndarray, rows: Optional[LayerData]
+) -> LayerData:
+    if indices.size == 0:
+        return data
+    if isinstance(data, np.ndarray):
+        data = np.array(data)
+        data[indices] = rows
+        return data
+    data = list(data)
+    for i, row in zip(indices, rows):
+        data[i] = np.copy(row)
+    return data
+
+
+def _delete(data: LayerData, indices: np.ndarray) -> LayerData:
+    if indices.size == 0:
+        return data
+    if isinstance(data, np.ndarray):
+        return np.delete(data, indices, 0)
+    removed = set(indices.tolist())
+    return [item for i, item in enumerate(data) if i not in removed]
+
+
+def _insert(
+    data: LayerData, indices: np.ndarray, rows: Optional[LayerData]
+) -> LayerData:
+    """
+    insert `rows` so that they end up at the (sorted) `indices`
+    of the resulting data
+    """
+    if indices.size == 0:
+        return data
+    if isinstance(data, np.ndarray):
+        # np.insert positions refer to the array before insertion
+        return np.insert(data, indices - np.arange(len(indices)), rows, 0)
+    data = list(data)
+    for i, row in zip(indices.tolist(), rows):
+        data.insert(i, np.copy(row))
+    return data
+
+
+def insert_rows(
+    data: np.ndarray, indices: Sequence[int], rows: np.ndarray
+) -> np.ndarray:
+    """
+    Insert all `rows` in one operation, so that rows[i] ends up at
+    indices[i] of the returned array. Indices can be given in any order.
+
+    Args:
+        data: array to insert into, it is not modified
+        indices: positions of the rows in the returned array
+        rows: rows to insert, one per index
+    """
+    indices = np.asarray(indices, dtype=np.intp).reshape(-1)
+    rows = np.asarray(rows)
+    if len(indices) != len(rows):
+        raise ValueError(
+            f"{len(indices)} indices given for {len(rows)} rows to insert"
+        )
+    order = np.argsort(indices, kind="stable")
+    return _insert(data, indices[order], rows[order])
+
+
+def read_only(values: np.ndarray) -> np.ndarray:
+    """
+    returns a read-only view of an array, eg: of an array of a layer
+    given to commands that only copy it if they have to write it
+    """
+    view = values.view()
+    view.flags.writeable = False
+    return view
+
+
+def writable(values: np.ndarray) -> np.ndarray:
+    """
+    returns the array itself, or a copy of it if it is read-only
+    """
+    return values if values.flags.writeable else np.array(values)
+
+
+def _nbytes(data: Optional[Union[LayerData, Sequence]]) -> int:
+    # spilled values do not use any memory,
+    # compressed ones only their compressed bytes
+    if data is None or isinstance(data, SpilledArray):
+        return 0
+    if isinstance(data, (np.ndarray, CompressedArray)):
+        return data.nbytes
+    return sum(
+        (
+            item.nbytes
+            if isinstance(item, CompressedArray)
+            else (np.asarray(item).nbytes)
+        )
+        for item in data
+        if not isinstance(item, SpilledArray)
+    )
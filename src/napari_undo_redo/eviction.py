@@ -0,0 +1,81 @@
+"""
+Eviction policies used by a CareTaker to stay within its memory budget.
+
+Whenever a new state makes the history go over budget, the caretaker asks
+its policy to evict states until it fits again. A policy never evicts the
+most recent state, so the layer can always be restored to what it shows.
+"""
+
+from abc import ABC, abstractmethod
+
+
+class EvictionPolicy(ABC):
+    @abstractmethod
+    def evict(self, caretaker) -> bool:
+        """
+        remove one or more states from the caretaker
+
+        Args:
+            caretaker: CareTaker that is over budget
+
+        Returns:
+            False if nothing could be evicted
+        """
+
+
+class DropOldest(EvictionPolicy):
+    """
+    Drop the oldest state, the next one becomes the new base.
+    """
+
+    def evict(self, caretaker) -> bool:
+        if len(caretaker) <= 1:
+            return False
+        caretaker.remove_state(0)
+        return True
+
+
+class ThinIntermediate(EvictionPolicy):
+    """
+    Remove every other state of the older half of the history,
+    so that old history gets sparser while recent steps stay fine grained.
+    Once there is no intermediate state left, the oldest state is dropped.
+    """
+
+    def __init__(self) -> None:
+        # index of the next state to remove in the current thinning pass
+        self._next = 1
+
+    def evict(self, caretaker) -> bool:
+        if len(caretaker) <= 2:
+            return DropOldest().evict(caretaker)
+        if self._next >= max(len(caretaker) // 2, 2):
+            # start a new pass from the oldest states
+            self._next = 1
+        caretaker.remove_state(self._next)
+        # the states after the removed one moved back by one,
+        # so this skips the state right after it
+        self._next += 1
+        return True
+
+
+class MergeIntoBase(EvictionPolicy):
+    """
+    Merge the oldest steps into a new base in one go.
+    Rebuilding the base happens once for many evicted steps,
+    instead of once per evicted step.
+    """
+
+    def __init__(self, fraction: float = 0.25) -> None:
+        """
+        Args:
+            fraction: fraction of the history merged into the base
+        """
+        self.fraction = fraction
+
+    def evict(self, caretaker) -> bool:
+        if len(caretaker) <= 1:
+            return False
+        steps = max(1, int(len(caretaker) * self.fraction))
+        caretaker.merge_into_base(min(steps, len(caretaker) - 1))
+        return True
@@ -0,0 +1,202 @@
+"""
+Cheap change detection for the data of a layer.
+
+napari emits data events that don't always change the data (eg: setting the
+same array again), so the widget has to check whether a new state is needed.
+Comparing against the last saved state would rebuild that state and compare
+every element on every event. Instead, a ChangeDetector keeps a fingerprint
+of the last saved data: its shape, its dtype and one digest per block of
+rows. A new event is then checked in this order:
+
+1. shape or dtype differ: changed, in constant time
+2. the data is the fingerprinted object edited in place and the event
+   names the rows it touched (`data_indices`): only the blocks of these
+   rows are hashed again
+3. otherwise every block is hashed, stopping at the first different
+   block. The data is only unchanged if all the digests match, eg: for
+   `layer.data = layer.data` after an edit of `layer.data[...]`
+
+After a save, only the blocks of the rows the event named are hashed
+again, see reset.
+"""
+
+import hashlib
+import weakref
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+from .chunkstore import DEFAULT_CHUNK_BYTES
+from .delta import LayerData
+
+# 64 bit digests, a collision between two blocks is negligible
+_DIGEST_SIZE = 8
+
+
+class ChangeDetector:
+    """
+    Fingerprint of the last saved data of a layer
+    """
+
+    def __init__(self, block_bytes: int = DEFAULT_CHUNK_BYTES) -> None:
+        """
+        Args:
+            block_bytes: approximate size of a hashed block of rows, in bytes
+        """
+        self.block_bytes = block_bytes
+        self.shape: Optional[tuple] = None
+        self.dtype: Optional[np.dtype] = None
+        self.block_rows = 1
+        self.digests: List[bytes] = []
+        # the fingerprinted object, to know if it was modified in place
+        self._data_ref: Optional[weakref.ref] = None
+
+    def reset(
+        self, data: LayerData, rows: Optional[Sequence[int]] = None
+    ) -> None:
+        """
+        fingerprint the data of the state that was just saved or restored
+
+        Args:
+            data: layer data
+            rows: indices of the only rows that changed since the last
+                reset, if `data` is the fingerprinted object edited in
+                place, None fingerprints all the rows
+        """
+        if rows is not None and self._is_fingerprinted(data):
+            for block in self._blocks(data, rows):
+                self.digests[block] = self._digest(data, block)
+            return
+        self.shape, self.dtype = _signature(data)
+        if isinstance(data, np.ndarray) and data.ndim:
+            row_nbytes = data[:1].nbytes or 1
+            self.block_rows = max(1, self.block_bytes // row_nbytes)
+        else:
+            # shapes data, each shape is hashed with its vertices
+            self.block_rows = 64
+        self.digests = [
+            self._digest(data, block) for block in range(self._nblocks(data))
+        ]
+        try:
+            self._data_ref = weakref.ref(data)
+        except TypeError:
+            # lists can't be weakly referenced
+            self._data_ref = None
+
+    def has_changed(
+        self,
+        data: LayerData,
+        rows: Optional[Sequence[int]] = None,
+        full: bool = True,
+    ) -> bool:
+        """
+        returns True if the data differs from the fingerprinted data
+
+        Args:
+            data: current layer data
+            rows: indices of the rows that may have changed, as given by
+                the `data_indices` of napari data events.
+                Only used if `data` is the fingerprinted object
+                modified in place, None checks all the rows.
+            full: hash all the blocks if needed, False returns True
+                (may have changed) instead
+        """
+        if self.shape is None:
+            return True
+        if _signature(data) != (self.shape, self.dtype):
+            return True
+
+        if rows is not None and self._is_fingerprinted(data):
+            blocks = self._blocks(data, rows)
+        elif not full:
+            return True
+        else:
+            blocks = range(self._nblocks(data))
+
+        return any(
+            self._digest(data, block) != self.digests[block]
+            for block in blocks
+        )
+
+    def _is_fingerprinted(self, data: LayerData) -> bool:
+        """
+        whether `data` is the fingerprinted object, with the same shape
+        """
+        return (
+            self._data_ref is not None
+            and self._data_ref() is data
+            and _signature(data) == (self.shape, self.dtype)
+        )
+
+    def _blocks(self, data: LayerData, rows: Sequence[int]) -> List[int]:
+        """
+        returns the blocks of rows
+        """
+        rows = np.asarray(rows, dtype=np.intp).reshape(-1)
+        if len(data):
+            rows = rows % len(data)
+        return np.unique(rows // self.block_rows).tolist()
+
+    def _nblocks(self, data: LayerData) -> int:
+        if isinstance(data, np.ndarray) and not data.ndim:
+            return 1
+        return -(-len(data) // self.block_rows)
+
+    def _digest(self, data: LayerData, block: int) -> bytes:
+        """
+        returns the digest of the rows of one block
+        """
+        h = hashlib.blake2b(digest_size=_DIGEST_SIZE)
+        if isinstance(data, np.ndarray):
+            if data.ndim:
+                start = block * self.block_rows
+                data = data[start : start + self.block_rows]
+            h.update(np.ascontiguousarray(data).reshape(-1).view(np.uint8))
+            return h.digest()
+        start = block * self.block_rows
+        for item in data[start : start + self.block_rows]:
+            item = np.ascontiguousarray(item)
+            h.update(str((item.shape, item.dtype.str)).encode())
+            h.update(item.reshape(-1).view(np.uint8))
+        return h.digest()
+
+
+def _signature(data: LayerData) -> tuple:
+    """
+    returns what can be compared in constant time: (shape, dtype)
+    """
+    if isinstance(data, np.ndarray):
+        return data.shape, data.dtype
+    return (len(data),), None
+
+
+def data_signature(data: LayerData, digest: bool = True) -> dict:
+    """
+    returns the shape, dtype and digest of all the data, as json,
+    eg: to check that a layer still holds the data a history was made on
+
+    Args:
+        data: layer data
+        digest: hash all the data, None is returned as digest otherwise
+    """
+    if isinstance(data, (np.ndarray, list)):
+        shape, dtype = _signature(data)
+    else:
+        # eg: dask arrays, never hashed
+        shape, dtype, digest = (
+            getattr(data, "shape", (len(data),)),
+            None,
+            False,
+        )
+    signature = {
+        "shape": [int(size) for size in shape],
+        "dtype": None if dtype is None else np.dtype(dtype).str,
+        "digest": None,
+    }
+    if digest:
+        detector = ChangeDetector()
+        detector.reset(data)
+        signature["digest"] = hashlib.blake2b(
+            b"".join(detector.digests), digest_size=16
+        ).hexdigest()
+    return signature
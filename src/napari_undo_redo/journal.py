@@ -0,0 +1,505 @@
+"""
+Append-only on-disk journal of the command history of a layer.
+
+Every change of the undo/redo stacks of a CommandManager (a command pushed,
+merged or cancelled, an undo, a redo, ...) is appended to a binary log file
+by a background writer thread, so that the history survives a crash of
+napari and can be reloaded in the next session.
+
+The file starts with `_MAGIC` and is then a sequence of records:
+
+    kind: uint8, length: uint64 (little endian), body: `length` bytes
+
+and the body of a record holding commands is:
+
+    meta length: uint32, meta: json, raw bytes of the arrays, in order
+
+The json meta describes the commands (type, which array is which field,
+dtype and shape of every array). Arrays are written raw, never pickled.
+Fields holding a list of arrays (the vertices of shapes) reference one
+array per item, lists of strings (shape types) are written in the meta,
+and dicts of arrays (columns of properties and features) one array per key.
+Columns of python objects other than strings can't be journaled.
+
+Every `checkpoint_every` records (or more, for stacks holding more commands),
+the whole undo and redo stacks are written as a checkpoint record.
+read_journal only decodes the records from the last checkpoint onwards,
+so loading stays fast for very long logs.
+A record cut short by a crash is ignored.
+
+Journals are named after their layer, so a layer of another session may
+have the same name but other data. A signature record (shape, dtype and
+digest of the layer data) is written when the journal is opened and when
+it is closed, and one without digest after every checkpoint. read_journal
+follows the number of rows through the records written after the last
+signature, and refuses data that the history wasn't recorded on.
+"""
+
+from __future__ import annotations
+
+import json
+import mmap
+import os
+import queue
+import struct
+import threading
+from collections import deque
+from typing import TYPE_CHECKING, Deque, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from ._my_logger import logger
+from .command.add import AddCommand
+from .command.base import Command
+from .command.columns import ColumnsCommand
+from .command.composite import CompositeCommand
+from .command.delete import DeleteCommand
+from .command.move import MoveCommand
+from .command.paint import PaintCommand
+from .command.shapes import (
+    AddShapesCommand,
+    DeleteShapesCommand,
+    EditShapesCommand,
+    TransformShapesCommand,
+)
+from .delta import LayerData
+from .fingerprint import data_signature
+
+if TYPE_CHECKING:
+    from napari.layers import Layer
+
+_MAGIC = b"NAPARI-UNDO-REDO-JOURNAL-1\n"
+_HEADER = struct.Struct("<BQ")
+_META_LENGTH = struct.Struct("<I")
+
+# kinds of records, ie: operations on the stacks of a CommandManager
+APPEND = 1  # push a command on the undo stack
+REPLACE = 2  # replace the top of the undo stack (merged command)
+POP = 3  # drop the top of the undo stack (cancelled command)
+UNDO = 4  # move the top of the undo stack to the redo stack
+REDO = 5  # move the top of the redo stack to the undo stack
+CLEAR_REDO = 6  # drop the redo stack
+EVICT = 7  # drop the oldest command of the undo stack
+CHECKPOINT = 8  # the whole undo and redo stacks
+SIGNATURE = 9  # shape, dtype and digest of the layer data, see data_signature
+
+# array attributes saved for each type of command
+_FIELDS = {
+    AddCommand: ("add", ("indices", "data", "columns")),
+    DeleteCommand: ("delete", ("indices", "data", "columns")),
+    MoveCommand: (
+        "move",
+        ("indices", "prev_coordinates", "new_coordinates", "offset"),
+    ),
+    PaintCommand: ("paint", ("indices", "prev_values", "new_values")),
+    ColumnsCommand: ("columns", ("indices", "prev_values", "new_values")),
+    AddShapesCommand: (
+        "add_shapes",
+        ("indices", "data", "shape_types", "columns"),
+    ),
+    DeleteShapesCommand: (
+        "delete_shapes",
+        ("indices", "data", "shape_types", "columns"),
+    ),
+    EditShapesCommand: (
+        "edit_shapes",
+        (
+            "indices",
+            "prev_data",
+            "new_data",
+            "prev_types",
+            "new_types",
+        ),
+    ),
+    TransformShapesCommand: (
+        "transform_shapes",
+        ("indices", "prev_data", "new_data", "offset"),
+    ),
+}
+_TYPES = {name: (cls, fields) for cls, (name, fields) in _FIELDS.items()}
+
+
+class Journal:
+    """
+    Writes the operations on the stacks of a CommandManager to a log file,
+    see CommandManager.journal
+    """
+
+    def __init__(
+        self, path: str, checkpoint_every: int = 1000, fsync: bool = False
+    ) -> None:
+        """
+        Args:
+            path: log file, created if needed, appended to otherwise
+            checkpoint_every: number of records between two checkpoints
+            fsync: force every batch of records to the disk,
+                slower but also survives a crash of the system
+        """
+        self.path = path
+        self.checkpoint_every = checkpoint_every
+        self.fsync = fsync
+        # records since the last checkpoint
+        self.records = 0
+
+        self._file = open(path, "ab")
+        if self._file.tell() == 0:
+            self._file.write(_MAGIC)
+        self._queue: "queue.Queue" = queue.Queue()
+        self._writer = threading.Thread(
+            target=self._write_records, name="napari-undo-redo-journal"
+        )
+        self._writer.daemon = True
+        self._writer.start()
+
+    def checkpoint_due(self, stack_size: int) -> bool:
+        """
+        returns True if a checkpoint of stacks of `stack_size` commands
+        should be written now. Checkpoints of long histories are spaced out,
+        so that writing them stays proportional to the number of records.
+        """
+        return self.records >= max(self.checkpoint_every, stack_size)
+
+    def append(self, kind: int, cmd: Optional[Command] = None) -> None:
+        """
+        log one operation on the stacks
+
+        Args:
+            kind: APPEND, REPLACE, POP, UNDO, REDO, CLEAR_REDO or EVICT
+            cmd: the command, for APPEND and REPLACE
+        """
+        arrays = []
+        meta = None
+        if cmd is not None:
+            meta = {"command": encode_command(cmd, arrays)}
+        self._queue.put((kind, meta, arrays))
+        self.records += 1
+
+    def checkpoint(
+        self, undo_stack: Sequence[Command], redo_stack: Sequence[Command]
+    ) -> None:
+        """
+        log the whole stacks, the records before it are not needed anymore
+        """
+        arrays = []
+        meta = {
+            "undo": [encode_command(cmd, arrays) for cmd in undo_stack],
+            "redo": [encode_command(cmd, arrays) for cmd in redo_stack],
+        }
+        self._queue.put((CHECKPOINT, meta, arrays))
+        self.records = 0
+
+    def sign(self, signature: dict) -> None:
+        """
+        log what the layer data is now, see data_signature
+        """
+        self._queue.put((SIGNATURE, {"signature": signature}, []))
+
+    def flush(self) -> None:
+        """
+        wait until all the logged operations are written
+        """
+        self._queue.join()
+
+    def close(self) -> None:
+        """
+        write the pending operations and close the file
+        """
+        if self._file.closed:
+            return
+        self._queue.put(None)
+        self._writer.join()
+        self._file.close()
+
+    @property
+    def closed(self) -> bool:
+        return self._file.closed
+
+    def _write_records(self) -> None:
+        """
+        body of the writer thread
+        """
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+                if self._queue.empty():
+                    self._file.flush()
+                    if self.fsync:
+                        os.fsync(self._file.fileno())
+            except Exception:
+                logger.exception(f"could not write to {self.path}")
+            finally:
+                self._queue.task_done()
+
+    def _write(self, kind: int, meta, arrays: List[np.ndarray]) -> None:
+        arrays = [np.ascontiguousarray(array) for array in arrays]
+        if meta is None:
+            self._file.write(_HEADER.pack(kind, 0))
+            return
+        meta = dict(meta)
+        meta["arrays"] = [[array.dtype.str, array.shape] for array in arrays]
+        meta = json.dumps(meta, separators=(",", ":")).encode()
+        length = _META_LENGTH.size + len(meta) + sum(a.nbytes for a in arrays)
+        self._file.write(_HEADER.pack(kind, length))
+        self._file.write(_META_LENGTH.pack(len(meta)))
+        self._file.write(meta)
+        for array in arrays:
+            self._file.write(array.reshape(-1).view(np.uint8).data)
+
+
+def encode_command(cmd: Command, arrays: List[np.ndarray]) -> dict:
+    """
+    returns the json meta of a command,
+    its arrays are appended to `arrays` and referenced by index
+
+    Args:
+        cmd: command to encode
+        arrays: arrays of the record being written
+    """
+    if isinstance(cmd, CompositeCommand):
+        return {
+            "type": "composite",
+            "commands": [encode_command(c, arrays) for c in cmd.commands],
+        }
+    if type(cmd) not in _FIELDS:
+        raise TypeError(f"{type(cmd).__name__} can't be journaled")
+    name, fields = _FIELDS[type(cmd)]
+    meta = {"type": name}
+    for field in fields:
+        meta[field] = _encode_field(getattr(cmd, field), arrays)
+    return meta
+
+
+def _encode_field(value, arrays: List[np.ndarray]):
+    """
+    returns the json meta of a field, see encode_command
+    """
+    if value is None:
+        return None
+    if isinstance(value, dict):
+        return {
+            "columns": {
+                name: _encode_field(item, arrays)
+                for name, item in value.items()
+            }
+        }
+    if isinstance(value, list) and value and isinstance(value[0], str):
+        return {"strings": value}
+    if isinstance(value, list) and value and isinstance(value[0], np.ndarray):
+        start = len(arrays)
+        arrays.extend(np.asarray(item) for item in value)
+        return {"arrays": list(range(start, len(arrays)))}
+    value = np.asarray(value)
+    if value.dtype.hasobject:
+        if not all(isinstance(item, str) for item in value.tolist()):
+            raise TypeError("columns of python objects can't be journaled")
+        return {"strings": value.tolist(), "object": True}
+    arrays.append(value)
+    return len(arrays) - 1
+
+
+def decode_command(meta: dict, arrays: List[np.ndarray], layer: Layer):
+    """
+    returns the command encoded by encode_command
+
+    Args:
+        meta: json meta of the command
+        arrays: arrays of the record
+        layer: napari layer the command applies to
+    """
+    if meta["type"] == "composite":
+        return CompositeCommand(
+            [decode_command(c, arrays, layer) for c in meta["commands"]]
+        )
+    cls, fields = _TYPES[meta["type"]]
+    # the fields are restored as they were, without running __init__ again
+    cmd = cls.__new__(cls)
+    cmd.layer = layer
+    for field in fields:
+        # fields added since the journal was written are None
+        setattr(cmd, field, _decode_field(meta.get(field), arrays))
+    if cls in (AddCommand, DeleteCommand):
+        cmd.indices = cmd.indices.tolist()
+    return cmd
+
+
+def _decode_field(index, arrays: List[np.ndarray]):
+    """
+    returns the value of a field encoded by _encode_field
+    """
+    if index is None:
+        return None
+    if isinstance(index, int):
+        return arrays[index]
+    if "columns" in index:
+        return {
+            name: _decode_field(item, arrays)
+            for name, item in index["columns"].items()
+        }
+    if "strings" in index and index.get("object"):
+        return np.array(index["strings"], dtype=object)
+    if "strings" in index:
+        return index["strings"]
+    return [arrays[i] for i in index["arrays"]]
+
+
+def read_journal(
+    path: str, layer: Layer, data: Optional[LayerData] = None
+) -> Tuple[Deque[Command], Deque[Command]]:
+    """
+    Rebuild the undo and redo stacks of a layer from its journal.
+    Only the records from the last checkpoint onwards are decoded.
+
+    Args:
+        path: log file written by a Journal
+        layer: napari layer the commands apply to
+        data: current data of the layer, checked against the last
+            signature of the journal, None doesn't check it
+
+    Returns:
+        undo stack, redo stack
+
+    Raises:
+        ValueError: not a journal, or not the journal of `data`
+    """
+    undo_stack, redo_stack = deque(), deque()
+    # last signature, rows of the data after the records following it,
+    # and whether these records edited the data
+    signature, rows, edited = None, 0, False
+    with open(path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        if size <= len(_MAGIC):
+            return undo_stack, redo_stack
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if mapped[: len(_MAGIC)] != _MAGIC:
+                raise ValueError(f"{path} is not a napari-undo-redo journal")
+
+            # headers only, to find the last checkpoint
+            records = []
+            position = len(_MAGIC)
+            while position + _HEADER.size <= size:
+                kind, length = _HEADER.unpack_from(mapped, position)
+                start = position + _HEADER.size
+                if start + length > size:
+                    # cut short by a crash
+                    break
+                if kind == CHECKPOINT:
+                    records = []
+                records.append((kind, start, length))
+                position = start + length
+
+            for kind, start, length in records:
+                cmd = None
+                if length:
+                    meta, arrays = _read_body(mapped, start, length)
+                    if kind not in (CHECKPOINT, SIGNATURE):
+                        cmd = decode_command(meta["command"], arrays, layer)
+                if kind == SIGNATURE:
+                    signature = meta["signature"]
+                    rows, edited = signature["shape"][0], False
+                    continue
+                if kind == CHECKPOINT:
+                    undo_stack = deque(
+                        decode_command(m, arrays, layer) for m in meta["undo"]
+                    )
+                    redo_stack = deque(
+                        decode_command(m, arrays, layer) for m in meta["redo"]
+                    )
+                    continue
+                if kind not in (EVICT, CLEAR_REDO):
+                    rows += _rows_changed(kind, cmd, undo_stack, redo_stack)
+                    edited = True
+                _replay(kind, cmd, undo_stack, redo_stack)
+
+    if data is not None and signature is not None:
+        current = data_signature(
+            data, digest=not edited and signature["digest"] is not None
+        )
+        if edited:
+            # only the rows are known after the signature
+            current = current["shape"][:1]
+            signature = [rows]
+        if current != signature:
+            raise ValueError(f"{path} is the journal of other data")
+    return undo_stack, redo_stack
+
+
+def _rows_changed(
+    kind: int,
+    cmd: Optional[Command],
+    undo_stack: Deque[Command],
+    redo_stack: Deque[Command],
+) -> int:
+    """
+    returns the rows added to the layer data by an operation on the stacks,
+    before it is replayed
+    """
+    if kind == APPEND:
+        return _rows_added(cmd)
+    if kind == REPLACE:
+        # the merged command replaces the top, which was done already
+        return _rows_added(cmd) - _rows_added(undo_stack[-1])
+    if kind in (POP, UNDO):
+        return -_rows_added(undo_stack[-1])
+    if kind == REDO:
+        return _rows_added(redo_stack[-1])
+    return 0
+
+
+def _rows_added(cmd: Command) -> int:
+    """
+    returns the rows added to the layer data by doing a command
+    """
+    if isinstance(cmd, CompositeCommand):
+        return sum(_rows_added(c) for c in cmd.commands)
+    if isinstance(cmd, (AddCommand, AddShapesCommand)):
+        return len(cmd.indices)
+    if isinstance(cmd, (DeleteCommand, DeleteShapesCommand)):
+        return -len(cmd.indices)
+    return 0
+
+
+def _read_body(data: mmap.mmap, start: int, length: int) -> tuple:
+    """
+    returns the json meta and the arrays of a record
+    """
+    (meta_length,) = _META_LENGTH.unpack_from(data, start)
+    position = start + _META_LENGTH.size
+    meta = json.loads(bytes(data[position : position + meta_length]))
+    position += meta_length
+    arrays = []
+    for dtype, shape in meta["arrays"]:
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape))
+        if count:
+            # copied, the file is closed once loaded
+            array = np.frombuffer(data, dtype, count, position).copy()
+        else:
+            array = np.empty(0, dtype)
+        arrays.append(array.reshape(shape))
+        position += count * dtype.itemsize
+    return meta, arrays
+
+
+def _replay(
+    kind: int,
+    cmd: Optional[Command],
+    undo_stack: Deque[Command],
+    redo_stack: Deque[Command],
+) -> None:
+    if kind == APPEND:
+        undo_stack.append(cmd)
+    elif kind == REPLACE:
+        undo_stack[-1] = cmd
+    elif kind == POP:
+        undo_stack.pop()
+    elif kind == UNDO:
+        redo_stack.append(undo_stack.pop())
+    elif kind == REDO:
+        undo_stack.append(redo_stack.pop())
+    elif kind == CLEAR_REDO:
+        redo_stack.clear()
+    elif kind == EVICT:
+        undo_stack.popleft()
@@ -0,0 +1,27 @@
+"""
+napari layer types with a history, by class name.
+
+The core of the history (commands, states and their storage) doesn't
+import napari, only the widget does: layers are told apart by the name of
+their napari class, or of the napari class they derive from.
+"""
+
+from typing import Optional
+
+# layers whose data is a sequence of rows (points or shapes)
+ROW_LAYER_TYPES = ("Points", "Shapes")
+# layers whose data is one dense array
+DENSE_LAYER_TYPES = ("Labels", "Image")
+# layer types for which we can save states
+SUPPORTED_LAYER_TYPES = ROW_LAYER_TYPES + DENSE_LAYER_TYPES
+
+
+def layer_type(layer) -> Optional[str]:
+    """
+    returns the supported layer type of a layer, eg: "Points",
+    None if it has no history
+    """
+    for cls in type(layer).__mro__:
+        if cls.__name__ in SUPPORTED_LAYER_TYPES:
+            return cls.__name__
+    return None
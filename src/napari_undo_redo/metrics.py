@@ -0,0 +1,241 @@
+"""
+Instrumentation of the history: latency histograms of its operations
+(capture, diff, store, undo, redo) and counts of the layer events it saw.
+The bytes held by the history of each layer are read from the histories
+themselves, see UndoRedoWidget.stats.
+
+Metrics are off by default and cost a single attribute check then:
+`metrics.timer()` returns a shared no-op context manager and `count()`
+returns right away.
+
+    from napari_undo_redo.metrics import metrics
+
+    metrics.enable()          # log=True also logs every measurement
+    ...
+    metrics.snapshot()        # {"latency": {...}, "events": {...}}
+
+Latencies are kept in log2 buckets from 1 µs to about 1 min, so the
+memory of a histogram doesn't grow with the number of measurements and
+percentiles are approximated by the upper bound of their bucket.
+"""
+
+import json
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from contextlib import nullcontext
+from functools import wraps
+from typing import Callable, ContextManager, Dict, List, Optional
+
+from ._my_logger import logger
+
+# upper bounds of the buckets, in seconds, the last bucket is unbounded
+BUCKET_BOUNDS = tuple(1e-6 * 2**i for i in range(27))
+PERCENTILES = (50, 90, 99)
+
+# returned by timer() when disabled, nullcontext can be reused
+_NO_TIMER = nullcontext()
+
+
+class Histogram:
+    """
+    log2 buckets of latencies, see BUCKET_BOUNDS
+    """
+
+    __slots__ = ("counts", "count", "total", "min", "max")
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+
+    def add(self, seconds: float) -> None:
+        self.counts[bisect_left(BUCKET_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q: float) -> float:
+        """
+        returns the upper bound of the bucket holding the q-th percentile,
+        at most the largest latency measured
+        """
+        if not self.count:
+            return 0.0
+        rank = q / 100 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                if i == len(BUCKET_BOUNDS):
+                    break
+                return min(BUCKET_BOUNDS[i], self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        summary = {
+            "count": self.count,
+            "total_s": self.total,
+            "mean_s": self.total / self.count if self.count else 0.0,
+            "min_s": self.min if self.count else 0.0,
+            "max_s": self.max,
+        }
+        for q in PERCENTILES:
+            summary[f"p{q}_s"] = self.percentile(q)
+        # non-empty buckets only: [upper bound in seconds, count]
+        bounds = (*BUCKET_BOUNDS, None)
+        summary["buckets"] = [
+            [bound, n] for bound, n in zip(bounds, self.counts) if n
+        ]
+        return summary
+
+
+class _Timer:
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics: "Metrics", name: str) -> None:
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self) -> "_Timer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+
+
+class Metrics:
+    """
+    latency histograms and event counters, thread safe:
+    states may be stored on capture threads
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        # log every measurement through _my_logger, as json
+        self.log = False
+        self._lock = threading.Lock()
+        self.reset()
+
+    def enable(self, log: bool = False) -> None:
+        """
+        Args:
+            log: also log every measurement and event
+        """
+        self.log = log
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def reset(self) -> None:
+        """
+        forget everything measured so far
+        """
+        with self._lock:
+            self.latency: Dict[str, Histogram] = {}
+            self.events: Counter = Counter()
+
+    def timer(self, name: str) -> ContextManager:
+        """
+        returns a context manager measuring the latency of its block
+
+            with metrics.timer("undo"):
+                ...
+        """
+        if not self.enabled:
+            return _NO_TIMER
+        return _Timer(self, name)
+
+    def timed(self, name: str) -> Callable:
+        """
+        decorator measuring the latency of every call of a function
+        """
+
+        def decorator(fn: Callable) -> Callable:
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                with _Timer(self, name):
+                    return fn(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def observe(self, name: str, seconds: float) -> None:
+        """
+        add a latency to the histogram `name`
+        """
+        with self._lock:
+            histogram = self.latency.get(name)
+            if histogram is None:
+                histogram = self.latency[name] = Histogram()
+            histogram.add(seconds)
+        if self.log:
+            logger.info(json.dumps({"latency": name, "seconds": seconds}))
+
+    def count(self, name: str, n: int = 1) -> None:
+        """
+        count an event, eg: a data event of a layer
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self.events[name] += n
+        if self.log:
+            logger.info(json.dumps({"event": name, "n": n}))
+
+    def snapshot(self) -> dict:
+        """
+        returns everything measured so far, see Histogram.summary
+        """
+        with self._lock:
+            return {
+                "latency": {
+                    name: histogram.summary()
+                    for name, histogram in self.latency.items()
+                },
+                "events": dict(self.events),
+            }
+
+    def log_snapshot(self) -> None:
+        """
+        log the snapshot through _my_logger, as json
+        """
+        logger.info(json.dumps(self.snapshot()))
+
+
+def format_bytes(nbytes: Optional[int]) -> str:
+    if nbytes is None:
+        return "-"
+    for unit in ("B", "KB", "MB", "GB"):
+        if nbytes < 1024 or unit == "GB":
+            break
+        nbytes /= 1024
+    return f"{nbytes:.0f} {unit}" if unit == "B" else f"{nbytes:.1f} {unit}"
+
+
+def format_stats(stats: dict, names: List[str]) -> str:
+    """
+    returns a one line readout of UndoRedoWidget.stats: the bytes of the
+    history, then the median latency of each operation of `names`
+    """
+    parts = [f"history {format_bytes(stats['history_bytes'])}"]
+    latency = stats["latency"]
+    for name in names:
+        if name in latency:
+            ms = latency[name]["p50_s"] * 1000
+            parts.append(f"{name} {ms:.3g} ms")
+    parts.append(f"{sum(stats['events'].values())} events")
+    return " | ".join(parts)
+
+
+# used by the whole plugin
+metrics = Metrics()
@@ -1,7 +1,12 @@
-from napari.layers import Layer
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
 
 from .state import State
 
+if TYPE_CHECKING:
+    from napari.layers import Layer
+
 
 class Originator:
     """
@@ -19,5 +24,11 @@ class Originator:
         return State(self.layer)
 
     def restore_from_state(self, state: State) -> Layer:
-        self.layer = state.get_layer()
+        """
+        set the data of the current layer back to a state
+
+        Returns:
+            the current layer, restored
+        """
+        state.restore(self.layer)
         return self.layer
@@ -1,6 +1,12 @@
-from caretaker import CareTaker
-from napari.layers import Layer
-from originator import Originator
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+from .caretaker import CareTaker
+from .originator import Originator
+
+if TYPE_CHECKING:
+    from napari.layers import Layer
 
 
 class UndoPlugin:
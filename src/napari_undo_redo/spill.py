@@ -0,0 +1,230 @@
+"""
+Disk tier for the history, backed by memory-mapped files.
+
+Old history entries are rarely needed, so a CareTaker can write their arrays
+to a scratch directory and only keep a SpilledArray (file, offset, shape,
+dtype) in memory. The data is paged back lazily by np.memmap when an undo or
+redo actually reaches it.
+
+The scratch directory is removed when the SpillStore is closed or garbage
+collected, ie: when the layer history or the widget goes away.
+"""
+
+import os
+import shutil
+import tempfile
+import weakref
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .compress import CompressedArray
+
+_SPILL_PREFIX = "napari-undo-redo-"
+
+
+class SpilledArray:
+    """
+    Reference to an array written to a file of a SpillStore
+    """
+
+    __slots__ = ("path", "offset", "shape", "dtype")
+
+    def __init__(
+        self, path: str, offset: int, shape: Tuple[int, ...], dtype: np.dtype
+    ) -> None:
+        self.path = path
+        self.offset = offset
+        self.shape = shape
+        self.dtype = dtype
+
+    @property
+    def nbytes(self) -> int:
+        """
+        number of bytes of the array on disk
+        """
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def load(self) -> np.ndarray:
+        """
+        returns a read-only memory-mapped view of the array
+        """
+        if self.nbytes == 0:
+            return np.empty(self.shape, dtype=self.dtype)
+        return np.memmap(
+            self.path,
+            dtype=self.dtype,
+            mode="r",
+            offset=self.offset,
+            shape=self.shape,
+        )
+
+
+class SpillStore:
+    """
+    Writes batches of arrays to memory-mapped files in a scratch directory
+    """
+
+    def __init__(self, directory: Optional[str] = None) -> None:
+        """
+        Args:
+            directory: where the scratch directory is created,
+                defaults to the system temporary directory
+        """
+        self.directory = tempfile.mkdtemp(prefix=_SPILL_PREFIX, dir=directory)
+        # number of live SpilledArrays per file
+        self.refcounts: Dict[str, int] = {}
+        # number of bytes written to disk and not released yet
+        self.nbytes = 0
+        self._files = 0
+        self._finalizer = weakref.finalize(
+            self, shutil.rmtree, self.directory, ignore_errors=True
+        )
+
+    def write(self, arrays: Sequence[np.ndarray]) -> List[SpilledArray]:
+        """
+        write a batch of arrays to a single new file
+
+        Args:
+            arrays: arrays to write
+
+        Returns:
+            one SpilledArray per array, in the same order
+        """
+        arrays = [np.ascontiguousarray(array) for array in arrays]
+        total = sum(array.nbytes for array in arrays)
+        path = os.path.join(self.directory, f"{self._files}.bin")
+        self._files += 1
+
+        spilled = []
+        if total:
+            file = np.memmap(path, dtype=np.uint8, mode="w+", shape=(total,))
+            offset = 0
+            for array in arrays:
+                raw = array.reshape(-1).view(np.uint8)
+                file[offset : offset + raw.size] = raw
+                spilled.append(
+                    SpilledArray(path, offset, array.shape, array.dtype)
+                )
+                offset += raw.size
+            file.flush()
+            del file
+        else:
+            spilled = [
+                SpilledArray(path, 0, array.shape, array.dtype)
+                for array in arrays
+            ]
+        self.refcounts[path] = self.refcounts.get(path, 0) + len(spilled)
+        self.nbytes += total
+        return spilled
+
+    def release(self, spilled: SpilledArray) -> None:
+        """
+        drop a reference returned by write(),
+        the file is deleted once none of its arrays is referenced anymore
+
+        Args:
+            spilled: reference returned by write()
+        """
+        self.nbytes -= spilled.nbytes
+        self.refcounts[spilled.path] -= 1
+        if self.refcounts[spilled.path] == 0:
+            del self.refcounts[spilled.path]
+            try:
+                os.remove(spilled.path)
+            except OSError:
+                # still mapped somewhere, close() removes it later
+                pass
+
+    def close(self) -> None:
+        """
+        delete the scratch directory and all the files in it
+        """
+        self.refcounts.clear()
+        self.nbytes = 0
+        self._finalizer()
+
+    @property
+    def closed(self) -> bool:
+        return not self._finalizer.alive
+
+
+# helpers to spill layer data, ie: arrays or lists of arrays (shapes)
+
+
+def spill_data(store: SpillStore, values: Sequence) -> list:
+    """
+    write a batch of layer data values to a single file
+
+    Args:
+        store: SpillStore to write to
+        values: arrays or lists of arrays, compressed arrays are written
+            decompressed, so that they can be memory-mapped
+
+    Returns:
+        the values with every array replaced by a SpilledArray
+    """
+    values = [_decompressed(value) for value in values]
+    arrays = []
+    for value in values:
+        if isinstance(value, np.ndarray):
+            arrays.append(value)
+        else:
+            arrays.extend(np.asarray(item) for item in value)
+    spilled = iter(store.write(arrays))
+    return [
+        (
+            next(spilled)
+            if isinstance(value, np.ndarray)
+            else [next(spilled) for _ in value]
+        )
+        for value in values
+    ]
+
+
+def load_data(value):
+    """
+    returns the value with every SpilledArray paged back from disk
+    and every CompressedArray decompressed
+    """
+    if isinstance(value, (SpilledArray, CompressedArray)):
+        return value.load()
+    if (
+        isinstance(value, list)
+        and value
+        and isinstance(value[0], (SpilledArray, CompressedArray))
+    ):
+        return [item.load() for item in value]
+    return value
+
+
+def _decompressed(value):
+    if isinstance(value, CompressedArray):
+        return value.load(cache=False)
+    if (
+        isinstance(value, list)
+        and value
+        and isinstance(value[0], CompressedArray)
+    ):
+        return [item.load(cache=False) for item in value]
+    return value
+
+
+def release_data(store: SpillStore, value) -> None:
+    """
+    release every SpilledArray of the value
+    """
+    if isinstance(value, SpilledArray):
+        store.release(value)
+    elif isinstance(value, list):
+        for item in value:
+            if isinstance(item, SpilledArray):
+                store.release(item)
+
+
+def is_spilled(value) -> bool:
+    return isinstance(value, SpilledArray) or (
+        isinstance(value, list)
+        and bool(value)
+        and isinstance(value[0], SpilledArray)
+    )
@@ -1,13 +1,33 @@
+from __future__ import annotations
+
 from copy import deepcopy
+from typing import TYPE_CHECKING, List, Optional
+
+import numpy as np
 
-from napari.layers import Layer, Points, Shapes
+from .delta import LayerData, _copy
+from .layer_types import (  # noqa: F401
+    DENSE_LAYER_TYPES,
+    ROW_LAYER_TYPES,
+    SUPPORTED_LAYER_TYPES,
+    layer_type,
+)
+
+if TYPE_CHECKING:
+    from napari.layers import Layer
 
 
 class State:
     """
     Represents the state of a napari layer at a particular point in time
+
+    A state only holds a copy of the layer data (and the type of each shape
+    for Shapes layers), never a napari layer: no events, colormaps, feature
+    tables or meshes are built to save or restore it.
     """
 
+    __slots__ = ("layer_type", "data", "shape_types")
+
     def __init__(self, layer: Layer) -> None:
         """
         creates a state representing the current snapshot of a napari layer.
@@ -16,27 +36,63 @@ class State:
             layer: napari.layers.Layer
                 (https://napari.org/api/napari.layers.Layer.html#napari.layers.Layer)
         """
-        # we are doing a deepcopy because we don't want the state to be
-        # modified whenever the layer is modified.
-        # instead we are creating a state with a new layer everytime
-        # self.layer = deepcopy(layer) # Getting this error:
-        # "NotImplementedError: object proxy must define __deepcopy__()"
-
-        # Pickling layer to bytes as a workaround because deepcopy doesn't work
-        # Doesn' work, getting this error:
-        # "TypeError: cannot pickle 'generator' object"
-        # self.layer = pickle.dumps(layer)
-
-        if isinstance(layer, Points):
-            print("creating points layer state")
-            self.layer = Points(data=deepcopy(layer.data))
-        elif isinstance(layer, Shapes):
-            print("creating shapes layer state")
-            self.layer = Shapes(data=deepcopy(layer.data))
-
-    def get_layer(self) -> Layer:
+        # we only copy the layer data: a napari layer can't be deepcopied
+        # ("NotImplementedError: object proxy must define __deepcopy__()")
+        # nor pickled ("TypeError: cannot pickle 'generator' object")
+        self.layer_type = layer_type(layer)
+        if self.layer_type is None:
+            raise TypeError(f"Cannot save the state of {type(layer)} layers")
+        data = layer.data
+        if isinstance(data, (np.ndarray, list)) and not getattr(
+            layer, "multiscale", False
+        ):
+            self.data = _copy(data)
+        else:
+            # eg: dask arrays or multiscale images
+            self.data = deepcopy(data)
+        self.shape_types: Optional[List[str]] = None
+        if self.layer_type == "Shapes":
+            self.shape_types = list(layer.shape_type)
+
+    @classmethod
+    def from_data(
+        cls,
+        layer_type: str,
+        data: LayerData,
+        shape_types: Optional[List[str]] = None,
+    ) -> "State":
         """
-        returns the napari layer in this state
+        creates a state from data rebuilt by the caretaker,
+        without copying it again
+
+        Args:
+            layer_type: one of SUPPORTED_LAYER_TYPES
+            data: layer data at this state
+            shape_types: type of each shape, for Shapes layers,
+                None keeps the types of the layer the state is restored to
+        """
+        state = cls.__new__(cls)
+        state.layer_type = layer_type
+        state.data = data
+        state.shape_types = shape_types
+        return state
+
+    def restore(self, layer: Layer) -> None:
+        """
+        set the data of a napari layer to the data of this state
+
+        Args:
+            layer: layer of the same type as the one the state was saved from
         """
-        return self.layer
-        # return pickle.loads(self.layer)
+        if layer_type(layer) != self.layer_type:
+            raise TypeError(
+                f"Cannot restore a {self.layer_type} state "
+                f"to {type(layer).__name__} layers"
+            )
+        if self.shape_types is not None and len(self.shape_types) == len(
+            self.data
+        ):
+            # (vertices, type) pairs, see napari's extract_shape_type
+            layer.data = list(zip(self.data, self.shape_types))
+        else:
+            layer.data = self.data
@@ -0,0 +1,232 @@
+"""
+Branches of an undo history, so that a new edit after an undo doesn't
+lose what could be redone.
+
+A history (CommandManager or CareTaker) keeps its active line as before:
+the edges (commands, deltas or snapshots) from its oldest state to its
+most recent one. When a new edit is made after an undo, the edges that
+could be redone are kept in a HistoryTree as a Branch instead of being
+dropped. A branch only holds its own edges: the states before its fork
+are shared with the line, or with the branch it forks from.
+
+    line:    s0 -> s1 -> s2 -> s3 -> s4
+                         \\
+    branch:               -> b3 -> b4 -> b5   (fork 2, 3 edges)
+
+Switching to a branch swaps it with the part of the line after its fork,
+which becomes a branch in turn. Only the edges between the two positions
+are undone and redone, see CommandManager.switch_branch and
+CareTaker.switch_branch.
+
+When the history is over its memory budget, the least recently visited
+branch without branches of its own is pruned first, before any state of
+the line is evicted.
+"""
+
+from typing import Any, Callable, Iterator, List, Optional
+
+
+class Branch:
+    """
+    edges of a history that are not on its active line, in order
+    """
+
+    __slots__ = ("parent", "fork", "edges", "branches", "visited", "nbytes")
+
+    def __init__(
+        self,
+        parent: Optional["Branch"],
+        fork: int,
+        edges: List[Any],
+        nbytes: int,
+        visited: int,
+    ) -> None:
+        """
+        Args:
+            parent: branch it forks from, None if it forks from the line
+            fork: index of the state of the line it forks from, or number
+                of edges of its parent before the fork
+            edges: edges from the fork to the tip of the branch
+            nbytes: bytes held by the edges
+            visited: when the branch was last on the line, see
+                HistoryTree.tick
+        """
+        self.parent = parent
+        self.fork = fork
+        self.edges = edges
+        self.branches: List["Branch"] = []
+        self.visited = visited
+        self.nbytes = nbytes
+
+    def __len__(self) -> int:
+        return len(self.edges)
+
+    @property
+    def fork_depth(self) -> int:
+        """
+        number of edges from the oldest state to the fork
+        """
+        if self.parent is None:
+            return self.fork
+        return self.parent.fork_depth + self.fork
+
+
+class HistoryTree:
+    """
+    The branches of a history, the line itself is kept by the history
+    """
+
+    def __init__(
+        self,
+        edge_nbytes: Callable[[Any], int],
+        release: Optional[Callable[[Any], None]] = None,
+    ) -> None:
+        """
+        Args:
+            edge_nbytes: returns the bytes held by an edge
+            release: frees what an edge holds outside of the tree, eg:
+                its spilled files, when its branch is pruned
+        """
+        self.edge_nbytes = edge_nbytes
+        self.release = release
+        # branches forking from the line
+        self.branches: List[Branch] = []
+        # bytes held by the edges of all the branches
+        self.nbytes = 0
+        self._clock = 0
+
+    def __len__(self) -> int:
+        """
+        returns the number of branches
+        """
+        return sum(1 for _ in self)
+
+    def __iter__(self) -> Iterator[Branch]:
+        """
+        iterate over all the branches, each one before its own branches
+        """
+        stack = list(reversed(self.branches))
+        while stack:
+            branch = stack.pop()
+            yield branch
+            stack.extend(reversed(branch.branches))
+
+    def tick(self) -> int:
+        self._clock += 1
+        return self._clock
+
+    def stash(self, fork: int, edges: List[Any]) -> Optional[Branch]:
+        """
+        keep the edges that followed the state `fork` of the line as a
+        branch, the branches forking after that state move into it
+
+        Returns:
+            the new branch, None if there were no edges
+        """
+        if not edges:
+            return None
+        nbytes = sum(self.edge_nbytes(edge) for edge in edges)
+        branch = Branch(None, fork, list(edges), nbytes, self.tick())
+        kept = []
+        for child in self.branches:
+            if child.fork > fork:
+                child.parent = branch
+                child.fork -= fork
+                branch.branches.append(child)
+            else:
+                kept.append(child)
+        self.branches = kept + [branch]
+        self.nbytes += nbytes
+        return branch
+
+    def switch(
+        self,
+        branch: Branch,
+        detach: Callable[[int], List[Any]],
+        attach: Callable[[List[Any]], None],
+    ) -> None:
+        """
+        Put a branch on the line, with the branches it forks from: the
+        line after each fork is stashed as a branch, and replaced by the
+        edges of the branch.
+
+        Args:
+            branch: one of the branches of the tree
+            detach: removes the edges after a state of the line from it
+                and returns them, the state itself stays on the line
+            attach: appends edges at the end of the line
+        """
+        chain = [branch]
+        while chain[-1].parent is not None:
+            chain.append(chain[-1].parent)
+        for promoted in reversed(chain):
+            # it forks from the line now
+            self.branches.remove(promoted)
+            self.nbytes -= promoted.nbytes
+            self.stash(promoted.fork, detach(promoted.fork))
+            attach(promoted.edges)
+            for child in promoted.branches:
+                child.parent = None
+                child.fork += promoted.fork
+                self.branches.append(child)
+
+    def prune_coldest(self) -> int:
+        """
+        drop the least recently visited branch that has no branches
+
+        Returns:
+            the bytes freed, 0 if there was no branch
+        """
+        leaves = [branch for branch in self if not branch.branches]
+        if not leaves:
+            return 0
+        coldest = min(leaves, key=lambda branch: branch.visited)
+        siblings = (
+            self.branches
+            if coldest.parent is None
+            else coldest.parent.branches
+        )
+        siblings.remove(coldest)
+        return self._drop(coldest)
+
+    def remove_states(self, start: int, stop: Optional[int] = None) -> int:
+        """
+        the states [start, stop) of the line were removed: drop the
+        branches forking from them, the branches forking after them move
+        back with the following states
+
+        Returns:
+            the bytes freed
+        """
+        freed = 0
+        kept = []
+        for branch in self.branches:
+            if branch.fork < start:
+                kept.append(branch)
+            elif stop is None or branch.fork < stop:
+                freed += self._drop(branch)
+            else:
+                branch.fork -= stop - start
+                kept.append(branch)
+        self.branches = kept
+        return freed
+
+    def clear(self) -> int:
+        """
+        drop all the branches
+
+        Returns:
+            the bytes freed
+        """
+        return self.remove_states(0)
+
+    def _drop(self, branch: Branch) -> int:
+        """
+        release a branch removed from the tree, with its own branches
+        """
+        freed = sum(self._drop(child) for child in branch.branches)
+        if self.release is not None:
+            for edge in branch.edges:
+                self.release(edge)
+        self.nbytes -= branch.nbytes
+        return freed + branch.nbytes